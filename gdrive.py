@@ -2,14 +2,34 @@
 
 """A script to interact with your Google Drive files using the terminal"""
 
-from modules import logger
+from modules import logger, tracing
 from modules.backports import asyncio_run_compat
 from modules.command import CommandParser
+from modules.profiler import SamplingProfiler
 from modules.util import current_python_version_supported, min_python_version_str, current_python_version_str
 
 
 async def main():
-    await CommandParser().execute_command()
+    parser = CommandParser()
+    if parser.args.trace_out:
+        tracing.start()
+    try:
+        await profiled(parser)
+    finally:
+        if parser.args.trace_out:
+            tracing.write(parser.args.trace_out)
+
+
+async def profiled(parser: CommandParser):
+    if not parser.args.profile:
+        await parser.execute_command()
+        return
+    profiler = SamplingProfiler()
+    try:
+        with profiler:
+            await parser.execute_command()
+    finally:
+        profiler.write(parser.args.profile)
 
 
 if __name__ == '__main__':
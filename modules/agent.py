@@ -0,0 +1,237 @@
+import asyncio
+import json
+import os
+import socket
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Hashable, Optional
+
+from modules import config, logger
+from modules.backports import to_thread_compat
+from modules.chunks import create_chunks, transfer
+from modules.googleservice import DriveQueries, DriveQuery, DESCRIPTION_FIELDS
+from modules.memorybudget import MemoryBudget
+from modules.progresslogger import Progress
+
+# Messages are JSON objects, one per line. A client sends a single request, {"job": ..., "params": {...}}, and the
+# agent answers with any number of {"progress": [received, total]} messages, followed by either {"result": ...} or
+# {"error": ...}. Then the connection is closed.
+
+
+class AgentError(Exception):
+    """An error reported by the agent while running a job"""
+
+
+def is_supported() -> bool:
+    return hasattr(socket, 'AF_UNIX')
+
+
+def _encode(message: dict) -> bytes:
+    return (json.dumps(message) + '\n').encode()
+
+
+def _progress_message(progress: Progress) -> dict:
+    return {'progress': [progress.bytes_received, progress.bytes_total]}
+
+
+def _check_error(message: dict) -> dict:
+    if 'error' in message:
+        raise AgentError(message['error'])
+    return message
+
+
+class MetadataCache:
+    """Metadata looked up recently, kept for ttl seconds, and for at most max_size files.
+
+    Entries are kept in the order they were stored in, so the oldest ones, which are also the first to expire, are
+    the ones dropped whenever an entry is stored. So the cache never grows beyond max_size, however long the agent runs.
+    """
+
+    def __init__(self, ttl=config.AGENT_METADATA_TTL, max_size=config.AGENT_METADATA_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # Key -> (time stored, metadata)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry[0] >= self.ttl:
+            del self._entries[key]
+            return None
+        return entry[1]
+
+    def put(self, key: Hashable, metadata: dict):
+        self._entries.pop(key, None)
+        self._entries[key] = (time.time(), metadata)
+        now = time.time()
+        while self._entries:
+            oldest_key, (stored, _) = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_size and now - stored < self.ttl:
+                break
+            del self._entries[oldest_key]
+
+
+class Agent:
+    """A long-lived process that keeps a GoogleService, its connections and caches warm for the CLI commands.
+
+    All transfers share a single executor, so concurrent CLI calls are scheduled together instead of each one
+    opening its own set of connections.
+    """
+
+    def __init__(self, socket_path=config.AGENT_SOCKET_PATH, google=None, memory: Optional[MemoryBudget] = None):
+        from modules.googleservice import GoogleService
+        self.socket_path = socket_path
+        self.google = google or GoogleService()
+        self.executor = ThreadPoolExecutor(max_workers=config.AGENT_WORKERS)
+        # Shared by the downloads of all clients, so together they stay within the agent's --max-memory
+        self.memory = memory or MemoryBudget(config.DOWNLOAD_MAX_MEMORY)
+        self._metadata_cache = MetadataCache()
+
+    async def serve(self):
+        if AgentClient.connect_if_running(self.socket_path):
+            # Removing its socket would leave that agent running, but unreachable
+            raise AgentError(f"An agent is already running on {self.socket_path}")
+        if os.path.exists(self.socket_path):
+            logger.d(f"Removing stale agent socket {self.socket_path}")
+            os.remove(self.socket_path)
+        # The socket is created only accessible by us, instead of made so after it is already listening
+        umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self._handle, path=self.socket_path)
+        finally:
+            os.umask(umask)
+        print(f"gdrive agent listening on {self.socket_path}")
+        try:
+            # Serve until interrupted
+            await asyncio.get_event_loop().create_future()
+        finally:
+            server.close()
+            self.executor.shutdown()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    async def _handle(self, reader, writer):
+        try:
+            request = json.loads(await reader.readline())
+            logger.d(f"Agent received request {request}")
+            job = getattr(self, f"_job_{request['job']}")
+            async for message in job(**request.get('params', {})):
+                writer.write(_encode(message))
+                await writer.drain()
+        except BaseException as e:
+            logger.d("Agent failed running job", e)
+            logger.stacktrace()
+            try:
+                writer.write(_encode({'error': str(e) or type(e).__name__}))
+                await writer.drain()
+            except ConnectionError:
+                pass
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            writer.close()
+
+    async def _job_metadata(self, file_id, fields):
+        fields = tuple(fields)
+        cached = self._metadata_cache.get((file_id, fields))
+        if cached is not None:
+            yield {'result': cached}
+            return
+        metadata = await to_thread_compat(self.google.get_file_metadata, file_id, fields)
+        if metadata is not None:
+            self._metadata_cache.put((file_id, fields), metadata)
+        yield {'result': metadata}
+
+    async def _job_search(self, query, page_size, page_token, fields):
+        fields = tuple(fields)
+        files_found, next_page_token = await to_thread_compat(self.google.search_page, DriveQuery(**query), page_size,
+                                                              page_token, fields)
+        for metadata in files_found:
+            self._metadata_cache.put((metadata['id'], fields), metadata)
+        yield {'result': [files_found, next_page_token]}
+
+    async def _job_download(self, metadata, file_path):
+        file_downloader = self.google.get_file_downloader(metadata)
+        chunks = create_chunks(file_path, int(metadata['size']), config.DOWNLOAD_CHUNK_SIZE, file_downloader,
+                               self.memory, executor=self.executor, owns_executor=False)
+        async for progress in transfer(chunks):
+            yield _progress_message(progress)
+        yield {'result': None}
+
+    async def _job_upload(self, file_path, mimetype):
+        request = self.google.upload(file_path, mimetype)
+        response = None
+        while not response:
+            # With the http of the worker thread, since other clients may be uploading at the same time
+            status, response = await to_thread_compat(self.google.upload_chunk, request)
+            if status:
+                yield _progress_message(Progress(status.resumable_progress, status.total_size))
+        yield {'result': {'id': response.get('id')}}
+
+
+class AgentClient(DriveQueries):
+    """Talks to a running Agent, offering the same queries as GoogleService and streaming transfers"""
+
+    def __init__(self, socket_path=config.AGENT_SOCKET_PATH):
+        self.socket_path = socket_path
+
+    @staticmethod
+    def connect_if_running(socket_path=config.AGENT_SOCKET_PATH) -> Optional['AgentClient']:
+        if not is_supported() or not os.path.exists(socket_path):
+            return None
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(socket_path)
+        except OSError as e:
+            logger.d(f"Agent socket {socket_path} exists, but no agent is answering", e)
+            return None
+        logger.d(f"Using agent at {socket_path}")
+        return AgentClient(socket_path)
+
+    @staticmethod
+    def is_valid():
+        return True
+
+    def request(self, job, **params):
+        """Sends a job to the agent and returns its result, blocking until it is done"""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.socket_path)
+            sock.sendall(_encode({'job': job, 'params': params}))
+            with sock.makefile('r') as lines:
+                for line in lines:
+                    message = _check_error(json.loads(line))
+                    if 'result' in message:
+                        return message['result']
+        raise AgentError(f"Agent closed the connection before finishing job '{job}'")
+
+    async def stream(self, job, **params):
+        """Sends a job to the agent and yields its progress as Progress objects, and lastly its result dict"""
+        reader, writer = await asyncio.open_unix_connection(self.socket_path)
+        try:
+            writer.write(_encode({'job': job, 'params': params}))
+            await writer.drain()
+            while True:
+                line = await reader.readline()
+                if not line:
+                    raise AgentError(f"Agent closed the connection before finishing job '{job}'")
+                message = _check_error(json.loads(line))
+                if 'progress' in message:
+                    yield Progress(*message['progress'])
+                else:
+                    yield message
+                    return
+        finally:
+            writer.close()
+
+    def get_file_metadata(self, file_id, fields=DESCRIPTION_FIELDS):
+        return self.request('metadata', file_id=file_id, fields=fields)
+
+    def search_page(self, query: DriveQuery, page_size=1, page_token='', fields=DESCRIPTION_FIELDS):
+        files_found, next_page_token = self.request('search', query=query.to_dict(), page_size=page_size,
+                                                    page_token=page_token, fields=fields)
+        return files_found, next_page_token
@@ -0,0 +1,54 @@
+import tarfile
+import zipfile
+from typing import BinaryIO, List, Tuple
+
+
+class ArchiveError(Exception):
+    """A file that is not a zip or tar archive, or a member that is not in it"""
+
+
+class Archive:
+    """Reads the members of a zip or tar archive from a seekable file object, like a DriveFile.
+
+    Zip archives are read from their central directory, at the end, and uncompressed tar archives header by header,
+    so only the ranges holding the listing, and the members that are opened, are read. Compressed tar archives have to
+    be decompressed from the start, so they are read up to the member that is needed.
+    """
+
+    def __init__(self, fileobj: BinaryIO):
+        self._zip = None
+        self._tar = None
+        if zipfile.is_zipfile(fileobj):
+            self._zip = zipfile.ZipFile(fileobj)
+            return
+        fileobj.seek(0)
+        try:
+            self._tar = tarfile.open(fileobj=fileobj, mode='r:*')
+        except tarfile.TarError:
+            raise ArchiveError("Not a zip or tar archive")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def members(self) -> List[Tuple[str, int]]:
+        """Names and sizes of the files in the archive"""
+        if self._zip:
+            return [(info.filename, info.file_size) for info in self._zip.infolist() if not info.is_dir()]
+        return [(info.name, info.size) for info in self._tar.getmembers() if info.isfile()]
+
+    def open(self, name: str) -> BinaryIO:
+        try:
+            if self._zip:
+                return self._zip.open(name)
+            member = self._tar.extractfile(name)
+        except KeyError:
+            raise ArchiveError(f"No member '{name}' in the archive")
+        if member is None:
+            raise ArchiveError(f"Member '{name}' is not a file")
+        return member
+
+    def close(self):
+        (self._zip or self._tar).close()
@@ -0,0 +1,186 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from modules import config, logger
+from modules.backports import to_thread_compat
+from modules.chunks import complete, create_chunks
+from modules.googleservice import DriveQuery, DOWNLOAD_FIELDS
+from modules.memorybudget import MemoryBudget
+from modules.util import guess_mimetype
+
+# A batch manifest has one job per line, as JSON:
+#   {"op": "download", "file_id": "<id>", "output": "<path, optional>"}
+#   {"op": "download", "name": "<name to search>", "output": "<path, optional>"}
+#   {"op": "upload", "path": "<path>"}
+# Any job may have an "id". Jobs without one are identified by their content.
+
+DONE = 'done'
+FAILED = 'failed'
+
+
+class BatchError(Exception):
+    """A batch job that cannot be run"""
+
+
+def job_key(job: dict) -> str:
+    if 'id' in job:
+        return str(job['id'])
+    return hashlib.sha1(json.dumps(job, sort_keys=True).encode()).hexdigest()
+
+
+def read_jobs(manifest_path: str) -> List[dict]:
+    jobs = []
+    with open(manifest_path, 'r') as f:
+        for number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                jobs.append(json.loads(line))
+            except ValueError as e:
+                raise BatchError(f"Line {number} of {manifest_path} is not valid JSON: {e}")
+    return jobs
+
+
+class BatchQueue:
+    """The state of each job of a batch, kept in an append-only file of JSON lines, so it survives crashes.
+
+    The last line about a job wins. Jobs that are done are skipped when the batch runs again, failed ones are retried.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.states: Dict[str, dict] = {}
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash
+                    logger.d(f"Ignoring invalid line in batch queue {self.path}: {line}")
+                    continue
+                self.states[record['job']] = record
+
+    def is_done(self, key: str) -> bool:
+        return self.states.get(key, {}).get('state') == DONE
+
+    def record(self, key: str, state: str, **details):
+        record = dict(job=key, state=state, time=time.time(), **details)
+        self.states[key] = record
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class Batch:
+    """Runs the jobs of a manifest concurrently, through a single GoogleService.
+
+    All jobs share the service's connections and request governor, and downloads share one executor, so the whole
+    batch is scheduled together. The files of download jobs by ID are looked up ahead of the jobs, many per request, so
+    the lookups of later jobs overlap the downloads of earlier ones, and small files cost little more than their
+    download.
+    """
+
+    def __init__(self, google, queue: BatchQueue, concurrency: int, memory: MemoryBudget):
+        self.google = google
+        self.queue = queue
+        self.memory = memory  # Shared by the download jobs running at the same time
+        self._jobs = asyncio.Semaphore(concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=config.BATCH_WORKERS)
+        self._lookups: Dict[str, asyncio.Future] = {}  # ID of a file to download -> its metadata, once looked up
+
+    async def run(self, jobs: List[dict]) -> bool:
+        """Runs the jobs that are not done yet. Returns whether all of them are done."""
+        pending = [job for job in jobs if not self.queue.is_done(job_key(job))]
+        print(f"{len(jobs) - len(pending)} of {len(jobs)} jobs already done, running {len(pending)}.")
+        file_ids = list(dict.fromkeys(job['file_id'] for job in pending
+                                      if job.get('op') == 'download' and 'file_id' in job))
+        self._lookups = {file_id: asyncio.get_event_loop().create_future() for file_id in file_ids}
+        look_up = asyncio.ensure_future(self._look_up_files(file_ids))
+        try:
+            results = await asyncio.gather(*map(self._run_job, pending))
+        finally:
+            look_up.cancel()
+            self._executor.shutdown()
+        failed = results.count(False)
+        print(f"Batch finished: {len(pending) - failed} jobs done, {failed} failed.")
+        return failed == 0
+
+    async def _look_up_files(self, file_ids: List[str]):
+        """Looks the files up in groups, in the order of their jobs, so the first jobs can start early"""
+        for start in range(0, len(file_ids), config.METADATA_BATCH_SIZE):
+            group = file_ids[start:start + config.METADATA_BATCH_SIZE]
+            try:
+                found = await to_thread_compat(self.google.get_files_metadata, group, DOWNLOAD_FIELDS)
+            except Exception as e:
+                for file_id in group:
+                    self._lookups[file_id].set_exception(e)
+                continue
+            for file_id in group:
+                self._lookups[file_id].set_result(found.get(file_id))
+
+    async def _file_metadata(self, file_id: str):
+        lookup = self._lookups.get(file_id)
+        if lookup is not None:
+            try:
+                # Shielded, since jobs with the same file share the lookup
+                return await asyncio.shield(lookup)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.d(f"Batched lookup of file {file_id} failed, looking it up alone", e)
+        return await to_thread_compat(self.google.get_file_metadata, file_id, DOWNLOAD_FIELDS)
+
+    async def _run_job(self, job: dict) -> bool:
+        key = job_key(job)
+        async with self._jobs:
+            try:
+                operation = getattr(self, f"_{job.get('op')}", None)
+                if operation is None:
+                    raise BatchError(f"Unknown operation '{job.get('op')}'")
+                result = await operation(job)
+            except Exception as e:
+                logger.stacktrace()
+                print(f"[{FAILED}] {key}: {e}")
+                self.queue.record(key, FAILED, error=str(e) or type(e).__name__)
+                return False
+            print(f"[{DONE}] {key}")
+            self.queue.record(key, DONE, result=result)
+            return True
+
+    async def _download(self, job: dict):
+        if 'file_id' in job:
+            metadata = await self._file_metadata(job['file_id'])
+        elif 'name' in job:
+            metadata = await to_thread_compat(self.google.find_first, DriveQuery(name=job['name']), DOWNLOAD_FIELDS)
+        else:
+            raise BatchError("Download jobs need a 'file_id' or a 'name'")
+        if metadata is None:
+            raise BatchError("File not found")
+        output = job.get('output') or metadata['name']
+        file_downloader = self.google.get_file_downloader(metadata)
+        chunks = create_chunks(output, int(metadata['size']), config.DOWNLOAD_CHUNK_SIZE, file_downloader,
+                               self.memory, executor=self._executor, owns_executor=False)
+        await complete(chunks)
+        return {'file_id': metadata['id'], 'output': output}
+
+    async def _upload(self, job: dict):
+        if 'path' not in job:
+            raise BatchError("Upload jobs need a 'path'")
+        request = self.google.upload(job['path'], guess_mimetype(job['path']))
+        response = None
+        while not response:
+            # With the http of the worker thread, since other jobs upload at the same time
+            _, response = await to_thread_compat(self.google.upload_chunk, request)
+        return {'file_id': response.get('id')}
@@ -0,0 +1,444 @@
+import asyncio
+import hashlib
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+from modules import config, logger
+from modules.util import create_dir, remove_file
+
+# Clients ask for GET /files/<file ID>?md5=<md5Checksum>&size=<size>, with a Range header, like they would ask Drive.
+# Files are cached by ID, checksum and size together, so a file changed on Drive is a new entry, and a client can only
+# get what it would have got from Drive for the same metadata. The cache server has no credentials of its own: misses
+# are fetched from Drive with the token of the client that asked, so tokens are refreshed, and access checked, by
+# clients. Clients ask without their token first, and the server answers 401 when it needs one, so tokens only cross
+# the LAN for misses. Hits are served to anyone who can reach the server, so it is meant for a trusted LAN.
+
+_FILE_PATH = re.compile(r'^/files/([\w-]+)$')
+_CHECKSUM = re.compile(r'^[0-9a-f]{32}$')
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+_RELAYED_HEADERS = ('content-type', 'retry-after')
+
+
+def media_uri(server: str, metadata) -> str:
+    """The URI of the media of a file on a cache server"""
+    query = urlencode({'md5': metadata['md5Checksum'], 'size': metadata['size']})
+    return f"{server.rstrip('/')}/files/{metadata['id']}?{query}"
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """The first and last byte of a Range header, None for the whole file. Raises ValueError if unsatisfiable."""
+    match = _RANGE.match(header or '')
+    if match is None:
+        # Not a single byte range, which is all Drive clients ask for
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        first, last = max(0, size - int(last)), size - 1
+    else:
+        first, last = int(first), min(int(last), size - 1) if last else size - 1
+    if first > last or first >= size:
+        raise ValueError(f"Range {header} is not satisfiable for a file of {size} bytes")
+    return first, last
+
+
+class UpstreamError(Exception):
+    """A response from Drive that is not the content asked for, relayed as is to the client"""
+
+    def __init__(self, status: int, reason: str, headers: Dict[str, str], body: bytes):
+        super().__init__(f"{status} {reason}")
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+
+class CacheEntry:
+    """The cached media of a file: a sparse file as big as the file, and which of its blocks are there"""
+
+    def __init__(self, path: str, checksum: str, size: int, block_size: int):
+        self.path = path
+        self.checksum = checksum
+        self.size = size
+        self.block_size = block_size
+        self.blocks_path = f'{path}.blocks'
+        self.users = 0  # Responses and fetches using the entry, which keep it from being evicted
+        self.dropped = False  # Removed from the cache, like for content that did not match its checksum
+        self._save_lock = threading.Lock()
+        number_of_blocks = -(-size // block_size)
+        try:
+            with open(self.blocks_path, 'rb') as f:
+                self.blocks = bytearray(f.read())
+        except FileNotFoundError:
+            self.blocks = bytearray()
+        if len(self.blocks) != number_of_blocks or not os.path.exists(path):
+            self.blocks = bytearray(number_of_blocks)
+            with open(path, 'wb') as f:
+                f.truncate(size)
+
+    def block_range(self, first: int, last: int) -> range:
+        """The blocks holding the bytes first to last"""
+        return range(first // self.block_size, last // self.block_size + 1)
+
+    def byte_range(self, first_block: int, last_block: int) -> Tuple[int, int]:
+        return first_block * self.block_size, min(self.size, (last_block + 1) * self.block_size) - 1
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(path) and os.path.exists(f'{path}.blocks')
+
+    def has(self, block: int) -> bool:
+        return bool(self.blocks[block])
+
+    def completes(self, first_block: int, last_block: int) -> bool:
+        """Whether these blocks are the only ones missing"""
+        return all(self.blocks[block] or first_block <= block <= last_block for block in range(len(self.blocks)))
+
+    def md5(self) -> str:
+        md5 = hashlib.md5()
+        with open(self.path, 'rb') as f:
+            for block in iter(lambda: f.read(self.block_size), b''):
+                md5.update(block)
+        return md5.hexdigest()
+
+    def mark(self, first_block: int, last_block: int):
+        for block in range(first_block, last_block + 1):
+            self.blocks[block] = 1
+
+    def save(self):
+        """Writes which blocks are there, for a restart to find them. Safe to call from any number of threads."""
+        with self._save_lock:
+            tmp_path = f'{self.blocks_path}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(bytes(self.blocks))
+            os.replace(tmp_path, self.blocks_path)
+
+
+class CacheServer:
+    """A caching HTTP proxy for Drive media, so the machines of a LAN download each file from Drive only once.
+
+    Files are stored by blocks, so any range can be served from disk as soon as its blocks are there, without the whole
+    file. When clients ask for blocks that are missing, each run of missing blocks is fetched from Drive with a single
+    request, and clients asking for blocks already being fetched wait for that fetch instead of starting their own.
+    When the cache grows beyond max_size, the least recently used entries are evicted.
+
+    Nothing is allocated for what clients claim: an entry is only created once Drive confirms the file has the checksum
+    and size asked for, and once all of its blocks are there, its content is checked against the checksum, so blocks
+    of a file changed on Drive in the meantime are never kept as the version asked for.
+    """
+
+    def __init__(self, path=config.CACHE_SERVER_PATH, max_size=config.CACHE_SERVER_MAX_SIZE,
+                 block_size=config.CACHE_SERVER_BLOCK_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.block_size = block_size
+        self.executor = ThreadPoolExecutor(max_workers=config.CACHE_SERVER_WORKERS)
+        self._entries: Dict[str, CacheEntry] = {}
+        self._fetches: Dict[Tuple[str, int], asyncio.Future] = {}  # (entry path, block) -> its fetch, in flight
+        self._creations: Dict[str, asyncio.Future] = {}  # Entry path -> its creation, in flight
+        self._size: Optional[int] = None  # Bytes the entries take on disk, as of the last scan plus fetches since
+        self._local = threading.local()
+
+    async def serve(self, host=config.CACHE_SERVER_BIND, port=config.CACHE_SERVER_PORT):
+        create_dir(self.path)
+        server = await asyncio.start_server(self._handle, host, port)
+        print(f"gdrive cache server listening on {host}:{port}, caching into {self.path}")
+        try:
+            # Serve until interrupted
+            await asyncio.get_event_loop().create_future()
+        finally:
+            server.close()
+            self.executor.shutdown()
+
+    async def _run(self, function, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, function, *args)
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    await self._send(writer, 400, 'Bad Request')
+                    break
+                await self._respond(writer, method, target, headers)
+                if version != 'HTTP/1.1' or headers.get('connection', '').lower() == 'close':
+                    break
+        except ConnectionError as e:
+            logger.d("Cache server client went away", e)
+        except BaseException as e:
+            logger.d("Cache server failed answering a request", e)
+            logger.stacktrace()
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _head(status: int, reason: str, headers: Dict[str, str]) -> bytes:
+        lines = [f'HTTP/1.1 {status} {reason}'] + [f'{name}: {value}' for name, value in headers.items()]
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    async def _send(self, writer, status: int, reason: str, headers: Dict[str, str] = None, body: bytes = b''):
+        writer.write(self._head(status, reason, dict(headers or {}, **{'Content-Length': str(len(body))})) + body)
+        await writer.drain()
+
+    async def _respond(self, writer, method: str, target: str, headers: Dict[str, str]):
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+        match = _FILE_PATH.match(url.path)
+        checksum = query.get('md5', [''])[0]
+        size = query.get('size', [''])[0]
+        if method != 'GET':
+            await self._send(writer, 405, 'Method Not Allowed', {'Allow': 'GET'})
+            return
+        if match is None or not _CHECKSUM.match(checksum) or not size.isdigit():
+            await self._send(writer, 404, 'Not Found')
+            return
+        file_id, size = match.group(1), int(size)
+        try:
+            byte_range = parse_range(headers.get('range'), size) if size else None
+        except ValueError:
+            await self._send(writer, 416, 'Range Not Satisfiable', {'Content-Range': f'bytes */{size}'})
+            return
+        response_headers = {'Content-Type': 'application/octet-stream', 'Accept-Ranges': 'bytes'}
+        if not size:
+            # Nothing to cache, nor to ask Drive for
+            await self._send(writer, 200, 'OK', response_headers)
+            return
+        authorization = headers.get('authorization')
+        try:
+            entry = await self._entry(file_id, checksum, size, authorization)
+        except UpstreamError as e:
+            await self._send(writer, e.status, e.reason, e.headers, e.body)
+            return
+        entry.users += 1
+        try:
+            first, last = byte_range or (0, size - 1)
+            await self._ensure(entry, file_id, first, last, authorization)
+            if byte_range is None:
+                await self._stream(writer, 200, 'OK', response_headers, entry, first, last)
+            else:
+                response_headers['Content-Range'] = f'bytes {first}-{last}/{size}'
+                await self._stream(writer, 206, 'Partial Content', response_headers, entry, first, last)
+        except UpstreamError as e:
+            await self._send(writer, e.status, e.reason, e.headers, e.body)
+        finally:
+            entry.users -= 1
+
+    async def _entry(self, file_id: str, checksum: str, size: int, authorization: Optional[str]) -> CacheEntry:
+        path = os.path.join(self.path, f'{file_id}-{checksum}-{size}')
+        entry = self._entries.get(path)
+        if entry is None:
+            creation = self._creations.get(path)
+            if creation is None:
+                creation = self._creations[path] = asyncio.ensure_future(
+                    self._create_entry(path, file_id, checksum, size, authorization))
+                creation.add_done_callback(lambda _: self._creations.pop(path, None))
+                creation.add_done_callback(_retrieve)
+            entry = await asyncio.shield(creation)
+        os.utime(entry.path)
+        return entry
+
+    async def _create_entry(self, path: str, file_id: str, checksum: str, size: int,
+                            authorization: Optional[str]) -> CacheEntry:
+        if not CacheEntry.exists(path):
+            # Nothing is allocated before Drive confirms the file has the checksum and size the client claims
+            await self._run(self._check_metadata, file_id, checksum, size, self._authorized(authorization))
+        entry = self._entries[path] = await self._run(CacheEntry, path, checksum, size, self.block_size)
+        return entry
+
+    @staticmethod
+    def _authorized(authorization: Optional[str]) -> str:
+        """The token to ask Drive with or, if the client sent none, a challenge for it to ask again with one"""
+        if not authorization:
+            raise UpstreamError(401, 'Unauthorized', {'WWW-Authenticate': 'Bearer'},
+                                b'Not cached yet, ask again with a token for Drive')
+        return authorization
+
+    async def _ensure(self, entry: CacheEntry, file_id: str, first: int, last: int, authorization: Optional[str]):
+        """Makes the blocks of bytes first to last be in the entry, fetching the missing ones that no one is fetching,
+        and waiting for the ones being fetched"""
+        while True:
+            if entry.dropped:
+                raise UpstreamError(502, 'Bad Gateway', {}, b'The file changed on Drive while it was being cached')
+            missing = [block for block in entry.block_range(first, last) if not entry.has(block)]
+            if not missing:
+                return
+            in_flight = list(dict.fromkeys(self._fetches[entry.path, block] for block in missing
+                                           if (entry.path, block) in self._fetches))
+            runs = _runs([block for block in missing if (entry.path, block) not in self._fetches])
+            if runs:
+                authorization = self._authorized(authorization)
+            # Registered before waiting for anything, so clients asking for the same blocks meanwhile wait for these
+            fetches = [self._start_fetch(entry, file_id, first_block, last_block, authorization)
+                       for first_block, last_block in runs]
+            # Fetches of other clients that fail, maybe for their tokens, are retried with ours on the next round.
+            # Shielded, so a client going away does not cancel fetches others wait for.
+            results = await asyncio.gather(*(asyncio.shield(fetch) for fetch in fetches + in_flight),
+                                           return_exceptions=True)
+            for result in results[:len(fetches)]:
+                if isinstance(result, BaseException):
+                    raise result
+
+    def _start_fetch(self, entry: CacheEntry, file_id: str, first_block: int, last_block: int,
+                     authorization: str) -> asyncio.Future:
+        fetch = asyncio.ensure_future(self._fetch(entry, file_id, first_block, last_block, authorization))
+        blocks = range(first_block, last_block + 1)
+        for block in blocks:
+            self._fetches[entry.path, block] = fetch
+        entry.users += 1
+
+        def done(_):
+            # A callback, so it happens even for a fetch cancelled before it started
+            entry.users -= 1
+            for block in blocks:
+                self._fetches.pop((entry.path, block), None)
+
+        fetch.add_done_callback(done)
+        fetch.add_done_callback(_retrieve)
+        return fetch
+
+    async def _fetch(self, entry: CacheEntry, file_id: str, first_block: int, last_block: int, authorization: str):
+        first, last = entry.byte_range(first_block, last_block)
+        logger.d(f"Cache server fetching bytes {first}-{last} of file {file_id}")
+        await self._run(self._download, entry, file_id, first, last, authorization)
+        # Only one fetch completes an entry, since all the others are marked by then
+        if entry.completes(first_block, last_block) and await self._run(entry.md5) != entry.checksum:
+            logger.d(f"Cache server entry {entry.path} does not match its checksum, dropping it")
+            self._drop(entry)
+            raise UpstreamError(502, 'Bad Gateway', {}, b'The file changed on Drive while it was being cached')
+        # Marked on the loop, so the next fetch to finish sees whether it completes the entry
+        entry.mark(first_block, last_block)
+        await self._run(entry.save)
+        if self._size is not None:
+            self._size += last - first + 1
+        if self._size is None or self._size > self.max_size:
+            await self._evict()
+
+    def _drop(self, entry: CacheEntry):
+        entry.dropped = True
+        if self._entries.get(entry.path) is entry:
+            del self._entries[entry.path]
+        remove_file(entry.path, entry.blocks_path)
+
+    def _check_metadata(self, file_id: str, checksum: str, size: int, authorization: str):
+        """Raises UpstreamError unless the file is on Drive with this checksum and size"""
+        response = self._session().get(config.DRIVE_METADATA_URI.format(file_id),
+                                       headers={'Authorization': authorization}, timeout=config.DOWNLOAD_READ_TIMEOUT)
+        if response.status_code >= 300:
+            raise UpstreamError(response.status_code, response.reason,
+                                {name: response.headers[name] for name in _RELAYED_HEADERS
+                                 if name in response.headers}, response.content)
+        metadata = response.json()
+        if metadata.get('md5Checksum') != checksum or metadata.get('size') != str(size):
+            raise UpstreamError(404, 'Not Found', {}, b'Drive has no such version of the file')
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            import requests
+            session = self._local.session = requests.Session()
+        return session
+
+    def _download(self, entry: CacheEntry, file_id: str, first: int, last: int, authorization: Optional[str]):
+        headers = {'Range': f'bytes={first}-{last}'}
+        if authorization:
+            headers['Authorization'] = authorization
+        response = self._session().get(config.DRIVE_MEDIA_URI.format(file_id), headers=headers, stream=True,
+                                       timeout=config.DOWNLOAD_READ_TIMEOUT)
+        try:
+            if response.status_code >= 300:
+                raise UpstreamError(response.status_code, response.reason,
+                                    {name: response.headers[name] for name in _RELAYED_HEADERS
+                                     if name in response.headers}, response.content)
+            total = response.headers.get('content-range', '').rpartition('/')[2]
+            if response.status_code != 206 or total != str(entry.size):
+                raise UpstreamError(502, 'Bad Gateway', {}, b'Drive did not send the range asked for, of a file of '
+                                                            b'the size asked for')
+            offset = first
+            with open(entry.path, 'r+b') as f:
+                f.seek(first)
+                for block in response.iter_content(config.DOWNLOAD_READ_BLOCK_SIZE):
+                    f.write(block[:last + 1 - offset])
+                    offset += len(block)
+            if offset < last + 1:
+                raise UpstreamError(502, 'Bad Gateway', {}, b'Drive sent fewer bytes than asked for')
+        finally:
+            response.close()
+
+    async def _stream(self, writer, status: int, reason: str, headers: Dict[str, str], entry: CacheEntry,
+                      first: int, last: int):
+        writer.write(self._head(status, reason, dict(headers, **{'Content-Length': str(last - first + 1)})))
+        if entry.size:
+            with open(entry.path, 'rb') as f:
+                offset = first
+                while offset <= last:
+                    block = await self._run(os.pread, f.fileno(), min(self.block_size, last + 1 - offset), offset)
+                    writer.write(block)
+                    await writer.drain()
+                    offset += len(block)
+        await writer.drain()
+
+    def entries(self):
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if name.endswith(('.blocks', '.tmp')):
+                continue
+            try:
+                yield path, os.stat(path)
+            except FileNotFoundError:
+                pass
+
+    async def _evict(self):
+        """Removes the least recently used entries not in use until the cache fits in max_size.
+
+        Only called when the cache may not fit, since it scans the whole cache, which it does in a worker thread.
+        """
+        entries = await self._run(lambda: sorted(self.entries(), key=lambda entry: entry[1].st_mtime))
+        # Entries are sparse, so only what is on disk counts
+        size = sum(entry_stat.st_blocks * 512 for _, entry_stat in entries)
+        for path, entry_stat in entries:
+            if size <= self.max_size:
+                break
+            entry = self._entries.get(path)
+            if entry is not None and entry.users:
+                continue
+            logger.d(f"Evicting cache server entry {path}")
+            self._entries.pop(path, None)
+            # Removed right away, on the loop, so no client can open the entry between its eviction and its removal
+            remove_file(path, f'{path}.blocks')
+            size -= entry_stat.st_blocks * 512
+        self._size = size
+
+
+def _retrieve(future: asyncio.Future):
+    """Marks the exception of a future as retrieved, for futures whose waiters may all have gone away"""
+    if not future.cancelled():
+        future.exception()
+
+
+def _runs(blocks: List[int]) -> List[Tuple[int, int]]:
+    """Sorted blocks grouped into runs of adjacent ones, as (first, last)"""
+    runs = []
+    for block in blocks:
+        if runs and runs[-1][1] == block - 1:
+            runs[-1] = (runs[-1][0], block)
+        else:
+            runs.append((block, block))
+    return runs
@@ -1,17 +1,20 @@
 import asyncio
-import io
 import math
 import os
-from asyncio import Task, Event, BaseEventLoop, Future
+import threading
+from abc import ABC, abstractmethod
+from asyncio import Task, BaseEventLoop, Future
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
-from typing import Callable, Tuple
+from itertools import islice
+from typing import AsyncIterator, Callable, BinaryIO, Dict, Iterator, Optional, Union
 
-from modules import logger
+from modules import logger, config, tracing
 from modules.backports import to_thread_compat
+from modules.memorybudget import MemoryBudget
 from modules.progresslogger import Progress
-from modules.util import current_is_python36, create_dir, remove_dir, remove_file, copy_file_contents, python38, \
-    current_python_version
+from modules.util import create_dir, remove_dir, remove_file, append_file_contents, python38, current_python_version
 
 
 @dataclass
@@ -27,84 +30,121 @@ class ChunksDir:
         remove_dir(self.path)
 
 
-@dataclass
-class Chunk:
-    """A single chunk of a download."""
-    file_name: str
-    file_dir: str
-    number: int
-    start: int
-    end: int
-    executor: ThreadPoolExecutor
-    downloader: Callable[[int, int], bytes]
-    loop: BaseEventLoop = field(default_factory=asyncio.get_event_loop)
-    _task: Future = field(init=False)
-    # Must be init afterwards: 'got Future <Future pending> attached to a different loop'
-    _download_interrupted: Event = field(init=False)
-    _task_really_finished: Event = field(init=False)
+class Transfer(ABC):
+    """What the ways of downloading a file share: they are awaitable, report their progress through a queue that is
+    ended with None, and shut down their executor when done, unless it is shared."""
+    owns_executor = True
 
-    def __post_init__(self):
-        self._download_interrupted = Event(loop=self.loop)
-        self._task_really_finished = Event(loop=self.loop)
-        self._task = self.loop.run_in_executor(self.executor, self.download)
+    def __await__(self):
+        yield from self.await_it().__await__()
 
-    @staticmethod
-    def create_from(file_downloader: Callable[[int, int], bytes], file_name: str, file_dir: str, file_size: int,
-                    chunk_size: int, number: int, loop: BaseEventLoop, executor: ThreadPoolExecutor):
-        start = chunk_size * number
-        end = min(file_size - 1, start + chunk_size - 1)
-        return Chunk(file_name, file_dir, number, start, end, executor, file_downloader, loop)
+    @abstractmethod
+    async def await_it(self):
+        """Waits for the transfer to be done"""
 
-    @property
-    def file_name_with_number(self) -> str:
-        return f'{self.file_name}.{self.number}'
+    @abstractmethod
+    def cancel(self):
+        """Stops the transfer, leaving nothing incomplete behind"""
 
-    @property
-    def file_path(self) -> str:
-        return os.path.join(self.file_dir, self.file_name_with_number)
+    async def progresses(self) -> AsyncIterator[Progress]:
+        """Generator for progress."""
+        while True:
+            progress = await self._progresses.get()
+            if progress is None:
+                break
+            yield progress
+
+    def _shutdown_executor(self, wait: bool = True):
+        if not self.owns_executor or self.executor is None:
+            return
+        if current_python_version() <= python38():
+            self.executor.shutdown(wait=wait)
+        else:
+            self.executor.shutdown(wait=wait, cancel_futures=True)
 
-    @property
-    def task(self) -> Future:
-        return self._task
 
-    @property
-    def interrupted(self):
-        return self._download_interrupted.is_set()
+async def transfer(chunks: Transfer) -> AsyncIterator[Progress]:
+    """Runs a transfer to the end, yielding its progress. If it fails, or stops being iterated, it is cancelled."""
+    try:
+        async for progress in chunks.progresses():
+            yield progress
+        await chunks.await_it()
+    except BaseException:
+        chunks.cancel()
+        raise
 
-    @property
-    def done(self):
-        return self._task.done()
+
+async def complete(chunks: Transfer):
+    """Runs a transfer to the end, when its progress is of no interest"""
+    async for _ in transfer(chunks):
+        pass
+
+
+def default_memory() -> MemoryBudget:
+    """A budget for a transfer on its own. Transfers running at the same time are given one budget to share instead."""
+    return MemoryBudget(config.DOWNLOAD_MAX_MEMORY)
+
+
+def reserve_memory(memory: MemoryBudget, size: int, interrupted: threading.Event):
+    """Block until the memory budget has room for size bytes, giving up if the download gets interrupted."""
+    while not memory.reserve(size, timeout=0.1):
+        if interrupted.is_set():
+            raise asyncio.CancelledError
+
+
+class Chunk:
+    """A single chunk of a download.
+
+    Chunks are only created when they are about to be downloaded, and only live while in flight, so they are kept
+    small: no dataclass fields, no events, just slots.
+    """
+    __slots__ = ('number', 'start', 'end', 'file_path', 'task')
+    TRACE_CATEGORY = 'chunk'
+
+    def __init__(self, number: int, start: int, end: int, file_path: str):
+        self.number = number
+        self.start = start
+        self.end = end
+        self.file_path = file_path
+        self.task: Optional[Future] = None
 
     @property
     def size(self):
         return self.end - self.start + 1
 
-    def __await__(self):
-        yield from self.await_it().__await__()
-
-    # Python 3.6
-    async def await_it(self):
-        await self._task
-        await self._task_really_finished.wait()
-        logger.d(f"Task {self.number} finished")
+    @property
+    def trace_id(self) -> str:
+        return self.file_path
 
-    def download(self) -> 'Chunk':
+    def download(self, downloader: Callable[[int, int, threading.Event], bytes], memory: MemoryBudget,
+                 interrupted: threading.Event) -> Optional['Chunk']:
+        """Downloads the chunk into its partial file. Returns None if interrupted."""
         logger.d(f"Started task for chunk #{self.number}...")
+        tracing.step('started', self.TRACE_CATEGORY, self.trace_id)
         try:
             # Cancelling the task returned by run_in_executor does not actually remove the task from the executor if
             # the argument 'cancel_futures=True' is not passed, and Python 3.6 does not support cancel_futures argument.
             # So, we check for interruption before actually doing any work.
-            if self.interrupted:
+            if interrupted.is_set():
                 raise asyncio.CancelledError
-            logger.d(f"Task for chunk #{self.number} not interrupted. Starting work...")
-            file_handler = io.BytesIO(self.downloader(self.start, self.end))
-            with open(self.file_path, 'wb') as f:
-                logger.d(f"Writing file handler buffer to file '{f.name}'")
-                # noinspection PyTypeChecker
-                f.write(file_handler.getbuffer())
+            logger.d(f"Task for chunk #{self.number} not interrupted. Waiting for memory...")
+            reserve_memory(memory, self.size, interrupted)
+            try:
+                logger.d(f"Task for chunk #{self.number} got memory. Starting work...")
+                # Interruptible: the download stops between two small blocks once interrupted is set
+                with tracing.current(self.trace_id), tracing.span(f'download chunk #{self.number}',
+                                                                  self.TRACE_CATEGORY, start=self.start, end=self.end):
+                    content = downloader(self.start, self.end, interrupted)
+                tracing.step('downloaded', self.TRACE_CATEGORY, self.trace_id)
+                with open(self.file_path, 'wb') as f, tracing.span(f'write chunk #{self.number}', self.TRACE_CATEGORY):
+                    logger.d(f"Writing downloaded content to file '{f.name}'")
+                    f.write(content)
+                del content  # Free it before giving the memory back
+            finally:
+                memory.release(self.size)
             logger.d(f"Task for chunk #{self.number} finished...")
             # Check again after the (blocking) work is done.
-            if self.interrupted:
+            if interrupted.is_set():
                 raise asyncio.CancelledError
             return self
         except asyncio.CancelledError:
@@ -115,118 +155,319 @@ class Chunk:
             logger.d(e)
             remove_file(self.file_path)
             raise
-        finally:
-            self._task_really_finished.set()
-
-    def cancel(self):
-        """Cancel the download work of this chunk.
-
-        Blocking tasks cannot be cancelled after started the way coroutines can, as coroutines cancel at their
-        suspension points and blocking tasks do not have such. The solution for gracefully cancelling blocking tasks
-        is setting a flag, and have the task clean up itself if the flag is set
-        """
-        logger.d(f"Cancelling task for chunk #{self.number}")
-        self._download_interrupted.set()
-        result = self._task.cancel()
-        logger.d(f"Cancellation of task {self._task} for chunk #{self.number} returned {result}")
 
 
 @dataclass
-class Chunks:
+class Chunks(Transfer):
+    """Downloads a file by chunks, in parallel, into partial files that are appended in order to the final file.
+
+    Chunks are generated lazily from the file ranges: only a window of chunks, starting from the lowest one not yet
+    appended, is in flight at a time. So the number of objects, pending futures and partial files stays the same, no
+    matter how large the file is.
+    """
     file_name: str
     file_size: int
     chunk_size: int
-    file_downloader: Callable[[int, int], bytes]
+    # Downloads a range: (start, end, interrupted) -> content, stopping quickly once interrupted is set
+    file_downloader: Callable[[int, int, threading.Event], bytes]
+    # Shared with every other transfer of the process, so together they stay within it
+    memory: MemoryBudget = field(default_factory=default_memory)
     loop: BaseEventLoop = field(default_factory=asyncio.get_event_loop)
-    executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=5)
-    chunks: Tuple[Chunk, ...] = field(init=False)
-    join_partial_files_task: Task = field(init=False)
+    executor: ThreadPoolExecutor = field(default_factory=lambda: ThreadPoolExecutor(config.DOWNLOAD_WORKERS))
+    # Whether the executor belongs to these chunks alone, and can be shut down when they are done
+    owns_executor: bool = True
+    window: int = config.DOWNLOAD_WINDOW
+    _join_buffer: bytearray = field(init=False)
+    work_task: Task = field(init=False)
+    _interrupted: threading.Event = field(init=False, default_factory=threading.Event)
+    _progresses: asyncio.Queue = field(init=False)
+    _received: int = field(init=False, default=0)
 
     def __post_init__(self):
-        async def write_files():
-            async def await_chunks():
-                for chunk in self.chunks:
-                    if current_is_python36():
-                        await chunk.await_it()
-                    else:
-                        await chunk
-
-            chunk_files = tuple(chunk.file_path for chunk in self.chunks)
-            with self.file_dir:  # Removes directory afterwards
+        # A chunk can never be bigger than the whole memory budget
+        self.chunk_size = min(self.chunk_size, self.memory.max_memory)
+        # Joins happen one at a time, so a single small buffer is enough for all of them
+        self._join_buffer = bytearray(min(self.chunk_size, config.DOWNLOAD_JOIN_BUFFER_SIZE))
+        self._progresses = asyncio.Queue()
+        self.work_task = self.loop.create_task(self._work())
+
+    async def await_it(self):
+        await self.work_task
+        logger.d("Chunks finished work, shutting down executor.")
+        self._shutdown_executor()
+
+    def __len__(self):
+        return Chunks.calculate_number_of_chunks(self.file_size, self.chunk_size)
+
+    def _chunks(self) -> Iterator[Chunk]:
+        """Generates the chunks lazily, from the file ranges"""
+        directory = self.file_dir.path
+        name = os.path.basename(self.file_name)
+        for number in range(len(self)):
+            start = self.chunk_size * number
+            end = min(self.file_size - 1, start + self.chunk_size - 1)
+            yield Chunk(number, start, end, os.path.join(directory, f'{name}.{number}'))
+
+    def _submit(self, chunk: Chunk):
+        logger.d(f"Submitting chunk #{chunk.number}")
+        tracing.begin(f'chunk #{chunk.number}', Chunk.TRACE_CATEGORY, chunk.trace_id, start=chunk.start, end=chunk.end)
+        chunk.task = self.loop.run_in_executor(self.executor, chunk.download, self.file_downloader, self.memory,
+                                               self._interrupted)
+        chunk.task.add_done_callback(lambda task: self._on_chunk_done(chunk, task))
+
+    def _on_chunk_done(self, chunk: Chunk, task: Future):
+        if task.cancelled() or task.exception() is not None or task.result() is None:
+            return
+        self._received += chunk.size
+        self._progresses.put_nowait(Progress(self._received, self.file_size))
+
+    async def _work(self):
+        in_flight = deque()
+        upcoming = self._chunks()
+        try:
+            with self.file_dir, open(self.file_name, 'wb') as final_file:  # Removes directory afterwards
                 try:
-                    await await_chunks()
-                    await to_thread_compat(copy_file_contents, self.file_name, *chunk_files)
-                finally:
-                    logger.d("Reached finally block, removing already downloaded partial files")
-                    await to_thread_compat(remove_file, *chunk_files)
+                    while True:
+                        # Keep the window full, starting from the lowest chunk that was not appended yet
+                        for chunk in islice(upcoming, self.window - len(in_flight)):
+                            self._submit(chunk)
+                            in_flight.append(chunk)
+                        if not in_flight:
+                            break
+                        chunk = in_flight[0]
+                        if await chunk.task is None:
+                            raise asyncio.CancelledError
+                        await to_thread_compat(self._append_partial_file, final_file, chunk)
+                        in_flight.popleft()
+                except BaseException:
+                    logger.d("Chunks work interrupted, removing partial files")
+                    self._interrupted.set()
+                    for chunk in in_flight:
+                        chunk.task.cancel()
+                    await to_thread_compat(remove_file, *(chunk.file_path for chunk in in_flight))
+                    raise
+        except BaseException:
+            # Do not leave an incomplete file behind
+            remove_file(self.file_name)
+            raise
+        finally:
+            await self._progresses.put(None)
 
-        def create_chunk(number):
-            return Chunk.create_from(self.file_downloader, self.file_name, self.file_dir.path, self.file_size,
-                                     self.chunk_size, number, self.loop, self.executor)
+    def _append_partial_file(self, final_file: BinaryIO, chunk: Chunk):
+        with tracing.span(f'join chunk #{chunk.number}', Chunk.TRACE_CATEGORY):
+            append_file_contents(final_file, chunk.file_path, buffer=self._join_buffer)
+        remove_file(chunk.file_path)
+        tracing.end(f'chunk #{chunk.number}', Chunk.TRACE_CATEGORY, chunk.trace_id)
 
-        number_of_chunks = Chunks.calculate_number_of_chunks(self.file_size, self.chunk_size)
-        self.chunks = tuple(map(create_chunk, range(number_of_chunks)))
-        self.join_partial_files_task = self.loop.create_task(write_files())
+    @property
+    def file_dir(self) -> ChunksDir:
+        directory, name = os.path.split(self.file_name)
+        return ChunksDir(os.path.join(directory, f'.{name}'))
 
-    def __await__(self):
-        yield from self.await_it().__await__()
+    def cancel(self):
+        print("Cleaning up...")
+        logger.d(f"Cancelling task for all chunks")
+        self._interrupted.set()
+        self.work_task.cancel()
+        self._shutdown_executor()
+        logger.d(f"Cancelled task for all chunks")
+
+    @staticmethod
+    def calculate_number_of_chunks(file_size, chunk_size):
+        return math.ceil(int(file_size) / chunk_size)
+
+
+@dataclass
+class SmallFile(Transfer):
+    """Downloads a small file with a single request, and writes it in one step.
+
+    Skips what makes Chunks worth it for big files, and costly for small ones: no temporary directory, no partial
+    files and no join. The content is written aside, and renamed to the final file, so it is either complete or absent.
+    Has the interface of Chunks, so it can take their place.
+    """
+    file_name: str
+    file_size: int
+    file_downloader: Callable[[int, int, threading.Event], bytes]
+    memory: MemoryBudget = field(default_factory=default_memory)
+    loop: BaseEventLoop = field(default_factory=asyncio.get_event_loop)
+    executor: Optional[ThreadPoolExecutor] = None  # The loop's default executor, if not given
+    owns_executor: bool = True
+    work_task: Task = field(init=False)
+    _interrupted: threading.Event = field(init=False, default_factory=threading.Event)
+    _progresses: asyncio.Queue = field(init=False)
+
+    def __post_init__(self):
+        self._progresses = asyncio.Queue()
+        self.work_task = self.loop.create_task(self._work())
 
     async def await_it(self):
-        await asyncio.gather(self.join_partial_files_task)
-        logger.d("Chunks finished work, shutting down executor.")
-        if current_python_version() <= python38():
-            self.executor.shutdown()
-        else:
-            self.executor.shutdown(cancel_futures=True)
+        await self.work_task
+        self._shutdown_executor()
 
     def __len__(self):
-        return len(self.chunks)
+        return 1
 
-    def __iter__(self):
-        yield from self.chunks
+    @property
+    def part_file_name(self) -> str:
+        directory, name = os.path.split(self.file_name)
+        return os.path.join(directory, f'.{name}.part')
 
-    def __getitem__(self, item):
-        return self.chunks[item]
+    def _download(self):
+        reserve_memory(self.memory, self.file_size, self._interrupted)
+        try:
+            with tracing.span('download small file', Chunk.TRACE_CATEGORY, size=self.file_size):
+                # Drive rejects a range of an empty file
+                content = self.file_downloader(0, self.file_size - 1, self._interrupted) if self.file_size else b''
+            if self._interrupted.is_set():
+                raise asyncio.CancelledError
+            with open(self.part_file_name, 'wb') as f, tracing.span('write small file', Chunk.TRACE_CATEGORY):
+                f.write(content)
+            del content  # Free it before giving the memory back
+        finally:
+            self.memory.release(self.file_size)
+        os.replace(self.part_file_name, self.file_name)
 
-    async def completed_chunks(self):
-        for chunk in asyncio.as_completed(self.chunk_tasks):
-            yield await chunk
+    async def _work(self):
+        try:
+            await self.loop.run_in_executor(self.executor, self._download)
+            await self._progresses.put(Progress(self.file_size, self.file_size))
+        except BaseException:
+            self._interrupted.set()
+            remove_file(self.part_file_name)
+            raise
+        finally:
+            await self._progresses.put(None)
 
-    async def progresses(self):
-        """Generator for progress."""
-        received = 0
-        async for chunk in self.completed_chunks():
-            received += chunk.size
-            yield Progress(received, self.file_size)
+    def cancel(self):
+        logger.d(f"Cancelling download of small file {self.file_name}")
+        self._interrupted.set()
+        self.work_task.cancel()
+        self._shutdown_executor(wait=False)
 
-    @property
-    def file_dir(self) -> ChunksDir:
-        return ChunksDir(f'.{self.file_name}')
 
-    @property
-    def chunk_tasks(self) -> Tuple[Future, ...]:
-        return tuple(chunk.task for chunk in self.chunks)
+def create_chunks(file_name: str, file_size: int, chunk_size: int,
+                  file_downloader: Callable[[int, int, threading.Event], bytes],
+                  memory: Optional[MemoryBudget] = None, **kwargs) -> Union[Chunks, SmallFile]:
+    """Chunks to download a file with, or a SmallFile, if it is small enough to take a single request"""
+    memory = memory or default_memory()
+    if file_size <= config.SMALL_FILE_SIZE:
+        kwargs.pop('window', None)
+        return SmallFile(file_name, file_size, file_downloader, memory, **kwargs)
+    return Chunks(file_name, file_size, chunk_size, file_downloader, memory, **kwargs)
 
-    @property
-    def all_tasks(self):
-        return (self.join_partial_files_task,) + self.chunk_tasks
+
+@dataclass
+class StreamedChunks(Transfer):
+    """Downloads chunks in parallel, but writes them strictly in order to a file-like object, like stdout.
+
+    Only a window of chunks is in flight at a time, starting from the lowest offset not yet written, so the reorder
+    buffer never holds more than window chunks. Chunks are submitted in offset order, so idle workers always pick the
+    lowest missing offset first, and the output is never starved by work on later offsets. Each chunk holds its size
+    of the memory budget from before it is downloaded until it is written.
+    """
+    file_size: int
+    chunk_size: int
+    file_downloader: Callable[[int, int, threading.Event], bytes]
+    output: BinaryIO
+    memory: MemoryBudget = field(default_factory=default_memory)
+    loop: BaseEventLoop = field(default_factory=asyncio.get_event_loop)
+    executor: ThreadPoolExecutor = field(default_factory=lambda: ThreadPoolExecutor(config.DOWNLOAD_WORKERS))
+    window: int = field(init=False)
+    _pending: Dict[int, Future] = field(init=False, default_factory=dict)
+    _interrupted: threading.Event = field(init=False, default_factory=threading.Event)
+    _unwritten: Dict[int, int] = field(init=False, default_factory=dict)  # Chunk number -> its memory, until written
+    _unwritten_lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+    _progresses: asyncio.Queue = field(init=False)
+    write_task: Task = field(init=False)
+
+    def __post_init__(self):
+        self.chunk_size = min(self.chunk_size, self.memory.max_memory)
+        self.window = max(1, self.memory.max_memory // self.chunk_size)
+        self._progresses = asyncio.Queue()
+        self.write_task = self.loop.create_task(self._write_in_order())
+
+    async def await_it(self):
+        await self.write_task
+        logger.d("Streamed chunks finished work, shutting down executor.")
+        self._shutdown_executor()
 
     @property
-    def all_tasks_are_done(self) -> bool:
-        return all(map(lambda task: task.done(), self.all_tasks))
+    def number_of_chunks(self) -> int:
+        return Chunks.calculate_number_of_chunks(self.file_size, self.chunk_size)
+
+    def _submit(self, number: int):
+        start = self.chunk_size * number
+        end = min(self.file_size - 1, start + self.chunk_size - 1)
+        logger.d(f"Submitting streamed chunk #{number}")
+        tracing.begin(f'chunk #{number}', Chunk.TRACE_CATEGORY, self._trace_id(number), start=start, end=end)
+        self._pending[number] = self.loop.run_in_executor(self.executor, self._download, number, start, end)
+
+    def _trace_id(self, number: int) -> str:
+        return f'{id(self)}#{number}'
+
+    def _download(self, number: int, start: int, end: int) -> bytes:
+        reserve_memory(self.memory, end - start + 1, self._interrupted)
+        with self._unwritten_lock:
+            if self._interrupted.is_set():
+                self.memory.release(end - start + 1)
+                raise asyncio.CancelledError
+            self._unwritten[number] = end - start + 1
+        try:
+            with tracing.current(self._trace_id(number)):
+                return self.file_downloader(start, end, self._interrupted)
+        except BaseException:
+            self._release(number)
+            raise
+
+    def _write(self, number: int, content: bytes):
+        tracing.step('downloaded', Chunk.TRACE_CATEGORY, self._trace_id(number))
+        try:
+            with tracing.span(f'write chunk #{number}', Chunk.TRACE_CATEGORY, size=len(content)):
+                self.output.write(content)
+                self.output.flush()
+        finally:
+            self._release(number)
+        tracing.end(f'chunk #{number}', Chunk.TRACE_CATEGORY, self._trace_id(number))
+
+    def _release(self, number: int):
+        with self._unwritten_lock:
+            size = self._unwritten.pop(number, None)
+        if size is not None:
+            self.memory.release(size)
+
+    def _interrupt(self):
+        """Stops the downloads, and gives back the memory of the chunks that will never be written, even those whose
+        download is still finishing, since the budget may be shared with other transfers that go on"""
+        with self._unwritten_lock:
+            self._interrupted.set()
+            unwritten, self._unwritten = self._unwritten, {}
+        if unwritten:
+            self.memory.release(sum(unwritten.values()))
+
+    async def _write_in_order(self):
+        next_to_submit = 0
+        written = 0
+        try:
+            for number in range(self.number_of_chunks):
+                # Keep the window full, starting from the lowest offset that is missing
+                while next_to_submit < self.number_of_chunks and next_to_submit < number + self.window:
+                    self._submit(next_to_submit)
+                    next_to_submit += 1
+                content = await self._pending.pop(number)
+                await to_thread_compat(self._write, number, content)
+                written += len(content)
+                await self._progresses.put(Progress(written, self.file_size))
+        except BaseException:
+            self._interrupt()
+            raise
+        finally:
+            await self._progresses.put(None)
 
     def cancel(self):
         print("Cleaning up...")
-        logger.d(f"Cancelling task for all chunks")
-        for chunk in self.chunks:
-            chunk.cancel()
-        self.join_partial_files_task.cancel()
-        if current_python_version() <= python38():
-            self.executor.shutdown()
-        else:
-            self.executor.shutdown(cancel_futures=True)
-        logger.d(f"Cancelled task for all chunks")
-
-    @staticmethod
-    def calculate_number_of_chunks(file_size, chunk_size):
-        return math.ceil(int(file_size) / chunk_size)
+        logger.d(f"Cancelling streamed chunks")
+        self._interrupt()
+        for task in self._pending.values():
+            task.cancel()
+        self.write_task.cancel()
+        self._shutdown_executor(wait=False)
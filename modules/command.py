@@ -1,11 +1,30 @@
+import asyncio
+import json
+import os
+import shutil
+import sys
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout, ExitStack
+from typing import Optional, Union
 
-from modules import extractor, logger, config
-from modules.chunks import Chunks
-from modules.googleservice import GoogleService
+from modules import logger, config, agent, cacheserver, compression, batch, mirror, tracing, \
+    http2 as http2_transport
+from modules.agent import AgentClient
+from modules.archive import Archive, ArchiveError
+from modules.backports import to_thread_compat
+from modules.chunks import Chunks, SmallFile, StreamedChunks
+from modules.downloadcache import DownloadCache
+from modules.drivefile import DriveFile
+from modules.googleservice import GoogleService, DriveQuery, DESCRIPTION_FIELDS, DOWNLOAD_FIELDS, looks_like_file_id
+from modules.memorybudget import MemoryBudget
+from modules.prefetch import RangePrefetch
+from modules.watcher import DirectoryWatcher
+from modules.processchunks import ProcessChunks
 from modules.progresslogger import ProgressLogger, Progress
 from modules.util import current_is_python36, find_last_modified_file, guess_mimetype, move_cursor_up, \
-    delete_lines, for_lines, files_descriptions, print_files_descriptions, describe_files
+    delete_lines, for_lines, files_descriptions, print_files_descriptions, describe_files, from_human_readable, \
+    positive_int, positive_size, prefetched, remove_file, to_human_readable
 
 
 class Command:
@@ -15,7 +34,15 @@ class Command:
 
     def __init__(self, args):
         self.args = args
-        self.google = GoogleService()
+        # A command runs alone in its process, so all of its transfers share this budget, and together stay within
+        # --max-memory
+        self.memory = MemoryBudget(args.max_memory)
+        # When an agent is running, queries and transfers go through it instead of a GoogleService of our own
+        self.agent = None if args.no_agent else AgentClient.connect_if_running()
+        if self.agent:
+            self.google = self.agent
+        else:
+            self.google = self._create_service()
 
     @staticmethod
     def add_to_subparser(subparsers):
@@ -28,14 +55,113 @@ class Command:
     def is_service_started(self) -> bool:
         return self.google.is_valid()
 
+    @staticmethod
+    def _add_query_arguments(parser):
+        """Adds the search filters, which are applied by Google Drive itself"""
+        parser.add_argument(
+            '--mime',
+            metavar='TYPE',
+            help="Only files with this MIME type, e.g. application/zip"
+        )
+        parser.add_argument(
+            '--larger-than',
+            metavar='SIZE',
+            type=from_human_readable,
+            help="Only files larger than SIZE, e.g. 100M"
+        )
+        parser.add_argument(
+            '--modified-after',
+            metavar='DATE',
+            help="Only files modified after DATE, as YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS (UTC)"
+        )
+        parser.add_argument(
+            '--in-folder',
+            metavar='FOLDER_ID',
+            help="Only files directly inside the folder with this ID"
+        )
+        trashed = parser.add_mutually_exclusive_group()
+        trashed.add_argument(
+            '--trashed',
+            help="Only files in the trash",
+            action='store_const',
+            const=True
+        )
+        trashed.add_argument(
+            '--not-trashed',
+            help="Only files not in the trash",
+            action='store_const',
+            const=False,
+            dest='trashed'
+        )
+
+    def query(self, name=None):
+        return DriveQuery(
+            name=name,
+            mime_type=self.args.mime,
+            larger_than=self.args.larger_than,
+            modified_after=self.args.modified_after,
+            in_folder=self.args.in_folder,
+            trashed=self.args.trashed
+        )
+
+    def _use_own_service(self):
+        """For work that cannot go through the agent, like stdin and stdout streams, use a service of our own"""
+        if self.agent:
+            self.google = self._create_service()
+
+    def _create_service(self) -> GoogleService:
+        http2 = self.args.http2
+        if http2 and not http2_transport.is_available():
+            print("HTTP/2 needs httpx and h2 (pip install ggdrive[http2]), using HTTP/1.1 instead.")
+            http2 = False
+        return GoogleService(http2=http2, cache_server=self.args.cache_server, concurrency=self._concurrency())
+
+    def _concurrency(self) -> Optional[int]:
+        """Requests in flight the command asks for, to start the service's governor at, or None for the default"""
+        return None
+
+    async def find_file(self, file, fields=DESCRIPTION_FIELDS):
+        """The file with FILE as ID or, if there is none, the last modified one with FILE in its name"""
+        metadata = None
+        if looks_like_file_id(file):
+            metadata = await to_thread_compat(self.google.get_file_metadata, file, fields)
+        return metadata or await to_thread_compat(self.google.find_first, DriveQuery(name=file), fields)
+
+    def open_drive_file(self, metadata) -> DriveFile:
+        """A file object reading the file described by metadata from Google Drive, only the parts that are read"""
+        self._use_own_service()
+        return DriveFile(self.google.get_file_downloader(metadata), int(metadata['size']))
+
+    @staticmethod
+    async def _conclude_agent_job_while_logging(stream, title: str):
+        """Logs the progress streamed by an agent job, and returns its result"""
+        try:
+            with ProgressLogger(title) as progress_logger:
+                async for message in stream:
+                    if isinstance(message, Progress):
+                        await progress_logger.send(message)
+                    else:
+                        return message['result']
+        except BaseException as e:
+            print('\x1b[2K', end='\r')
+            logger.d(f'An error happened while running operation {title} on the agent')
+            logger.d(e)
+            raise
+
 
 class Download(Command):
     TYPE = "download"
     HELP = "Download a file from Google Drive through ID or Filename."
+    STDOUT = '-'
 
     def __init__(self, args):
         super().__init__(args)
         self.file = " ".join(self.args.file)
+        self.output = None
+        self.prefetch: Optional[RangePrefetch] = None
+
+    def _concurrency(self) -> Optional[int]:
+        return self.args.workers
 
     @staticmethod
     def add_to_subparser(subparsers):
@@ -75,8 +201,67 @@ class Download(Command):
             help='Tries to extract the downloaded file',
             action='store_true'
         )
+        parser.add_argument(
+            '-o',
+            '--output',
+            metavar='PATH',
+            help=f"Where to save the file (defaults to its name on Drive). Use '{Download.STDOUT}' to write it to "
+                 f"stdout, for piping into other programs"
+        )
+        parser.add_argument(
+            '-c',
+            '--cache',
+            help="Uses the local download cache: files already downloaded with the same checksum are linked or copied "
+                 "from it instead of downloaded, and new downloads are added to it",
+            action='store_true'
+        )
+        parser.add_argument(
+            '-p',
+            '--processes',
+            metavar='N',
+            type=int,
+            default=0,
+            help="Downloads with N worker processes instead of threads, for very fast links (Python 3.7+)"
+        )
+        parser.add_argument(
+            '-w',
+            '--workers',
+            metavar='N',
+            type=positive_int,
+            default=config.DOWNLOAD_WORKERS,
+            help="Threads downloading chunks at the same time (default: %(default)s). More than --max-memory can "
+                 "hold chunks of, wait for memory"
+        )
+        parser.add_argument(
+            '-m',
+            '--member',
+            metavar='NAME',
+            help="Downloads only the file NAME from a zip or tar archive, reading only the parts of the archive it "
+                 "needs. Saved as its base name, unless --output is given"
+        )
+        Command._add_query_arguments(parser)
+
+    @property
+    def is_streaming(self) -> bool:
+        return self.args.output == self.STDOUT
+
+    @property
+    def uses_processes(self) -> bool:
+        return self.args.processes > 0 and not self.is_streaming and not current_is_python36()
+
+    def output_path(self, metadata) -> str:
+        return self.args.output or metadata['name']
 
     async def execute(self):
+        if self.is_streaming:
+            # The file content owns stdout, so everything we would print goes to stderr
+            self.output = sys.stdout.buffer
+            with redirect_stdout(sys.stderr):
+                await self._execute()
+        else:
+            await self._execute()
+
+    async def _execute(self):
         extract = self.args.extract
         if self.args.last:
             await self.download_last_uploaded_file(extract)
@@ -91,52 +276,153 @@ class Download(Command):
             await self.try_download_id_then_name(extract)
 
     async def download_last_uploaded_file(self, extract):
-        last_file = self.google.get_last_modified_file()
+        last_file = self.google.get_last_modified_file(self.query(), DOWNLOAD_FIELDS)
         if not last_file:
             print("Could not find any file")
             return
         await self.download_from_metadata(last_file, extract)
 
     async def download_filename(self, extract):
-        file_found, _ = self.google.search_filename(self.file)
+        file_found = self.google.find_first(self.query(self.file), DOWNLOAD_FIELDS)
         if not file_found:
             print("Could not find any file that contains '%s' on the name" % self.file)
             return
         await self.download_from_metadata(file_found, extract)
 
     async def download_id(self, extract):
-        file_found = self.google.get_file_metadata(self.file)
+        self.prefetch_first_range()
+        file_found = await to_thread_compat(self.google.get_file_metadata, self.file, DOWNLOAD_FIELDS)
         if not file_found:
             print("Could not find file with '%s' as ID" % self.file)
             return
         await self.download_from_metadata(file_found, extract)
 
     async def try_download_id_then_name(self, extract):
-        file_id_found = self.google.get_file_metadata(self.file)
-        if file_id_found:
-            await self.download_from_metadata(file_id_found, extract)
-        else:
+        """Looks FILE up as an ID and searches it as a name at the same time. The ID wins, if it is one."""
+        if not looks_like_file_id(self.file):
             await self.download_filename(extract)
+            return
+        self.prefetch_first_range()
+        id_lookup = asyncio.ensure_future(to_thread_compat(self.google.get_file_metadata, self.file, DOWNLOAD_FIELDS))
+        name_search = asyncio.ensure_future(to_thread_compat(self.google.find_first, self.query(self.file),
+                                                             DOWNLOAD_FIELDS))
+        try:
+            file_found = await id_lookup
+            if file_found:
+                logger.d(f"'{self.file}' is a file ID, dropping the search by name")
+                name_search.cancel()
+            else:
+                self.discard_prefetch()
+                file_found = await name_search
+        except BaseException:
+            name_search.cancel()
+            self.discard_prefetch()
+            raise
+        if not file_found:
+            print("Could not find any file with '%s' as ID or on the name" % self.file)
+            return
+        await self.download_from_metadata(file_found, extract)
+
+    def prefetch_first_range(self):
+        """Requests the first chunk of FILE, taken as an ID, while its metadata is still on the way"""
+        if self.agent or self.uses_processes or self.uses_cache or self.args.member or self.args.cache_server:
+            # The agent and worker processes download with services of their own, cache hits download nothing,
+            # archive members are read from wherever they are in the archive and a cache server needs the checksum
+            return
+        # The size of the first chunk, which Chunks and StreamedChunks clip to the memory budget
+        self.prefetch = RangePrefetch(self.google, self.file, min(config.DOWNLOAD_CHUNK_SIZE, self.args.max_memory))
+
+    def discard_prefetch(self):
+        if self.prefetch:
+            self.prefetch.discard()
+            self.prefetch = None
 
     async def download_from_metadata(self, metadata, extract):
         if metadata is None:
             print('Could not find file to download')
             return
-        file_name = metadata["name"] or "Unknown filename"
+        file_name = self.output_path(metadata) or "Unknown filename"
         describe_files(metadata)
+        if self.args.member:
+            await self.download_member(metadata)
+            return
         try:
             await self.download(metadata)
-            if extract:
-                extractor.extract(file_name)
+            if extract and self.is_streaming:
+                print("Cannot extract a file written to stdout")
+            elif extract:
+                from modules import extractor
+                with tracing.span('extract', 'extract', file=file_name):
+                    extractor.extract(file_name)
         except BaseException as e:
             logger.d("Failed downloading or extracting")
             logger.d(e)
             raise
+        finally:
+            self.discard_prefetch()
 
-    async def download(self, metadata):
+    async def download_member(self, metadata):
+        member = self.args.member
+        output_path = self.args.output or os.path.basename(member)
+        print(f"Downloading {member} from the archive {metadata['name']}")
+        try:
+            await to_thread_compat(self._download_member, metadata, member, output_path)
+        except ArchiveError as e:
+            print(e)
+            return
+        print("Download finished.")
+
+    def _download_member(self, metadata, member, output_path):
+        with self.open_drive_file(metadata) as drive_file, Archive(drive_file) as archive, archive.open(member) as src:
+            if self.is_streaming:
+                shutil.copyfileobj(src, self.output, config.DRIVE_FILE_BLOCK_SIZE)
+            else:
+                try:
+                    with open(output_path, 'wb') as dest:
+                        shutil.copyfileobj(src, dest, config.DRIVE_FILE_BLOCK_SIZE)
+                except BaseException:
+                    remove_file(output_path)
+                    raise
+            logger.d(f"Read member '{member}' with {drive_file.requests} requests")
+
+    def create_chunks(self, metadata) -> Union[Chunks, SmallFile, StreamedChunks, ProcessChunks]:
+        file_size = int(metadata["size"])
+        if self.uses_processes and file_size > config.SMALL_FILE_SIZE:
+            return ProcessChunks(self.output_path(metadata), file_size, config.DOWNLOAD_CHUNK_SIZE, metadata,
+                                 self.args.processes, cache_server=self.args.cache_server)
+        if self.args.processes > 0 and current_is_python36():
+            print("Downloading with processes requires Python 3.7 or greater, using threads instead.")
         file_downloader = self.google.get_file_downloader(metadata)
-        file_id, file_name, file_size = metadata["id"], metadata["name"], int(metadata["size"])
-        chunks = Chunks(file_name, file_size, config.DOWNLOAD_CHUNK_SIZE, file_downloader)
+        if self.prefetch and self.prefetch.file_id == metadata['id']:
+            file_downloader = self.prefetch.wrap(file_downloader)
+        if self.is_streaming:
+            return StreamedChunks(file_size, config.DOWNLOAD_CHUNK_SIZE, file_downloader, self.output,
+                                  self.memory, executor=ThreadPoolExecutor(max_workers=self.args.workers))
+        if file_size <= config.SMALL_FILE_SIZE:
+            return SmallFile(self.output_path(metadata), file_size, file_downloader, self.memory)
+        return Chunks(self.output_path(metadata), file_size, config.DOWNLOAD_CHUNK_SIZE, file_downloader,
+                      self.memory, executor=ThreadPoolExecutor(max_workers=self.args.workers),
+                      window=max(config.DOWNLOAD_WINDOW, self.args.workers))
+
+    @property
+    def uses_cache(self) -> bool:
+        return self.args.cache and not self.is_streaming
+
+    async def download(self, metadata):
+        cache = DownloadCache()
+        if self.uses_cache and cache.materialize(metadata, self.output_path(metadata)):
+            print(f"File {metadata['name']} found in the download cache.")
+            return
+        await self._download(metadata)
+        if self.uses_cache:
+            await to_thread_compat(cache.store, metadata, self.output_path(metadata))
+
+    async def _download(self, metadata):
+        if self.agent and not self.is_streaming and not self.uses_processes:
+            await self.download_through_agent(metadata)
+            return
+        self._use_own_service()
+        chunks = self.create_chunks(metadata)
         file_name = metadata['name']
         try:
             print(f"Downloading the file: {file_name}")
@@ -152,8 +438,24 @@ class Download(Command):
             chunks.cancel()
             raise
 
+    async def download_through_agent(self, metadata):
+        file_name = metadata['name']
+        file_path = os.path.abspath(self.output_path(metadata))
+        stream = self.agent.stream('download', metadata=metadata, file_path=file_path)
+        try:
+            print(f"Downloading the file: {file_name}")
+            print("Downloading 0%", end='\r')
+            await self._conclude_agent_job_while_logging(stream, "Downloading")
+            print('\x1b[2K', end='\r')
+            print("Download finished.")
+        except BaseException as err:
+            print(f'An error happened while downloading the file {file_name}.')
+            logger.d(err)
+            raise
+
     @staticmethod
-    async def _conclude_operation_while_logging(chunks: Chunks, title: str):
+    async def _conclude_operation_while_logging(chunks: Union[Chunks, SmallFile, StreamedChunks, ProcessChunks],
+                                                title: str):
         try:
             with ProgressLogger(title) as progress_logger:
                 async for progress in chunks.progresses():
@@ -186,6 +488,9 @@ class Download(Command):
 class Upload(Command):
     TYPE = "upload"
     HELP = "Upload a file to Google Drive. Accepts wildcards and can find the last modified file."
+    STDIN = '-'
+    STDIN_NAME = 'stdin'
+    STDIN_MIMETYPE = 'application/octet-stream'
 
     def __init__(self, args):
         super().__init__(args)
@@ -202,7 +507,8 @@ class Upload(Command):
             'file',
             metavar='FILE',
             nargs='+',
-            help="Path or filename of the file to be uploaded (accepts wildcards)"
+            help=f"Path or filename of the file to be uploaded (accepts wildcards). Use '{Upload.STDIN}' to upload "
+                 f"what is read from stdin"
         )
         parser.add_argument(
             '--last',
@@ -210,9 +516,32 @@ class Upload(Command):
             help="Uploads the last modified file if a wildcard is used",
             action='store_true'
         )
+        parser.add_argument(
+            '--name',
+            '-n',
+            help=f"Name of the file on Google Drive when uploading from stdin (default: {Upload.STDIN_NAME})",
+            default=Upload.STDIN_NAME
+        )
+        parser.add_argument(
+            '--compress',
+            '-c',
+            help="Compresses the file, or a directory as a tar, on the fly using all CPU cores while uploading",
+            choices=tuple(compression.METHODS)
+        )
+
+    @property
+    def is_streaming(self) -> bool:
+        return self.args.file == [self.STDIN]
 
     async def execute(self):
-        self.upload()
+        if self.args.compress:
+            await self.upload_compressed()
+        elif self.is_streaming:
+            await self.upload_stream()
+        elif self.agent:
+            await self.upload_through_agent()
+        else:
+            await self.upload()
 
     def get_filepath(self):
         files = self.args.file
@@ -222,31 +551,83 @@ class Upload(Command):
         else:
             return files[0]
 
-    @staticmethod
-    def _conclude_operation_while_logging(task, title):
+    async def _conclude_operation_while_logging(self, task, title):
         try:
             with ProgressLogger(title) as progress_logger:
                 result = None
                 while not result:
-                    status, result = task.next_chunk()
+                    status, result = await to_thread_compat(self.google.upload_chunk, task)
                     if status:
                         progress = Progress(status.resumable_progress, status.total_size)
-                        progress_logger.send(progress)
+                        await progress_logger.send(progress)
                 return result
         except BaseException as err:
             print('\x1b[2K', end='\r')
             print(f'An error happened while running operation {title}')
             logger.d(err)
 
-    def upload(self):
+    async def upload(self):
         try:
             filepath = self.get_filepath()
             mimetype = guess_mimetype(filepath)
             upload_task = self.google.upload(filepath, mimetype)
+            await self._conclude_upload(upload_task)
+        except BaseException as err:
+            print('An error occurred while uploading the file.')
+            logger.d(err)
+
+    async def upload_stream(self):
+        self._use_own_service()
+        try:
+            mimetype = guess_mimetype(self.args.name) or self.STDIN_MIMETYPE
+            upload_task = self.google.upload_stream(sys.stdin.buffer, self.args.name, mimetype)
+            await self._conclude_upload(upload_task)
+        except BaseException as err:
+            print('An error occurred while uploading from stdin.')
+            logger.d(err)
+
+    async def upload_compressed(self):
+        method = self.args.compress
+        if not compression.is_available(method):
+            print(f"Compression method '{method}' is not available. For zstd, install the 'zstandard' package.")
+            return
+        self._use_own_service()
+        try:
+            with ExitStack() as stack:
+                if self.is_streaming:
+                    name, source, is_dir = self.args.name, compression.file_source(sys.stdin.buffer), False
+                else:
+                    filepath = self.get_filepath()
+                    name, is_dir = os.path.basename(os.path.normpath(filepath)), os.path.isdir(filepath)
+                    if is_dir:
+                        source = compression.tar_source(filepath)
+                    else:
+                        source = compression.file_source(stack.enter_context(open(filepath, 'rb')))
+                name = compression.compressed_name(name, method, is_dir)
+                compressed = stack.enter_context(compression.ParallelCompressor(source, method))
+                upload_task = self.google.upload_stream(compressed, name, compression.compressed_mimetype(method))
+                await self._conclude_upload(upload_task)
+        except BaseException as err:
+            print('An error occurred while compressing and uploading the file.')
+            logger.d(err)
+
+    async def _conclude_upload(self, upload_task):
+        print("Uploading 0%", end='\r')
+        response = await self._conclude_operation_while_logging(upload_task, "Uploading")
+        if not response:
+            return
+        print('\x1b[2K', end='\r')
+        print("Upload finished.")
+        print('File ID: %s\n' % response.get('id'))
+
+    async def upload_through_agent(self):
+        try:
+            filepath = self.get_filepath()
+            mimetype = guess_mimetype(filepath)
+            stream = self.agent.stream('upload', file_path=os.path.abspath(filepath), mimetype=mimetype)
             print("Uploading 0%", end='\r')
-            response = self._conclude_operation_while_logging(upload_task, "Uploading")
-            if not response:
-                return
+            response = await self._conclude_agent_job_while_logging(stream, "Uploading")
+            print('\x1b[2K', end='\r')
             print("Upload finished.")
             print('File ID: %s\n' % response.get('id'))
         except BaseException as err:
@@ -258,6 +639,7 @@ class List(Command):
     TYPE = "list"
     HELP = "Browse all files or search on Google Drive."
     FILES_PER_PAGE = 5
+    MAX_FILES_PER_PAGE = 1000  # Maximum page size accepted by Google Drive
 
     @staticmethod
     def add_to_subparser(subparsers):
@@ -273,9 +655,31 @@ class List(Command):
             nargs='?',
             help="Name of the file to be searched (leave blank to see all files)"
         )
+        parser.add_argument(
+            '--all',
+            '-a',
+            help="Lists all results at once, without waiting for Enter between pages",
+            action='store_true'
+        )
+        parser.add_argument(
+            '--json',
+            help="Lists all results at once as JSON, one file per line",
+            action='store_true'
+        )
+        parser.add_argument(
+            '--fields',
+            help="Comma separated file fields to fetch and print with --json (default: the ones shown by list)",
+            type=lambda fields: tuple(field.strip() for field in fields.split(','))
+        )
+        Command._add_query_arguments(parser)
 
     async def execute(self):
-        self.list_files()
+        if self.args.json:
+            self.list_all_files_json()
+        elif self.args.all:
+            self.list_all_files()
+        else:
+            self.list_files()
 
     def list_files(self):
         num_printed_lines = 0
@@ -287,13 +691,371 @@ class List(Command):
                 break
             num_printed_lines = len(descs) + sum(map(len, descs)) + 2  # last 2 lines are input text + newline
 
-    def search(self):
-        yield from self.google.search_filename(self.args.file, self.FILES_PER_PAGE)
+    def list_all_files(self):
+        for files_found in self.search(self.MAX_FILES_PER_PAGE):
+            print_files_descriptions(*files_descriptions(*files_found))
+
+    def list_all_files_json(self):
+        for files_found in self.search(self.MAX_FILES_PER_PAGE, self.args.fields):
+            for metadata in files_found:
+                print(json.dumps(metadata))
+            sys.stdout.flush()
+
+    def search(self, page_size=FILES_PER_PAGE, fields=None):
+        """Pages through the search results, while the next pages are already being fetched in the background"""
+        pages = self.google.search(self.query(self.args.file), page_size, fields=fields or DESCRIPTION_FIELDS)
+        yield from prefetched(pages, config.LIST_PREFETCH_PAGES)
+
+
+class ListArchive(Command):
+    TYPE = "list-archive"
+    HELP = "List the files in a zip or tar archive on Google Drive, without downloading the whole archive."
+
+    @staticmethod
+    def add_to_subparser(subparsers):
+        parser = subparsers.add_parser(
+            ListArchive.TYPE,
+            help=ListArchive.HELP
+        )
+        parser.set_defaults(command=ListArchive)
+        parser.add_argument(
+            'file',
+            metavar='FILE',
+            nargs='+',
+            help="ID or name of the archive"
+        )
+        parser.add_argument(
+            '--json',
+            help="Lists the files as JSON, one file per line",
+            action='store_true'
+        )
+
+    async def execute(self):
+        file = " ".join(self.args.file)
+        metadata = await self.find_file(file, DOWNLOAD_FIELDS)
+        if metadata is None:
+            print("Could not find any file with '%s' as ID or on the name" % file)
+            return
+        try:
+            members = await to_thread_compat(self.members, metadata)
+        except ArchiveError as e:
+            print(f"{metadata['name']}: {e}")
+            return
+        for name, size in members:
+            if self.args.json:
+                print(json.dumps({'name': name, 'size': size}))
+            else:
+                print("{0:>10}  {1}".format(to_human_readable(float(size))[0], name))
+
+    def members(self, metadata):
+        with self.open_drive_file(metadata) as drive_file, Archive(drive_file) as archive:
+            members = archive.members()
+            logger.d(f"Listed {len(members)} members with {drive_file.requests} requests")
+            return members
+
+
+class Watch(Command):
+    TYPE = "watch"
+    HELP = "Watch a directory and upload the files created or changed in it, once they are done being written."
+
+    @staticmethod
+    def add_to_subparser(subparsers):
+        parser = subparsers.add_parser(
+            Watch.TYPE,
+            help=Watch.HELP
+        )
+        parser.set_defaults(command=Watch)
+        parser.add_argument(
+            'dir',
+            metavar='DIR',
+            help="Directory to watch, with its subdirectories"
+        )
+        parser.add_argument(
+            '--pattern',
+            metavar='GLOB',
+            help="Only upload files whose name matches GLOB, e.g. '*.zip'"
+        )
+        parser.add_argument(
+            '--debounce',
+            metavar='SECONDS',
+            type=float,
+            default=config.WATCH_DEBOUNCE,
+            help="Seconds without changes in DIR before the changed files are uploaded (default: %(default)s)"
+        )
+
+    async def execute(self):
+        if not os.path.isdir(self.args.dir):
+            print(f"{self.args.dir} is not a directory")
+            return
+        # Uploads run here, with a service of our own that stays warm between rounds
+        self._use_own_service()
+        watcher = DirectoryWatcher(self.args.dir, self.args.pattern, self.args.debounce)
+        print(f"Watching {self.args.dir} for changes. Press Ctrl+C to stop.")
+        async for files in watcher.rounds():
+            print(f"Uploading {len(files)} changed files")
+            await asyncio.gather(*map(self.upload_file, files))
+
+    async def upload_file(self, path):
+        try:
+            request = self.google.upload(path, guess_mimetype(path))
+            response = None
+            while not response:
+                # Each chunk is sent with the http of the worker thread sending it, since the uploads of a round
+                # run at the same time
+                _, response = await to_thread_compat(self.google.upload_chunk, request)
+        except Exception as e:
+            logger.stacktrace()
+            print(f"Could not upload {path}: {e}")
+            return
+        print(f"Uploaded {path} (ID: {response.get('id')})")
+
+
+class Mirror(Command):
+    TYPE = "mirror"
+    HELP = "Keep a local directory in sync with a Google Drive folder, downloading new and changed files."
+
+    @staticmethod
+    def add_to_subparser(subparsers):
+        parser = subparsers.add_parser(
+            Mirror.TYPE,
+            help=Mirror.HELP
+        )
+        parser.set_defaults(command=Mirror)
+        parser.add_argument(
+            'folder',
+            metavar='FOLDER',
+            help="ID of the Google Drive folder to mirror"
+        )
+        parser.add_argument(
+            'dest',
+            metavar='DEST',
+            help=f"Local directory to keep in sync. Its state is kept in DEST/{mirror.STATE_FILE}"
+        )
+        parser.add_argument(
+            '--once',
+            help="Syncs once and exits, instead of following the changes",
+            action='store_true'
+        )
+        parser.add_argument(
+            '--interval',
+            metavar='SECONDS',
+            type=float,
+            default=config.MIRROR_POLL_INTERVAL,
+            help="Seconds between checks for changes (default: %(default)s)"
+        )
+
+    async def execute(self):
+        # The agent has no jobs for the changes feed
+        self._use_own_service()
+        try:
+            folder_mirror = mirror.Mirror(self.google, self.args.folder, self.args.dest, self.memory)
+        except (OSError, ValueError, mirror.MirrorError) as e:
+            print(f"Could not read the mirror state: {e}")
+            return
+        if self.args.once:
+            try:
+                await folder_mirror.sync()
+            finally:
+                folder_mirror.close()
+            print("Mirror is in sync.")
+            return
+        print(f"Mirroring folder {self.args.folder} into {self.args.dest}. Press Ctrl+C to stop.")
+        await folder_mirror.run(self.args.interval)
+
+
+class Copy(Command):
+    TYPE = "copy"
+    HELP = "Copy files on Google Drive itself, without downloading and uploading them again."
+
+    @staticmethod
+    def add_to_subparser(subparsers):
+        parser = subparsers.add_parser(
+            Copy.TYPE,
+            help=Copy.HELP
+        )
+        parser.set_defaults(command=Copy)
+        parser.add_argument(
+            'src',
+            metavar='SRC',
+            nargs='*',
+            help="IDs or names of the files to copy. Without any, copies all the files matching the filters, "
+                 "e.g. --in-folder"
+        )
+        parser.add_argument(
+            '--to',
+            metavar='FOLDER',
+            help="ID of the folder to copy the files into (default: the folder of each file)"
+        )
+        parser.add_argument(
+            '--name',
+            metavar='NAME',
+            help="Name of the copy, when copying a single file (default: the name of the file)"
+        )
+        Command._add_query_arguments(parser)
+
+    async def execute(self):
+        self._use_own_service()
+        files = await self.sources()
+        if not files:
+            print("No files to copy")
+            return
+        if self.args.name and len(files) > 1:
+            print(f"--name can only be used when copying a single file, not {len(files)}")
+            return
+        print(f"Copying {len(files)} files")
+        results = await asyncio.gather(*map(self.copy, files))
+        print(f"Copied {results.count(True)} of {len(files)} files.")
+
+    async def sources(self):
+        if not self.args.src:
+            query = self.query()
+            if not query.compile() and query.is_server_side:
+                print("Give the files to copy, or filters to select them, so not all of your Drive is copied")
+                return []
+            pages = await to_thread_compat(list, self.google.search(self.query(), List.MAX_FILES_PER_PAGE))
+            return [metadata for files in pages for metadata in files]
+        files = await asyncio.gather(*map(self.find_file, self.args.src))
+        for src, metadata in zip(self.args.src, files):
+            if metadata is None:
+                print(f"Could not find any file with '{src}' as ID or on the name")
+        return [metadata for metadata in files if metadata is not None]
+
+    async def copy(self, metadata) -> bool:
+        try:
+            copied = await to_thread_compat(self.google.copy_file, metadata['id'], self.args.name, self.args.to)
+        except Exception as e:
+            logger.stacktrace()
+            print(f"Could not copy {metadata['name']}: {e}")
+            return False
+        print(f"[copied] {metadata['name']} -> {copied['name']} (ID: {copied['id']})")
+        return True
+
+
+class Batch(Command):
+    TYPE = "batch"
+    HELP = "Run the downloads and uploads listed in a JSON lines manifest, skipping the ones already done."
+
+    @staticmethod
+    def add_to_subparser(subparsers):
+        parser = subparsers.add_parser(
+            Batch.TYPE,
+            help=Batch.HELP
+        )
+        parser.set_defaults(command=Batch)
+        parser.add_argument(
+            'manifest',
+            metavar='JOBS',
+            help='File with one job per line, like {"op": "download", "file_id": "<id>", "output": "<path>"} or '
+                 '{"op": "upload", "path": "<path>"}'
+        )
+        parser.add_argument(
+            '--state',
+            metavar='PATH',
+            help="File where the state of each job is kept (default: JOBS.state)"
+        )
+        parser.add_argument(
+            '-j',
+            '--jobs',
+            metavar='N',
+            type=positive_int,
+            default=config.BATCH_CONCURRENT_JOBS,
+            help="How many jobs run at the same time (default: %(default)s)"
+        )
+
+    async def execute(self):
+        # Batched metadata lookups and range downloads need the service itself, which the agent does not expose
+        self._use_own_service()
+        try:
+            jobs = batch.read_jobs(self.args.manifest)
+        except (OSError, batch.BatchError) as e:
+            print(f"Could not read jobs: {e}")
+            return
+        queue = batch.BatchQueue(self.args.state or f'{self.args.manifest}.state')
+        runner = batch.Batch(self.google, queue, self.args.jobs, self.memory)
+        if not await runner.run(jobs):
+            print("Run the same command again to retry the failed jobs.")
+
+
+class Agent(Command):
+    TYPE = "agent"
+    HELP = "Run a background agent that keeps a warm Google Drive service for the other commands."
+
+    def __init__(self, args):
+        self.args = args
+        self.memory = MemoryBudget(args.max_memory)
+        self.agent = None
+        self.google = None
+
+    @staticmethod
+    def add_to_subparser(subparsers):
+        parser = subparsers.add_parser(
+            Agent.TYPE,
+            help=Agent.HELP
+        )
+        parser.set_defaults(command=Agent)
+
+    def is_service_started(self) -> bool:
+        return agent.is_supported()
+
+    async def execute(self):
+        try:
+            await agent.Agent(google=self._create_service(), memory=self.memory).serve()
+        except agent.AgentError as e:
+            print(f"Could not start the agent: {e}")
+
+
+class CacheServer(Command):
+    TYPE = "cache-server"
+    HELP = "Run a caching proxy for the downloads of the machines of a LAN, which use it with --cache-server."
+
+    def __init__(self, args):
+        self.args = args
+        self.agent = None
+        self.google = None
+
+    @staticmethod
+    def add_to_subparser(subparsers):
+        parser = subparsers.add_parser(
+            CacheServer.TYPE,
+            help=CacheServer.HELP
+        )
+        parser.set_defaults(command=CacheServer)
+        parser.add_argument(
+            '--bind',
+            metavar='ADDRESS',
+            default=config.CACHE_SERVER_BIND,
+            help="Address to listen on (default: %(default)s)"
+        )
+        parser.add_argument(
+            '--port',
+            type=int,
+            default=config.CACHE_SERVER_PORT,
+            help="Port to listen on (default: %(default)s)"
+        )
+        parser.add_argument(
+            '--path',
+            default=config.CACHE_SERVER_PATH,
+            help="Directory where files are cached (default: %(default)s)"
+        )
+        parser.add_argument(
+            '--max-size',
+            metavar='SIZE',
+            type=positive_size,
+            default=config.CACHE_SERVER_MAX_SIZE,
+            help="Size beyond which the least recently used files are evicted, e.g. 100G (default: %(default)s bytes)"
+        )
+
+    def is_service_started(self) -> bool:
+        # Files are fetched with the tokens of the clients, so the server needs no service of its own
+        return True
+
+    async def execute(self):
+        await cacheserver.CacheServer(self.args.path, self.args.max_size).serve(self.args.bind, self.args.port)
 
 
 class CommandParser:
     """Starts the Commands' parsers and executes a command if the arguments are valid"""
-    COMMANDS = [Download, Upload, List]
+    COMMANDS = [Download, Upload, List, ListArchive, Copy, Watch, Mirror, Batch, Agent, CacheServer]
     NAME = "gdrive"
     DESCRIPTION = "A script to interact with your Google Drive files"
 
@@ -302,6 +1064,43 @@ class CommandParser:
             prog=self.NAME,
             description=self.DESCRIPTION
         )
+        self.parser.add_argument(
+            '--max-memory',
+            metavar='SIZE',
+            type=positive_size,
+            default=config.DOWNLOAD_MAX_MEMORY,
+            help="Maximum memory used by in-flight transfer buffers, e.g. 256M (default: %(default)s bytes)"
+        )
+        self.parser.add_argument(
+            '--no-agent',
+            help="Do not use a running gdrive agent, even if there is one",
+            action='store_true'
+        )
+        self.parser.add_argument(
+            '--http2',
+            help="Multiplex all requests over a few HTTP/2 connections, instead of one HTTP/1.1 connection per request "
+                 "in flight. Needs httpx and h2",
+            action='store_true'
+        )
+        self.parser.add_argument(
+            '--cache-server',
+            metavar='URL',
+            help="Download files through a gdrive cache server, e.g. http://cache-host:8788, so machines sharing it "
+                 "download each file from Google Drive only once"
+        )
+        self.parser.add_argument(
+            '--profile',
+            metavar='PREFIX',
+            help="Sample the event loop and all worker threads while the command runs, writing PREFIX.pstats and "
+                 "PREFIX.collapsed (for flamegraphs). Use with --no-agent, to profile the transfer itself"
+        )
+        self.parser.add_argument(
+            '--trace-out',
+            metavar='FILE',
+            help="Record a timeline of metadata calls, chunk lifecycles, joins, extraction and progress renders, by "
+                 "thread and task, into FILE, in the trace event format of chrome://tracing and ui.perfetto.dev. Use "
+                 "with --no-agent, to trace the transfer itself"
+        )
         subparsers = self.parser.add_subparsers()
         for command in self.COMMANDS:
             command.add_to_subparser(subparsers)
@@ -0,0 +1,153 @@
+import gzip
+import importlib.util
+import io
+import os
+import queue
+import shutil
+import tarfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import Callable, BinaryIO, Optional
+
+from modules import logger, config
+
+
+def _compress_gzip(block: bytes) -> bytes:
+    # Each block becomes a gzip member of its own, and concatenated members are a valid gzip file (like pigz does)
+    return gzip.compress(block, compresslevel=6)
+
+
+def _compress_zstd(block: bytes) -> bytes:
+    # Same for zstd: concatenated frames are a valid zstd file
+    import zstandard
+    return zstandard.ZstdCompressor(level=3).compress(block)
+
+
+# Compression method: (compress function, file extension, mimetype)
+METHODS = {
+    'gzip': (_compress_gzip, '.gz', 'application/gzip'),
+    'zstd': (_compress_zstd, '.zst', 'application/zstd'),
+}
+
+
+def is_available(method: str) -> bool:
+    if method == 'zstd':
+        return importlib.util.find_spec('zstandard') is not None
+    return method in METHODS
+
+
+def compressed_name(name: str, method: str, is_dir: bool = False) -> str:
+    return f"{name}{'.tar' if is_dir else ''}{METHODS[method][1]}"
+
+
+def compressed_mimetype(method: str) -> str:
+    return METHODS[method][2]
+
+
+def tar_source(path: str) -> Callable[[BinaryIO], None]:
+    """A source writing path, a directory, as a tar stream, without any temporary archive"""
+
+    def write(fileobj: BinaryIO):
+        with tarfile.open(fileobj=fileobj, mode='w|') as tar:
+            tar.add(path, arcname=os.path.basename(os.path.normpath(path)))
+
+    return write
+
+
+def file_source(fileobj_in: BinaryIO) -> Callable[[BinaryIO], None]:
+    """A source writing the contents of a readable file-like object, like stdin"""
+
+    def write(fileobj: BinaryIO):
+        shutil.copyfileobj(fileobj_in, fileobj, config.COMPRESSION_BLOCK_SIZE)
+
+    return write
+
+
+class _BlockWriter(io.RawIOBase):
+    """Splits what is written to it into blocks, handed to on_block as soon as each one is full"""
+
+    def __init__(self, block_size: int, on_block: Callable[[bytes], None]):
+        super().__init__()
+        self._block_size = block_size
+        self._on_block = on_block
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._buffer += b
+        while len(self._buffer) >= self._block_size:
+            self._on_block(bytes(self._buffer[:self._block_size]))
+            del self._buffer[:self._block_size]
+        return len(b)
+
+    def flush_last_block(self):
+        if self._buffer:
+            self._on_block(bytes(self._buffer))
+            self._buffer = bytearray()
+
+
+class ParallelCompressor(io.RawIOBase):
+    """A readable stream with the compressed output of a source, compressed by blocks across a process pool.
+
+    A thread runs the source, which writes into fixed size blocks. Each block is compressed independently in a worker
+    process, and the compressed blocks are read back in order. Only a bounded number of blocks is in flight, so a slow
+    reader, like an upload, holds back the source instead of growing memory.
+    """
+
+    _END = None
+
+    def __init__(self, source: Callable[[BinaryIO], None], method: str, workers: Optional[int] = None,
+                 block_size: int = config.COMPRESSION_BLOCK_SIZE):
+        super().__init__()
+        self._compress = METHODS[method][0]
+        workers = workers or os.cpu_count() or 1
+        self._executor = ProcessPoolExecutor(max_workers=workers)
+        self._compressed = queue.Queue(maxsize=workers * 2)
+        self._current = memoryview(b'')
+        self._error = None
+        self._finished = False
+        self._producer = threading.Thread(target=self._produce, args=(source, block_size), daemon=True)
+        self._producer.start()
+
+    def _produce(self, source: Callable[[BinaryIO], None], block_size: int):
+        try:
+            writer = _BlockWriter(block_size, self._submit)
+            source(writer)
+            writer.flush_last_block()
+        except BaseException as e:
+            logger.d("Failed producing blocks to compress", e)
+            self._error = e
+        finally:
+            self._compressed.put(self._END)
+
+    def _submit(self, block: bytes):
+        # Blocks while too many blocks are in flight
+        self._compressed.put(self._executor.submit(self._compress, block))
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._current and not self._finished:
+            self._next_block()
+        read = min(len(b), len(self._current))
+        b[:read] = self._current[:read]
+        self._current = self._current[read:]
+        return read
+
+    def _next_block(self):
+        future: Future = self._compressed.get()
+        if future is self._END:
+            self._finished = True
+            self._executor.shutdown()
+            if self._error is not None:
+                raise self._error
+            return
+        self._current = memoryview(future.result())
+
+    def close(self):
+        if not self._finished:
+            self._executor.shutdown(wait=False)
+        super().close()
@@ -5,5 +5,49 @@ GDRIVE_PATH = join(HOME, '.gdrive')
 CREDENTIALS_PATH = join(GDRIVE_PATH, 'credentials.json')
 TOKEN_PATH = join(GDRIVE_PATH, 'token.pickle')
 EXTRACTOR_CONFIG_FILE = join(GDRIVE_PATH, 'data_config.json')
+DISCOVERY_CACHE_PATH = join(GDRIVE_PATH, 'drive-v3-discovery.json')
+AGENT_SOCKET_PATH = join(GDRIVE_PATH, 'agent.sock')
+CACHE_SERVER_PATH = join(GDRIVE_PATH, 'cache-server')
+DISCOVERY_CACHE_MAX_AGE = 60 * 60 * 24 * 7  # 1 week
 UPLOAD_CHUNK_SIZE = 1024 * 1024 * 10  # 10MB
 DOWNLOAD_CHUNK_SIZE = 1024 * 1024 * 10  # 10MB
+COMPRESSION_BLOCK_SIZE = 1024 * 1024 * 4  # 4MB
+DOWNLOAD_MAX_MEMORY = 1024 * 1024 * 100  # 100MB
+DOWNLOAD_WINDOW = 16  # Chunks in flight at a time
+DOWNLOAD_JOIN_BUFFER_SIZE = 1024 * 1024  # 1MB, partial files are appended to the final file through it
+DOWNLOAD_WORKERS = 5  # Threads downloading chunks
+SMALL_FILE_SIZE = 1024 * 1024  # 1MB, files up to this size are downloaded with a single request
+DOWNLOAD_READ_BLOCK_SIZE = 1024 * 64  # 64KB, read at a time, so downloads can be interrupted between blocks
+DOWNLOAD_READ_TIMEOUT = (30, 60)  # seconds, to connect and between blocks
+DOWNLOAD_CACHE_PATH = join(GDRIVE_PATH, 'cache')
+DOWNLOAD_CACHE_MAX_SIZE = 1024 * 1024 * 1024 * 5  # 5GB
+LIST_PREFETCH_PAGES = 2
+DRIVE_FILE_BLOCK_SIZE = 1024 * 256  # 256KB
+DRIVE_FILE_CACHE_SIZE = 1024 * 1024 * 32  # 32MB
+DRIVE_FILE_MAX_READAHEAD = 1024 * 1024 * 8  # 8MB
+GOVERNOR_INITIAL_CONCURRENCY = 8  # Requests in flight
+GOVERNOR_MIN_CONCURRENCY = 1
+GOVERNOR_MAX_CONCURRENCY = 64
+GOVERNOR_DEFAULT_BACKOFF = 1  # seconds, when Drive does not send Retry-After
+GOVERNOR_MAX_RETRIES = 8
+BATCH_WORKERS = 8
+METADATA_BATCH_SIZE = 100  # Metadata lookups sent in one batch request, the most Drive takes
+BATCH_CONCURRENT_JOBS = 4
+AGENT_WORKERS = 8
+AGENT_METADATA_TTL = 60  # seconds
+AGENT_METADATA_CACHE_SIZE = 10000  # Files whose metadata the agent keeps
+WATCH_DEBOUNCE = 2  # seconds without changes before changed files are uploaded
+WATCH_MAX_DELAY = 30  # seconds, for files left alone while others keep changing
+WATCH_POLL_INTERVAL = 2  # seconds, where inotify is not available
+MIRROR_POLL_INTERVAL = 10  # seconds between listings of the changes feed
+MIRROR_CONCURRENT_DOWNLOADS = 4
+HTTP2_MAX_CONNECTIONS = 2  # Each one carries many concurrent streams
+HTTP2_TIMEOUT = 60  # seconds
+PROFILE_INTERVAL = 0.005  # seconds between profiling samples
+DRIVE_MEDIA_URI = 'https://www.googleapis.com/drive/v3/files/{}?alt=media'
+DRIVE_METADATA_URI = 'https://www.googleapis.com/drive/v3/files/{}?fields=md5Checksum,size&supportsAllDrives=true'
+CACHE_SERVER_BIND = '0.0.0.0'
+CACHE_SERVER_PORT = 8788
+CACHE_SERVER_MAX_SIZE = 1024 * 1024 * 1024 * 50  # 50GB
+CACHE_SERVER_BLOCK_SIZE = 1024 * 1024  # 1MB, the unit in which media is fetched from Drive and cached
+CACHE_SERVER_WORKERS = 16  # Threads fetching from Drive and reading from disk
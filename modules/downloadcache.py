@@ -0,0 +1,119 @@
+import os
+import shutil
+import stat
+from typing import Optional
+
+from modules import config, logger
+from modules.util import create_dir, remove_file
+
+# ioctl to clone a file's extents on Linux filesystems supporting it, like Btrfs and XFS: a copy-on-write copy
+_FICLONE = 0x40049409
+
+
+def _reflink(src: str, dest: str):
+    import fcntl
+    with open(src, 'rb') as src_file, open(dest, 'wb') as dest_file:
+        fcntl.ioctl(dest_file.fileno(), _FICLONE, src_file.fileno())
+
+
+def link_or_copy(src: str, dest: str, hardlink: bool = True) -> str:
+    """Makes dest have the contents of src as cheaply as possible: a reflink, else a hardlink, else a copy.
+
+    Returns how it was done.
+    """
+    remove_file(dest)
+    try:
+        _reflink(src, dest)
+        return 'reflink'
+    except (ImportError, OSError) as e:
+        logger.d(f"Could not reflink '{src}' to '{dest}'", e)
+        remove_file(dest)
+    try:
+        if hardlink:
+            os.link(src, dest)
+            return 'hardlink'
+    except OSError as e:
+        logger.d(f"Could not hardlink '{src}' to '{dest}'", e)
+    shutil.copyfile(src, dest)
+    return 'copy'
+
+
+class DownloadCache:
+    """A local, size-bounded cache of downloaded files, keyed by their content checksum.
+
+    Entries are read-only, since cache hits may be hardlinked to them. Every hit refreshes the modification time
+    of its entry, and when the cache grows beyond max_size, the least recently used entries are evicted.
+    Files without an md5Checksum, like Google Docs, are never cached.
+    """
+
+    def __init__(self, path=config.DOWNLOAD_CACHE_PATH, max_size=config.DOWNLOAD_CACHE_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+    @staticmethod
+    def is_cacheable(metadata) -> bool:
+        return bool(metadata.get('md5Checksum')) and 'size' in metadata
+
+    def entry_path(self, metadata) -> str:
+        checksum = metadata['md5Checksum']
+        return os.path.join(self.path, checksum[:2], checksum)
+
+    def find(self, metadata) -> Optional[str]:
+        if not self.is_cacheable(metadata):
+            return None
+        entry = self.entry_path(metadata)
+        try:
+            if os.stat(entry).st_size != int(metadata['size']):
+                logger.d(f"Cache entry {entry} has an unexpected size, ignoring it")
+                return None
+        except FileNotFoundError:
+            return None
+        os.utime(entry)
+        return entry
+
+    def materialize(self, metadata, dest: str) -> bool:
+        """Puts the cached contents of the file described by metadata at dest. Returns False if it is not cached."""
+        entry = self.find(metadata)
+        if entry is None:
+            return False
+        how = link_or_copy(entry, dest)
+        logger.d(f"Materialized cache entry {entry} at '{dest}' through a {how}")
+        return True
+
+    def store(self, metadata, src: str):
+        if not self.is_cacheable(metadata):
+            return
+        entry = self.entry_path(metadata)
+        create_dir(self.path, os.path.dirname(entry))
+        tmp_entry = f'{entry}.tmp'
+        try:
+            # Never a hardlink: making the entry read-only would make the downloaded file read-only too
+            how = link_or_copy(src, tmp_entry, hardlink=False)
+            os.chmod(tmp_entry, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.replace(tmp_entry, entry)
+            logger.d(f"Stored '{src}' in cache entry {entry} through a {how}")
+        except OSError as e:
+            logger.d(f"Could not store '{src}' in the cache", e)
+            remove_file(tmp_entry)
+            return
+        self.evict()
+
+    def entries(self):
+        for directory, _, files in os.walk(self.path):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    yield path, os.stat(path)
+                except FileNotFoundError:
+                    pass
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in max_size"""
+        entries = sorted(self.entries(), key=lambda entry: entry[1].st_mtime)
+        size = sum(entry_stat.st_size for _, entry_stat in entries)
+        for path, entry_stat in entries:
+            if size <= self.max_size:
+                break
+            logger.d(f"Evicting cache entry {path}")
+            remove_file(path)
+            size -= entry_stat.st_size
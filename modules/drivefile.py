@@ -0,0 +1,118 @@
+import io
+import os
+from collections import OrderedDict
+from typing import Callable, List, Tuple
+
+from modules import config, logger
+
+
+class DriveFile(io.RawIOBase):
+    """A read-only, seekable file object over a Google Drive file, fetching only the ranges that are read.
+
+    Ranges are fetched in blocks, kept in an LRU cache, so the small reads of parsers (like a zip's central directory,
+    read backwards from the end) cost a few requests. Missing blocks next to each other are fetched with a single
+    request. Once reads have gone sequentially through a whole block, the following blocks are fetched too, in a
+    readahead window that doubles with every sequential read, up to max_readahead, and drops when a read jumps
+    elsewhere. So small reads next to each other, like a tar header after the end of the previous member, do not
+    trigger readahead.
+    """
+
+    def __init__(self, file_downloader: Callable[[int, int], bytes], size: int, block_size=config.DRIVE_FILE_BLOCK_SIZE,
+                 cache_size=config.DRIVE_FILE_CACHE_SIZE, max_readahead=config.DRIVE_FILE_MAX_READAHEAD):
+        super().__init__()
+        self.file_downloader = file_downloader
+        self.size = size
+        self.block_size = block_size
+        self.cache_blocks = max(1, cache_size // block_size)
+        self.max_readahead_blocks = max_readahead // block_size
+        self.requests = 0
+        self._position = 0
+        self._blocks: 'OrderedDict[int, bytes]' = OrderedDict()
+        self._readahead_blocks = 0
+        self._last_read_end = None
+        self._sequential_bytes = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            position = offset
+        elif whence == os.SEEK_CUR:
+            position = self._position + offset
+        elif whence == os.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self._position = position
+        return position
+
+    def readinto(self, buffer) -> int:
+        start = self._position
+        end = min(self.size, start + len(buffer))
+        if start >= end:
+            return 0
+        self._update_readahead(start, end - start)
+        first_block = start // self.block_size
+        last_block = (end - 1) // self.block_size
+        if any(number not in self._blocks for number in range(first_block, last_block + 1)):
+            # The window is fetched as a whole when the read gets past what is cached, rather than a block at a time,
+            # so sequential reads take one request per window
+            readahead_end = min(last_block + self._readahead_blocks, (self.size - 1) // self.block_size)
+            self._fetch(first_block, readahead_end)
+        view = memoryview(buffer)
+        written = 0
+        for number in range(first_block, last_block + 1):
+            block = self._block(number)
+            block_start = number * self.block_size
+            piece = block[max(start, block_start) - block_start:min(end, block_start + len(block)) - block_start]
+            view[written:written + len(piece)] = piece
+            written += len(piece)
+        self._position = self._last_read_end = start + written
+        return written
+
+    def _update_readahead(self, start: int, length: int):
+        if start == self._last_read_end:
+            self._sequential_bytes += length
+        else:
+            self._sequential_bytes = length
+            self._readahead_blocks = 0
+        if self._sequential_bytes >= self.block_size:
+            self._readahead_blocks = min(self.max_readahead_blocks, max(1, self._readahead_blocks * 2))
+
+    def _block(self, number: int) -> bytes:
+        self._blocks.move_to_end(number)
+        return self._blocks[number]
+
+    def _fetch(self, first_block: int, last_block: int):
+        """Fetches the missing blocks of the range, each run of adjacent missing blocks with a single request"""
+        for first, last in self._missing_runs(first_block, last_block):
+            start = first * self.block_size
+            end = min(self.size, (last + 1) * self.block_size) - 1
+            self.requests += 1
+            logger.d(f"Fetching bytes {start}-{end} (blocks {first}-{last})")
+            content = self.file_downloader(start, end)
+            for number in range(first, last + 1):
+                offset = (number - first) * self.block_size
+                self._blocks[number] = content[offset:offset + self.block_size]
+        while len(self._blocks) > max(self.cache_blocks, last_block - first_block + 1):
+            self._blocks.popitem(last=False)
+
+    def _missing_runs(self, first_block: int, last_block: int) -> List[Tuple[int, int]]:
+        runs = []
+        for number in range(first_block, last_block + 1):
+            if number in self._blocks:
+                self._blocks.move_to_end(number)
+            elif runs and runs[-1][1] == number - 1:
+                runs[-1] = (runs[-1][0], number)
+            else:
+                runs.append((number, number))
+        return runs
@@ -1,16 +1,19 @@
+import copy
+import json
 import os
 import pickle
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, asdict
+from typing import Dict, Optional, Tuple
 
-# noinspection PyPackageRequirements
-from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import InstalledAppFlow
-# noinspection PyProtectedMember
-from googleapiclient import _auth
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaFileUpload
+from modules import config, logger, tracing
+from modules.governor import ConcurrencyGovernor, GovernedHttp
 
-from modules import config
+# Google client libraries are heavy to import, so they are only imported in the code paths that need them. This
+# keeps commands that never reach Google Drive, like 'gdrive --help', fast.
 
 
 class GoogleCredentials:
@@ -32,6 +35,8 @@ class GoogleCredentials:
 
     def prepare_credentials(self):
         if self._creds and self.is_credentials_outdated():
+            # noinspection PyPackageRequirements
+            from google.auth.transport.requests import Request
             self._creds.refresh(Request())
         else:
             self.create_credentials()
@@ -51,6 +56,7 @@ class GoogleCredentials:
 
     def create_credentials(self):
         if os.path.exists(config.CREDENTIALS_PATH):
+            from google_auth_oauthlib.flow import InstalledAppFlow
             flow = InstalledAppFlow.from_client_secrets_file(config.CREDENTIALS_PATH, self.SCOPES)
             self._creds = flow.run_local_server(port=0)
         else:
@@ -62,12 +68,193 @@ class GoogleCredentials:
             pickle.dump(self._creds, token)
 
 
-class GoogleService:
+class DiscoveryCache:
+    """Keeps a local copy of the Google Drive API discovery document, so the service can be built without fetching it.
+
+    The cached document is only used while it is younger than config.DISCOVERY_CACHE_MAX_AGE, and while it was
+    stored by the same version of the Google API client and describes the same API version.
+    """
+
+    API = 'drive'
+    VERSION = 'v3'
+
+    def __init__(self, path=config.DISCOVERY_CACHE_PATH):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                cached = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.d(f"No usable discovery document cache at {self.path}", e)
+            return None
+        if not self.is_valid(cached):
+            logger.d("Discovery document cache is stale")
+            return None
+        return cached['document']
+
+    def save(self, document):
+        cached = {
+            'client_version': self.client_version(),
+            'fetched_at': time.time(),
+            'document': document
+        }
+        try:
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(cached, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.d(f"Could not save discovery document cache at {self.path}", e)
+
+    def is_valid(self, cached):
+        try:
+            document = cached['document']
+            return cached['client_version'] == self.client_version() \
+                and document['name'] == self.API \
+                and document['version'] == self.VERSION \
+                and time.time() - cached['fetched_at'] < config.DISCOVERY_CACHE_MAX_AGE
+        except (KeyError, TypeError):
+            return False
+
+    @staticmethod
+    def client_version():
+        import googleapiclient
+        return googleapiclient.__version__
+
+
+# Fields needed to describe files with util.files_descriptions, which is what most commands render
+DESCRIPTION_FIELDS = ('id', 'name', 'size', 'modifiedTime', 'modifiedByMeTime', 'owners(displayName)')
+# Fields needed to describe and download files, including the checksum used by the download cache
+DOWNLOAD_FIELDS = DESCRIPTION_FIELDS + ('md5Checksum',)
+
+
+def looks_like_file_id(text: str) -> bool:
+    """Whether text could be a Google Drive file ID, which only has letters, digits, '-' and '_'"""
+    return re.fullmatch(r'[\w-]+', text) is not None
+
+
+def _quote(value: str) -> str:
+    return "'%s'" % value.replace('\\', '\\\\').replace("'", "\\'")
+
+
+@dataclass
+class DriveQuery:
+    """Filters for a Google Drive search, compiled into a Drive 'q' expression so they are applied server-side.
+
+    Drive cannot search by size, so larger_than is the only filter applied on our side, after the files are fetched.
+    """
+    name: Optional[str] = None
+    mime_type: Optional[str] = None
+    larger_than: Optional[int] = None
+    modified_after: Optional[str] = None  # RFC 3339 date or date-time, like 2021-06-30 or 2021-06-30T12:00:00
+    in_folder: Optional[str] = None  # Folder ID
+    trashed: Optional[bool] = None  # None for both trashed and not trashed files
+    order_by: str = 'modifiedByMeTime desc'
+
+    def compile(self) -> str:
+        terms = []
+        if self.name is not None:
+            # Could also be name = '%s' for an exact search
+            terms.append(f"name contains {_quote(self.name)}")
+        if self.mime_type is not None:
+            terms.append(f"mimeType = {_quote(self.mime_type)}")
+        if self.modified_after is not None:
+            # Drive expects a date-time, so a plain date means its midnight
+            modified_after = self.modified_after if 'T' in self.modified_after else f'{self.modified_after}T00:00:00'
+            terms.append(f"modifiedTime > {_quote(modified_after)}")
+        if self.in_folder is not None:
+            terms.append(f"{_quote(self.in_folder)} in parents")
+        if self.trashed is not None:
+            terms.append(f"trashed = {str(self.trashed).lower()}")
+        return ' and '.join(terms)
+
+    @property
+    def is_server_side(self) -> bool:
+        return self.larger_than is None
+
+    def matches(self, metadata) -> bool:
+        """Applies the filters that Drive cannot apply server-side"""
+        return self.larger_than is None or int(metadata.get('size', 0)) > self.larger_than
+
+    def required_fields(self, fields: Tuple[str, ...]) -> Tuple[str, ...]:
+        """The fields to request so both the caller and the filters applied on our side have what they need"""
+        if self.larger_than is not None and 'size' not in fields:
+            return fields + ('size',)
+        return fields
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class DriveQueries(ABC):
+    """Usability methods built on top of a single search_page call, shared by GoogleService and the agent client"""
+
+    @abstractmethod
+    def search_page(self, query: DriveQuery, page_size=1, page_token='', fields=DESCRIPTION_FIELDS):
+        """Returns the files found in a page of search results, and the token for the next page (None if last)"""
+
+    def search(self, query: DriveQuery, page_size=1, page_token='', fields=DESCRIPTION_FIELDS):
+        while True:
+            files_found, page_token = self.search_page(query, page_size, page_token, fields)
+            yield files_found
+            if page_token is None:
+                break
+
+    def search_filename(self, filename=None, page_size=1, page_token='', fields=DESCRIPTION_FIELDS):
+        yield from self.search(DriveQuery(name=filename), page_size, page_token, fields)
+
+    def find_first(self, query: DriveQuery, fields=DESCRIPTION_FIELDS):
+        # Filtering on our side may leave pages empty, so look at more files per page in that case
+        page_size = 1 if query.is_server_side else 100
+        for files_found in self.search(query, page_size, fields=fields):
+            if files_found:
+                return files_found[0]
+        return None
+
+    def get_last_modified_file(self, query: DriveQuery = None, fields=DESCRIPTION_FIELDS):
+        return self.find_first(query or DriveQuery(), fields)
+
+
+def _range_request(template, start: int, end: int):
+    """A request of its own for a range, so concurrent ranges never share, and clash on, the headers of one request"""
+    request = copy.copy(template)
+    request.headers = dict(template.headers, Range=f"bytes={start}-{end}")
+    request.response_callbacks = []
+    return request
+
+
+class GoogleService(DriveQueries):
     """Encapsulates Google Drive API, provides usability methods and keeps API-side configurations"""
 
-    def __init__(self):
+    def __init__(self, http2: bool = False, cache_server: Optional[str] = None, concurrency: Optional[int] = None):
         self.creds = GoogleCredentials().build()
-        self._google = build('drive', 'v3', credentials=self.creds)
+        self._google = self.build_drive()
+        self._local = threading.local()
+        # With HTTP/2, all threads share one transport, multiplexing their requests over a few connections
+        self._http2 = None
+        self._auth_request = None
+        self._credentials_lock = threading.Lock()
+        if http2:
+            from modules.http2 import Http2Transport
+            self._http2 = Http2Transport()
+        # URL of a gdrive cache server that media downloads go through, sending it our token for what it lacks
+        self.cache_server = cache_server
+        # Shared by every request made through this service, so they all back off together when throttled. Starts at
+        # the requests in flight asked for, if any, instead of growing to them from the default.
+        self.governor = ConcurrencyGovernor(initial=concurrency) if concurrency else ConcurrencyGovernor()
+
+    def build_drive(self):
+        from googleapiclient.discovery import build, build_from_document
+        cache = DiscoveryCache()
+        document = cache.load()
+        if document is not None:
+            return build_from_document(document, credentials=self.creds)
+        google = build(DiscoveryCache.API, DiscoveryCache.VERSION, credentials=self.creds, cache_discovery=False)
+        # The discovery document the resource was built from
+        # noinspection PyProtectedMember
+        cache.save(google._rootDesc)
+        return google
 
     def is_valid(self):
         return self._google is not None
@@ -79,55 +266,155 @@ class GoogleService:
         return self._google.files()
 
     def create_http(self):
+        """Returns this thread's authorized http, so its connections are reused by the following requests"""
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = self._local.http = GovernedHttp(self._authorized_http(), self.governor)
+        return http
+
+    def _authorized_http(self):
+        if self._http2 is not None:
+            import google_auth_httplib2
+            return google_auth_httplib2.AuthorizedHttp(self.creds, http=self._http2)
+        # noinspection PyProtectedMember
+        from googleapiclient import _auth
         return _auth.authorized_http(self.creds)
 
-    def get_file_metadata(self, file_id):
+    def _execute(self, request, name: str, **trace_args):
+        """Executes a metadata request with this thread's http, tracing it"""
+        with tracing.span(name, 'metadata', **trace_args):
+            return request.execute(http=self.create_http())
+
+    def get_file_metadata(self, file_id, fields=DESCRIPTION_FIELDS):
+        from googleapiclient.errors import HttpError
         try:
-            fields = 'id, name, size, modifiedTime, modifiedByMeTime, owners'
-            return self.drive().get(fileId=file_id, fields=fields).execute(http=self.create_http())
+            return self._execute(self.drive().get(fileId=file_id, fields=','.join(fields)), 'get file metadata',
+                                 file_id=file_id)
         except HttpError:
             return None
 
-    def search_filename(self, filename=None, page_size=1, page_token=''):
-        query = ''
-        if filename is not None:
-            # Could also be name = '%s' for an exact search
-            query = "name contains '%s'" % filename
+    def get_files_metadata(self, file_ids, fields=DESCRIPTION_FIELDS) -> Dict[str, Optional[dict]]:
+        """The metadata of many files, looked up with one batch request. Files not found map to None."""
+        found = {}
+
+        def on_response(file_id, metadata, exception):
+            found[file_id] = None if exception is not None else metadata
+
+        batch = self._google.new_batch_http_request(callback=on_response)
+        for file_id in file_ids:
+            batch.add(self.drive().get(fileId=file_id, fields=','.join(fields)), request_id=file_id)
+        self._execute(batch, 'get files metadata', files=len(file_ids))
+        return found
+
+    def search_page(self, query: DriveQuery, page_size=1, page_token='', fields=DESCRIPTION_FIELDS):
         fields = ','.join(
             ('nextPageToken',) +
-            tuple(map(lambda x: 'files/' + x, ('id', 'name', 'size', 'modifiedTime', 'modifiedByMeTime', 'owners')))
+            tuple(map(lambda x: 'files/' + x, query.required_fields(tuple(fields))))
         )
-        http = self.create_http()
-        while True:
-            search = self.drive().list(
-                q=query,
-                orderBy='modifiedByMeTime desc',
-                fields=fields,
-                pageSize=page_size,
-                pageToken=page_token
-            ).execute(http=http)
-            files_found = search.get('files', [])
-            page_token = search.get('nextPageToken', None)
-            yield files_found
-            if page_token is None:
-                break
+        search = self.drive().list(
+            q=query.compile(),
+            orderBy=query.order_by,
+            fields=fields,
+            pageSize=page_size,
+            pageToken=page_token
+        )
+        search = self._execute(search, 'search', query=query.compile(), page_size=page_size)
+        files_found = [metadata for metadata in search.get('files', []) if query.matches(metadata)]
+        return files_found, search.get('nextPageToken', None)
 
-    def get_last_modified_file(self):
-        try:
-            return next(self.search_filename())[0]
-        except KeyError:
-            return None
+    def copy_file(self, file_id: str, name: str = None, folder_id: str = None, fields=DESCRIPTION_FIELDS):
+        """Copies a file on Google Drive's side, so no content goes through us. Returns the metadata of the copy."""
+        body = {}
+        if name is not None:
+            body['name'] = name
+        if folder_id is not None:
+            body['parents'] = [folder_id]
+        return self._execute(self.drive().copy(fileId=file_id, body=body, fields=','.join(fields)), 'copy file',
+                             file_id=file_id)
+
+    def get_start_page_token(self) -> str:
+        """The page token of the changes feed at this moment: listing changes from it yields the changes made since"""
+        # noinspection PyUnresolvedReferences
+        return self._execute(self._google.changes().getStartPageToken(), 'get start page token')['startPageToken']
+
+    def list_changes(self, page_token: str, fields=DESCRIPTION_FIELDS):
+        """A page of the changes feed: its changes, the token of the next page, and, on the last page, the token to
+        list the changes made from now on"""
+        fields = ','.join((
+            'nextPageToken',
+            'newStartPageToken',
+            'changes(fileId,removed,file(%s))' % ','.join(fields + ('parents', 'trashed')),
+        ))
+        # noinspection PyUnresolvedReferences
+        page = self._google.changes().list(
+            pageToken=page_token,
+            pageSize=1000,
+            includeRemoved=True,
+            spaces='drive',
+            fields=fields
+        )
+        page = self._execute(page, 'list changes', page_token=page_token)
+        return page.get('changes', []), page.get('nextPageToken'), page.get('newStartPageToken')
+
+    def _open_media_stream(self, uri, headers, authorize: bool = True):
+        from google.auth.transport.requests import Request
+        from modules.mediastream import MediaStream
+        headers = dict(headers)
+        if authorize:
+            with self._credentials_lock:
+                # Refreshes the token when it expired, and adds it to the headers
+                self._auth_request = self._auth_request or Request()
+                self.creds.before_request(self._auth_request, 'GET', uri, headers)
+        if self._http2 is not None:
+            return self._http2.stream(uri, headers)
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            import requests
+            session = self._local.session = requests.Session()
+        response = session.get(uri, headers=headers, stream=True, timeout=config.DOWNLOAD_READ_TIMEOUT)
+        return MediaStream.from_requests(response)
 
     def get_file_downloader(self, metadata):
-        def file_downloader(start: int, end: int) -> bytes:
-            request.headers['Range'] = f"bytes={start}-{end}"
-            return request.execute(http=self.create_http())
+        """Returns a function downloading a range of the file. It is safe to call from any number of threads at once.
+
+        When given a threading.Event, the range is streamed and read in small blocks, and the download is abandoned,
+        closing its connection, as soon as the event is set, raising asyncio.CancelledError.
+        """
+        from modules import cacheserver
+        from modules.downloadcache import DownloadCache
+        if self.cache_server and DownloadCache.is_cacheable(metadata):
+            return self._get_cached_file_downloader(cacheserver.media_uri(self.cache_server, metadata))
+
+        def file_downloader(start: int, end: int, interrupted: threading.Event = None) -> bytes:
+            if interrupted is not None:
+                from modules.mediastream import download_range
+                return download_range(self._open_media_stream, self.governor, template.uri, start, end, interrupted)
+            return _range_request(template, start, end).execute(http=self.create_http())
+
+        # Built once, since building requests from the discovery document is slow, and copied for every range
+        template = self.drive().get_media(fileId=metadata["id"])
+        return file_downloader
+
+    def _get_cached_file_downloader(self, uri: str):
+        """Like get_file_downloader, for a file on the cache server. Always streamed, since the server is not Drive."""
+        def file_downloader(start: int, end: int, interrupted: threading.Event = None) -> bytes:
+            from modules.mediastream import download_range
+            return download_range(self._open_cached_media_stream, self.governor, uri, start, end,
+                                  interrupted or threading.Event())
 
-        file_id, file_name, file_size = metadata["id"], metadata["name"], int(metadata["size"])
-        request = self.drive().get_media(fileId=file_id)
         return file_downloader
 
+    def _open_cached_media_stream(self, uri, headers):
+        """Asks the cache server without our token, so it only crosses the network when the server needs it for what
+        it has not cached yet, which it answers with 401"""
+        stream = self._open_media_stream(uri, headers, authorize=False)
+        if stream.status != 401:
+            return stream
+        stream.read(threading.Event())  # Closes it
+        return self._open_media_stream(uri, headers)
+
     def upload(self, filepath, mime_type):
+        from googleapiclient.http import MediaFileUpload
         filename = filepath.split('/')[-1]
         file_metadata = {'name': filename}
         print('Uploading the file: %s' % filename)
@@ -142,3 +429,19 @@ class GoogleService:
             media_body=media,
             fields='id'
         )
+
+    def upload_stream(self, stream, filename, mime_type):
+        from modules.streamupload import StreamMediaUpload
+        file_metadata = {'name': filename}
+        print('Uploading the stream as: %s' % filename)
+        media = StreamMediaUpload(stream, mime_type, config.UPLOAD_CHUNK_SIZE)
+        return self.drive().create(
+            body=file_metadata,
+            media_body=media,
+            fields='id'
+        )
+
+    def upload_chunk(self, request):
+        """Sends the next chunk of an upload with the http of the thread calling it, so uploads running on different
+        threads never share a connection"""
+        return request.next_chunk(http=self.create_http())
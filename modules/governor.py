@@ -0,0 +1,110 @@
+import email.utils
+import json
+import threading
+import time
+from typing import Optional
+
+from modules import config, logger
+
+# Reasons Google Drive gives, in 403 responses, for throttling. 429 responses are always throttling.
+RATE_LIMIT_REASONS = ('userRateLimitExceeded', 'rateLimitExceeded')
+
+
+class ConcurrencyGovernor:
+    """Limits the number of requests in flight, adapting the limit to how Google Drive throttles us (AIMD).
+
+    Every successful request raises the limit a little (by about one request per round of requests), and every
+    throttled request halves it. When Drive tells us for how long to back off, with Retry-After, no new request is
+    started before that time is up. This keeps us at the highest rate the quota sustains, instead of failing.
+
+    An initial limit above the maximum raises the maximum, so asking for more requests in flight is never capped below
+    what was asked for.
+    """
+
+    def __init__(self, initial=config.GOVERNOR_INITIAL_CONCURRENCY, minimum=config.GOVERNOR_MIN_CONCURRENCY,
+                 maximum=config.GOVERNOR_MAX_CONCURRENCY):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = max(maximum, initial)
+        self.in_flight = 0
+        self._paused_until = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause <= 0 and self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                self._condition.wait(timeout=pause if pause > 0 else None)
+
+    def release(self, throttled: bool = False, retry_after: Optional[float] = None):
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit / 2)
+                backoff = retry_after if retry_after is not None else config.GOVERNOR_DEFAULT_BACKOFF
+                self._paused_until = max(self._paused_until, time.monotonic() + backoff)
+                logger.d(f"Throttled by Google Drive: limit is now {int(self.limit)}, pausing for {backoff}s")
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+def retry_after(response) -> Optional[float]:
+    value = response.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_throttled(response, content) -> bool:
+    if response.status == 429:
+        return True
+    if response.status != 403:
+        return False
+    try:
+        errors = json.loads(content)['error']['errors']
+    except (ValueError, KeyError, TypeError):
+        return False
+    return any(error.get('reason') in RATE_LIMIT_REASONS for error in errors)
+
+
+class GovernedHttp:
+    """Wraps an http object, so every request it makes goes through a ConcurrencyGovernor.
+
+    Throttled requests are retried, after backing off, as long as their body can be sent again.
+    """
+
+    def __init__(self, http, governor: ConcurrencyGovernor):
+        self.http = http
+        self.governor = governor
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        can_retry = body is None or isinstance(body, (bytes, str))
+        attempt = 0
+        while True:
+            self.governor.acquire()
+            try:
+                response, content = self.http.request(uri, method, body, headers, *args, **kwargs)
+            except BaseException:
+                self.governor.release()
+                raise
+            throttled = is_throttled(response, content)
+            self.governor.release(throttled, retry_after(response) if throttled else None)
+            if not throttled or not can_retry or attempt >= config.GOVERNOR_MAX_RETRIES:
+                return response, content
+            attempt += 1
+            logger.d(f"Retrying throttled request {method} {uri} (attempt {attempt})")
+
+    def __getattr__(self, name):
+        # Everything else, like credentials and connections, belongs to the wrapped http
+        return getattr(self.http, name)
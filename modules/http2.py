@@ -0,0 +1,64 @@
+from modules import config, logger
+
+# The HTTP/2 transport needs httpx, with its h2 extra: pip install ggdrive[http2]
+
+
+def is_available() -> bool:
+    try:
+        import httpx  # noqa: F401
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class Http2Response(dict):
+    """An httpx response, looking like the httplib2 one googleapiclient expects: headers in lowercase, and status"""
+
+    def __init__(self, response):
+        super().__init__((name.lower(), value) for name, value in response.headers.items())
+        self.status = response.status_code
+        self.reason = response.reason_phrase
+        self.version = 20
+        self['status'] = str(self.status)
+
+
+class Http2Transport:
+    """An httplib2-compatible http that multiplexes requests over a few HTTP/2 connections, through httpx.
+
+    With httplib2, every request in flight needs a connection of its own, so downloading more chunks at a time means
+    more TCP and TLS handshakes, and more connections for proxies to allow. Here, all chunk ranges and metadata calls of
+    a service share at most max_connections connections, as concurrent streams, with HTTP/2 flow control per stream.
+
+    A single transport is shared by all threads. Wrap it with credentials to authorize its requests.
+    """
+
+    def __init__(self, max_connections=config.HTTP2_MAX_CONNECTIONS, timeout=config.HTTP2_TIMEOUT):
+        import httpx
+        self.timeout = timeout
+        self.follow_redirects = True
+        self.connections = {}
+        self._client = httpx.Client(
+            http2=True,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            # Waiting for a connection of the pool is not a failure: it only means all streams are busy
+            timeout=httpx.Timeout(timeout, pool=None),
+        )
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        response = self._client.request(method, uri, content=body, headers=headers)
+        logger.d(f"{method} {uri} over {response.http_version}: {response.status_code}")
+        return Http2Response(response), response.content
+
+    def stream(self, uri, headers):
+        """Opens a streamed GET, for downloads that must be interruptible"""
+        from modules.mediastream import MediaStream
+        context = self._client.stream('GET', uri, headers=headers)
+        response = context.__enter__()
+        return MediaStream(response.status_code, response.reason_phrase, response.headers,
+                           response.iter_bytes(config.DOWNLOAD_READ_BLOCK_SIZE),
+                           lambda: context.__exit__(None, None, None))
+
+    def close(self):
+        self._client.close()
@@ -0,0 +1,82 @@
+import asyncio
+import threading
+from typing import Callable, Dict, Iterator, Optional
+
+from modules import config, logger, tracing
+from modules.governor import ConcurrencyGovernor, is_throttled, retry_after
+
+
+class MediaStream(dict):
+    """A streamed response to a media download: its headers, in lowercase, status, and body as an iterator of blocks.
+
+    Looks like the httplib2 responses googleapiclient expects, so it can be checked for throttling and errors the same
+    way. Reading it checks for interruption between blocks, and closing it closes its connection (or, with HTTP/2,
+    resets its stream), so an abandoned download stops using bandwidth right away.
+    """
+
+    def __init__(self, status: int, reason: str, headers: Dict[str, str], blocks: Iterator[bytes],
+                 close: Callable[[], None]):
+        super().__init__((name.lower(), value) for name, value in headers.items())
+        self.status = status
+        self.reason = reason
+        self['status'] = str(status)
+        self._blocks = blocks
+        self._close = close
+
+    @staticmethod
+    def from_requests(response) -> 'MediaStream':
+        return MediaStream(response.status_code, response.reason, response.headers,
+                           response.iter_content(config.DOWNLOAD_READ_BLOCK_SIZE), response.close)
+
+    def read(self, interrupted: threading.Event, expected_size: int = 0) -> bytearray:
+        """Reads the whole body, unless interrupted, in which case it raises CancelledError.
+
+        The content is allocated once, at the expected size, and the blocks are copied into place, instead of growing
+        it block by block, which copies what was read so far every time it is reallocated.
+        """
+        content = bytearray(expected_size)
+        received = 0
+        try:
+            for block in self._blocks:
+                if interrupted.is_set():
+                    logger.d(f"Media stream interrupted after {received} of {expected_size} bytes, closing it")
+                    raise asyncio.CancelledError
+                if not received:
+                    tracing.current_step('first byte', 'chunk', size=expected_size)
+                # Grows the content, if the body turns out longer than expected
+                content[received:received + len(block)] = block
+                received += len(block)
+        finally:
+            self._close()
+        # The body may be shorter, like for a range the server cut at the end of the file
+        del content[received:]
+        return content
+
+
+def download_range(open_stream: Callable[[str, dict], MediaStream], governor: ConcurrencyGovernor, uri: str,
+                   start: int, end: int, interrupted: threading.Event) -> bytearray:
+    """Downloads a range of a media URI through a stream, so it can be interrupted between any two blocks.
+
+    Goes through the governor, and retries when throttled, just like requests sent through a GovernedHttp.
+    """
+    headers = {'Range': f'bytes={start}-{end}'}
+    attempt = 0
+    while True:
+        if interrupted.is_set():
+            raise asyncio.CancelledError
+        governor.acquire()
+        throttled = False
+        stream: Optional[MediaStream] = None
+        try:
+            stream = open_stream(uri, headers)
+            if stream.status < 300:
+                return stream.read(interrupted, end - start + 1)
+            content = bytes(stream.read(interrupted))
+            throttled = is_throttled(stream, content)
+        finally:
+            governor.release(throttled, retry_after(stream) if throttled else None)
+        if not throttled or attempt >= config.GOVERNOR_MAX_RETRIES:
+            from googleapiclient.errors import HttpError
+            raise HttpError(stream, content, uri)
+        attempt += 1
+        logger.d(f"Retrying throttled range {start}-{end} of {uri} (attempt {attempt})")
@@ -0,0 +1,44 @@
+import threading
+from dataclasses import dataclass, field
+from typing import Optional
+
+from modules import logger
+
+
+@dataclass
+class MemoryBudget:
+    """The bytes that the in-flight work of transfers may hold, shared by all of their workers.
+
+    A process has a single budget, shared by all the transfers it runs at the same time. Workers reserve the size of
+    what they are about to download before downloading it, and release it once it is written out, so the memory held
+    by in-flight content never goes above max_memory, no matter how many workers and transfers are running. Nothing is
+    allocated here: the downloaded content itself is what is counted. A single reservation larger than the whole budget
+    is let through once nothing else is reserved, instead of waiting forever.
+    """
+    max_memory: int
+    _reserved: int = field(init=False, default=0)
+    _condition: threading.Condition = field(init=False, default_factory=threading.Condition)
+
+    @property
+    def reserved(self) -> int:
+        return self._reserved
+
+    def reserve(self, size: int, timeout: Optional[float] = None) -> bool:
+        """Reserve size bytes, blocking while the budget cannot hold them.
+
+        Returns False if they could not be reserved within timeout seconds, so callers can check for cancellation and
+        retry.
+        """
+        with self._condition:
+            fits = self._condition.wait_for(
+                lambda: self._reserved == 0 or self._reserved + size <= self.max_memory, timeout)
+            if not fits:
+                return False
+            self._reserved += size
+            logger.d(f"Reserved {size} bytes, {self._reserved}/{self.max_memory} in use")
+            return True
+
+    def release(self, size: int):
+        with self._condition:
+            self._reserved -= size
+            self._condition.notify_all()
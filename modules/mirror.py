@@ -0,0 +1,190 @@
+import asyncio
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+from modules import config, logger
+from modules.backports import to_thread_compat
+from modules.chunks import complete, create_chunks
+from modules.googleservice import DriveQuery, DOWNLOAD_FIELDS
+from modules.memorybudget import MemoryBudget
+from modules.util import create_dir, remove_file
+
+# The state of a mirror, kept in its directory: the changes feed page token it is at, and the files it holds
+STATE_FILE = '.gdrive-mirror.json'
+# Names of the temporary files and directories of downloads in progress, which are named after file IDs
+_TEMPORARY_NAME = re.compile(r'^\..*\.part$')
+
+
+class MirrorError(Exception):
+    """A mirror that cannot be synced"""
+
+
+class Mirror:
+    """Keeps a local directory in sync with the files of a Google Drive folder, following Drive's changes feed.
+
+    The first sync takes a page token of the feed, and then downloads the whole folder. Every later sync only lists
+    the changes made since the token, downloads the files that are new or whose checksum changed, in parallel, and
+    removes the local copies of files that were removed, trashed or moved out of the folder. The token is checkpointed
+    after each page of changes is applied, so a restart resumes where it stopped, without listing the folder again.
+
+    Only the files directly in the folder are mirrored. Google Docs, which have no content to download, are skipped,
+    and so are files with names the mirror cannot use, like '..', or keeps for itself, like its state file.
+    """
+
+    def __init__(self, google, folder_id: str, path: str, memory: MemoryBudget,
+                 concurrency=config.MIRROR_CONCURRENT_DOWNLOADS):
+        self.google = google
+        self.folder_id = folder_id
+        self.path = path
+        self.memory = memory  # Shared by the downloads running at the same time
+        self._downloads = asyncio.Semaphore(concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=config.BATCH_WORKERS)
+        self.state_path = os.path.join(path, STATE_FILE)
+        self.page_token: Optional[str] = None
+        self.files: Dict[str, dict] = {}  # ID of a mirrored file -> its name and checksum
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.state_path):
+            return
+        with open(self.state_path, 'r') as f:
+            state = json.load(f)
+        if state.get('folder') != self.folder_id:
+            raise MirrorError(f"{self.path} mirrors the folder {state.get('folder')}, not {self.folder_id}")
+        self.page_token = state['page_token']
+        self.files = state['files']
+
+    def checkpoint(self, page_token: str):
+        self.page_token = page_token
+        tmp_path = f'{self.state_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'folder': self.folder_id, 'page_token': page_token, 'files': self.files}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.state_path)
+
+    async def run(self, interval=config.MIRROR_POLL_INTERVAL):
+        try:
+            while True:
+                try:
+                    await self.sync()
+                except Exception as e:
+                    # The checkpoint was not moved past what failed, so the next sync retries it
+                    logger.stacktrace()
+                    print(f"Sync failed, retrying in {interval}s: {e}")
+                await asyncio.sleep(interval)
+        finally:
+            self.close()
+
+    def close(self):
+        self._executor.shutdown()
+
+    async def sync(self):
+        create_dir(self.path)
+        if self.page_token is None:
+            await self._mirror_whole_folder()
+        page_token = self.page_token
+        while True:
+            changes, next_page_token, new_start_page_token = await to_thread_compat(
+                self.google.list_changes, page_token, DOWNLOAD_FIELDS)
+            await self._apply({change['fileId']: self._mirrored_file(change) for change in changes})
+            page_token = next_page_token or new_start_page_token
+            self.checkpoint(page_token)
+            if next_page_token is None:
+                return
+
+    async def _mirror_whole_folder(self):
+        # Taken before listing, so files that land while the folder is listed are in the feed from it
+        page_token = await to_thread_compat(self.google.get_start_page_token)
+        print(f"Mirroring the whole folder {self.folder_id} into {self.path}")
+        query = DriveQuery(in_folder=self.folder_id, trashed=False)
+        pages = await to_thread_compat(list, self.google.search(query, 1000, fields=DOWNLOAD_FIELDS))
+        await self._apply({metadata['id']: metadata for files in pages for metadata in files})
+        self.checkpoint(page_token)
+
+    def _mirrored_file(self, change) -> Optional[dict]:
+        """The file of a change, if it is one to have in the mirror, else None"""
+        metadata = change.get('file')
+        if change.get('removed') or metadata is None or metadata.get('trashed'):
+            return None
+        if self.folder_id not in metadata.get('parents', []):
+            return None
+        return metadata
+
+    async def _apply(self, files: Dict[str, Optional[dict]]):
+        """Makes the mirror have each file, or not have it, when it maps to None"""
+        downloads = []
+        for file_id, metadata in files.items():
+            if metadata is not None and self._local_name(metadata) is None:
+                print(f"[skipped] {metadata['name']}: not a name the mirror can have a file with")
+                metadata = None
+            if metadata is None or 'md5Checksum' not in metadata:
+                self._remove(file_id)
+            elif self.files.get(file_id, {}).get('md5Checksum') != metadata['md5Checksum']:
+                downloads.append(metadata)
+            elif self.files[file_id]['name'] != self._local_name(metadata):
+                if not self._rename(file_id, self._local_name(metadata)):
+                    downloads.append(metadata)
+        results = await asyncio.gather(*map(self._download, downloads), return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            raise MirrorError(f"{len(errors)} of {len(downloads)} downloads failed, first with: {errors[0]}")
+
+    @staticmethod
+    def _local_name(metadata) -> Optional[str]:
+        """The name of the local copy of a file, or None if its name cannot be used in the mirror"""
+        name = os.path.basename(metadata['name'])
+        if name in ('', '.', '..', STATE_FILE, f'{STATE_FILE}.tmp') or _TEMPORARY_NAME.match(name):
+            return None
+        return name
+
+    def _is_name_taken(self, name: str, by_other_than: str) -> bool:
+        """Whether a file other than the given one is mirrored with this name. Drive allows files with the same name."""
+        return any(file['name'] == name for file_id, file in self.files.items() if file_id != by_other_than)
+
+    def _remove(self, file_id: str):
+        mirrored = self.files.pop(file_id, None)
+        if mirrored is None:
+            return
+        if not self._is_name_taken(mirrored['name'], file_id):
+            remove_file(os.path.join(self.path, mirrored['name']))
+        print(f"[removed] {mirrored['name']}")
+
+    def _rename(self, file_id: str, name: str) -> bool:
+        """Renames the local copy of a file. Returns False if there is none to rename, like when it was deleted."""
+        mirrored = self.files[file_id]
+        try:
+            os.replace(os.path.join(self.path, mirrored['name']), os.path.join(self.path, name))
+        except FileNotFoundError:
+            logger.d(f"Local copy of {mirrored['name']} is gone, downloading it again as {name}")
+            return False
+        print(f"[renamed] {mirrored['name']} -> {name}")
+        mirrored['name'] = name
+        return True
+
+    async def _download(self, metadata):
+        name = self._local_name(metadata)
+        final_path = os.path.join(self.path, name)
+        # Downloaded aside, so the mirror never has an incomplete file. Named after the ID, since Drive allows files
+        # with the same name, which may be downloading at the same time.
+        tmp_path = os.path.join(self.path, f".{metadata['id']}.part")
+        async with self._downloads:
+            file_downloader = self.google.get_file_downloader(metadata)
+            chunks = create_chunks(tmp_path, int(metadata['size']), config.DOWNLOAD_CHUNK_SIZE, file_downloader,
+                                   self.memory, executor=self._executor, owns_executor=False)
+            try:
+                await complete(chunks)
+            except BaseException:
+                remove_file(tmp_path)
+                raise
+            os.replace(tmp_path, final_path)
+        previous = self.files.get(metadata['id'])
+        if previous is not None and previous['name'] != name and not self._is_name_taken(previous['name'],
+                                                                                          metadata['id']):
+            # Renamed on Drive, as well as changed
+            remove_file(os.path.join(self.path, previous['name']))
+        self.files[metadata['id']] = {'name': name, 'md5Checksum': metadata['md5Checksum']}
+        print(f"[downloaded] {name}")
@@ -0,0 +1,62 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import Callable, Optional
+
+from modules import config, logger
+
+
+class RangePrefetch:
+    """The first range of a file, requested speculatively as soon as its ID is known, before its metadata arrives.
+
+    Downloaders wrapped by it take the prefetched content for the first chunk instead of requesting it again, so files
+    that fit in a single chunk are already downloaded when their metadata is. If the ID turns out to be wrong, or the
+    prefetch fails, the content is simply not used.
+    """
+
+    def __init__(self, google, file_id: str, chunk_size: int = config.DOWNLOAD_CHUNK_SIZE):
+        self.file_id = file_id
+        self.end = chunk_size - 1
+        self._discarded = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=1)
+        self._future = executor.submit(google.get_file_downloader({'id': file_id}), 0, self.end, self._discarded)
+        executor.shutdown(wait=False)
+        logger.d(f"Prefetching bytes 0-{self.end} of file {file_id}")
+
+    def wrap(self, file_downloader: Callable[..., bytes]) -> Callable[..., bytes]:
+        def prefetched_downloader(start: int, end: int, *args) -> bytes:
+            content = self.take(start, end, *args)
+            return file_downloader(start, end, *args) if content is None else content
+
+        return prefetched_downloader
+
+    def take(self, start: int, end: int, interrupted: threading.Event = None) -> Optional[bytes]:
+        """The prefetched content of the range, if it was prefetched, and only once"""
+        if self._future is None or start != 0 or end > self.end:
+            return None
+        future, self._future = self._future, None
+        try:
+            content = self._result(future, interrupted)
+        except Exception as e:
+            logger.d(f"Prefetch of file {self.file_id} failed, downloading its first range again", e)
+            return None
+        # The server cuts the range at the end of the file, so a chunk ending there matches it exactly
+        if len(content) != end - start + 1:
+            logger.d(f"Prefetched {len(content)} bytes of file {self.file_id}, but {end - start + 1} are needed")
+            return None
+        return content
+
+    def _result(self, future, interrupted: Optional[threading.Event]):
+        while True:
+            try:
+                return future.result(timeout=0.1)
+            except TimeoutError:
+                if interrupted is not None and interrupted.is_set():
+                    self._discarded.set()
+                    raise asyncio.CancelledError
+
+    def discard(self):
+        self._discarded.set()
+        if self._future is not None:
+            self._future.cancel()
+            self._future = None
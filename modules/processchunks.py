@@ -0,0 +1,121 @@
+import asyncio
+import multiprocessing
+import multiprocessing.synchronize
+import os
+from asyncio import BaseEventLoop, Future, Task
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import Optional, Set
+
+from modules import config, logger
+from modules.chunks import Chunks, Transfer
+from modules.progresslogger import Progress
+from modules.util import remove_file
+
+# State of a worker process, set up once by _init_worker: its own GoogleService, with its own connections, and its own
+# descriptor of the output file.
+_worker = {}
+
+
+def _init_worker(metadata, file_path, interrupted, cache_server):
+    from modules.googleservice import GoogleService
+    _worker['downloader'] = GoogleService(cache_server=cache_server).get_file_downloader(metadata)
+    _worker['interrupted'] = interrupted
+    _worker['fd'] = os.open(file_path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+    logger.d(f"Download worker process {os.getpid()} started")
+
+
+def _pwrite(fd, content, offset):
+    if hasattr(os, 'pwrite'):
+        os.pwrite(fd, content, offset)
+    else:
+        # Each worker process has its own descriptor, so seeking does not race with other workers
+        os.lseek(fd, offset, os.SEEK_SET)
+        os.write(fd, content)
+
+
+def _download_range(start: int, end: int) -> int:
+    """Downloads a range and writes it at its offset of the output file. Only the number of bytes goes back."""
+    content = _worker['downloader'](start, end, _worker['interrupted'])
+    _pwrite(_worker['fd'], content, start)
+    return len(content)
+
+
+@dataclass
+class ProcessChunks(Transfer):
+    """Downloads chunks across a pool of worker processes, for links fast enough to make a single process CPU-bound.
+
+    Each worker process has its own Google Drive service and connections, and writes the chunks it downloads straight
+    into the output file at their offsets. The output file is preallocated, so there are no partial files to join.
+    Only the number of bytes written goes back to the event loop, as progress. Like with Chunks, only a window of
+    chunks is submitted at a time, so the pending work stays the same, no matter how large the file is. Chunks are
+    written in place, so any chunk that is done makes room for the next one, in any order.
+
+    Requires Python 3.7 or greater, for process pool initializers.
+    """
+    file_name: str
+    file_size: int
+    chunk_size: int
+    metadata: dict
+    processes: int
+    cache_server: Optional[str] = None
+    loop: BaseEventLoop = field(default_factory=asyncio.get_event_loop)
+    window: int = config.DOWNLOAD_WINDOW
+    executor: ProcessPoolExecutor = field(init=False)
+    # Shared with the worker processes, so cancelling stops their downloads between two blocks
+    interrupted: multiprocessing.synchronize.Event = field(init=False, default_factory=multiprocessing.Event)
+    work_task: Task = field(init=False)
+    _in_flight: Set[Future] = field(init=False, default_factory=set)
+    _progresses: asyncio.Queue = field(init=False)
+
+    def __post_init__(self):
+        with open(self.file_name, 'wb') as f:
+            f.truncate(self.file_size)
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.processes,
+            initializer=_init_worker,
+            initargs=(self.metadata, os.path.abspath(self.file_name), self.interrupted, self.cache_server)
+        )
+        # Enough to keep every process busy while the next chunks are submitted
+        self.window = max(self.window, self.processes)
+        self._progresses = asyncio.Queue()
+        self.work_task = self.loop.create_task(self._work())
+
+    def _submit(self, number: int) -> Future:
+        start = self.chunk_size * number
+        end = min(self.file_size - 1, start + self.chunk_size - 1)
+        return self.loop.run_in_executor(self.executor, _download_range, start, end)
+
+    async def _work(self):
+        upcoming = iter(range(Chunks.calculate_number_of_chunks(self.file_size, self.chunk_size)))
+        received = 0
+        try:
+            while True:
+                self._in_flight.update(map(self._submit, islice(upcoming, self.window - len(self._in_flight))))
+                if not self._in_flight:
+                    break
+                done, self._in_flight = await asyncio.wait(self._in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    received += task.result()
+                    await self._progresses.put(Progress(received, self.file_size))
+        except BaseException:
+            self.interrupted.set()
+            for task in self._in_flight:
+                task.cancel()
+            raise
+        finally:
+            await self._progresses.put(None)
+
+    async def await_it(self):
+        await self.work_task
+        logger.d("Process chunks finished work, shutting down process pool.")
+        self._shutdown_executor()
+
+    def cancel(self):
+        print("Cleaning up...")
+        logger.d(f"Cancelling process chunks")
+        self.interrupted.set()
+        self.work_task.cancel()
+        self._shutdown_executor(wait=False)
+        remove_file(self.file_name)
@@ -0,0 +1,133 @@
+import os
+import sys
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, Tuple
+
+from modules import config, logger
+
+# A function, as pstats identifies it: (file name, first line number, function name)
+Function = Tuple[str, int, str]
+
+
+def _function(frame) -> Function:
+    code = frame.f_code
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+def _chunk_tag(frame):
+    """The chunk a frame works on, when it is Chunk.download, so samples can be told apart by chunk"""
+    if frame.f_code.co_name != 'download':
+        return None
+    chunk = frame.f_locals.get('self')
+    if type(chunk).__name__ != 'Chunk':
+        return None
+    return f'chunk#{chunk.number}'
+
+
+class SamplingProfiler:
+    """Samples the stacks of every thread at a fixed interval: the event loop and all executor worker threads.
+
+    Unlike cProfile, which only sees the thread it was enabled on, this shows where time goes across threads, including
+    time spent waiting for the GIL or for disk writes. Samples of Chunk.download are tagged with the chunk number.
+
+    Results can be written as pstats, estimated from the samples, and as collapsed stacks for flamegraph tools.
+    """
+
+    def __init__(self, interval=config.PROFILE_INTERVAL):
+        self.interval = interval
+        self.samples: Counter = Counter()  # (thread name, tag, stack of functions from root to leaf) -> count
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample_forever, name='SamplingProfiler', daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _sample_forever(self):
+        while not self._stopped.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == self._thread.ident:
+                continue
+            stack, tag = [], None
+            while frame is not None:
+                stack.append(_function(frame))
+                tag = tag or _chunk_tag(frame)
+                frame = frame.f_back
+            stack.reverse()
+            self.samples[(names.get(thread_id, str(thread_id)), tag, tuple(stack))] += 1
+
+    def write(self, prefix: str):
+        """Writes prefix.pstats and prefix.collapsed"""
+        self.write_pstats(f'{prefix}.pstats')
+        self.write_collapsed(f'{prefix}.collapsed')
+        print(f"Profile written to {prefix}.pstats and {prefix}.collapsed")
+
+    def write_collapsed(self, path: str):
+        """Writes one line per distinct stack, 'thread;[chunk;]frame;...;frame count', as flamegraph.pl expects"""
+        lines = Counter()
+        for (thread_name, tag, stack), count in self.samples.items():
+            frames = [thread_name] + ([tag] if tag else []) + [self._label(function) for function in stack]
+            lines[';'.join(frame.replace(';', ':') for frame in frames)] += count
+        with open(path, 'w') as f:
+            for line, count in sorted(lines.items()):
+                f.write(f'{line} {count}\n')
+
+    def write_pstats(self, path: str):
+        """Writes pstats, with times estimated from how many samples saw each function, and call counts as samples"""
+        import pstats
+        stats = _SampledStats(self.samples, self.interval)
+        pstats.Stats(stats).dump_stats(path)
+        logger.d(f"Wrote profile with {sum(self.samples.values())} samples to {path}")
+
+    @staticmethod
+    def _label(function: Function) -> str:
+        file_name, line, name = function
+        return f'{name} ({os.path.basename(file_name)}:{line})'
+
+
+class _SampledStats:
+    """Looks like a finished cProfile.Profile to pstats.Stats, with stats built from samples"""
+
+    def __init__(self, samples: Counter, interval: float):
+        self.stats = {}
+        self._build(samples, interval)
+
+    def create_stats(self):
+        pass
+
+    def _build(self, samples: Counter, interval: float):
+        own: Dict[Function, float] = defaultdict(float)
+        total: Dict[Function, float] = defaultdict(float)
+        hits: Dict[Function, int] = defaultdict(int)
+        callers: Dict[Function, Dict[Function, list]] = defaultdict(lambda: defaultdict(lambda: [0, 0, 0.0, 0.0]))
+        for (_, _, stack), count in samples.items():
+            elapsed = count * interval
+            own[stack[-1]] += elapsed
+            for function in set(stack):
+                total[function] += elapsed
+                hits[function] += count
+            for caller, callee in set(zip(stack, stack[1:])):
+                caller_stats = callers[callee][caller]
+                caller_stats[0] += count
+                caller_stats[1] += count
+                caller_stats[3] += elapsed
+                if callee == stack[-1]:
+                    caller_stats[2] += elapsed
+        for function in total:
+            function_callers = {caller: tuple(values) for caller, values in callers[function].items()}
+            self.stats[function] = (hits[function], hits[function], own[function], total[function], function_callers)
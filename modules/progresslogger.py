@@ -3,7 +3,7 @@ import time
 from asyncio import Queue, Task
 from dataclasses import dataclass, astuple, field
 
-from modules import logger
+from modules import logger, tracing
 from modules.util import to_human_readable
 
 
@@ -21,8 +21,17 @@ class Progress:
 
     @property
     def percentage(self) -> int:
+        if not self.is_total_known:
+            return 0
+        if self.bytes_total == 0:
+            # Nothing to transfer, like an empty file, is done as soon as it starts
+            return 100
         return int((float(self.bytes_received) / float(self.bytes_total)) * 100)
 
+    @property
+    def is_total_known(self) -> bool:
+        return self.bytes_total is not None
+
 
 @dataclass
 class Channel:
@@ -128,19 +137,39 @@ class ProgressLogger:
     async def _work(self):
         """Print logs while the channel is open and receiving values, or closed, but still has items."""
         async for progress in self._channel:
-            self._log_progress(progress)
+            with tracing.span('render progress', 'progress', operation=self.operation):
+                self._log_progress(progress)
 
     def _log_progress(self, progress: Progress):
         """Print log from status."""
         current_size, total_size, percentage = progress
         elapsed_time = time.time() - self._start_time
-        speed = current_size / elapsed_time
-        estimated_time = (total_size - current_size) / speed
+        speed = current_size / elapsed_time if elapsed_time > 0 else 0.0
+        if not progress.is_total_known:
+            self._log_unknown_total_progress(current_size, speed, elapsed_time)
+            return
         readable_current_size, readable_total_size, readable_speed = to_human_readable(current_size, total_size, speed)
         timer = time.strftime("%H:%M:%S", time.gmtime(elapsed_time))
-        eta = time.strftime("%H:%M:%S", time.gmtime(estimated_time))
+        eta = self._eta(total_size - current_size, speed)
         print(
             "%s %d%% - %s/%s - %s/s - %s - ETA: %s             " %
             (self.operation, percentage, readable_current_size, readable_total_size, readable_speed, timer, eta),
             end='\r'
         )
+
+    @staticmethod
+    def _eta(remaining_size: int, speed: float) -> str:
+        if remaining_size <= 0:
+            # Done, like an empty file, which is done before any byte is received
+            return "00:00:00"
+        if speed == 0:
+            return "--:--:--"
+        return time.strftime("%H:%M:%S", time.gmtime(remaining_size / speed))
+
+    def _log_unknown_total_progress(self, current_size, speed, elapsed_time):
+        readable_current_size, readable_speed = to_human_readable(current_size, speed)
+        timer = time.strftime("%H:%M:%S", time.gmtime(elapsed_time))
+        print(
+            "%s %s - %s/s - %s             " % (self.operation, readable_current_size, readable_speed, timer),
+            end='\r'
+        )
@@ -0,0 +1,73 @@
+from typing import BinaryIO
+
+from googleapiclient.http import MediaUpload
+
+from modules import logger
+
+
+class StreamNotSerializableError(TypeError):
+    """A stream upload that was asked to be serialized, to be resumed later"""
+
+
+class StreamMediaUpload(MediaUpload):
+    """A resumable media upload reading from a non-seekable stream of unknown size, like stdin or a pipe.
+
+    The stream is read one chunk at a time into a single buffer, which is only replaced after the server acknowledged
+    it, so memory stays at about one chunk no matter how large the stream is. The total size is unknown until the
+    stream ends: googleapiclient sends the last, short chunk with the final size.
+    """
+
+    def __init__(self, stream: BinaryIO, mimetype: str, chunksize: int):
+        super().__init__()
+        self._stream = stream
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        self._buffer = b''
+        self._buffer_offset = 0
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        return None
+
+    def resumable(self):
+        return True
+
+    def has_stream(self):
+        return False
+
+    def getbytes(self, begin, length):
+        """Returns length bytes starting at begin. Anything before begin was acknowledged and can be dropped."""
+        if not self._buffer_offset <= begin <= self._buffer_offset + len(self._buffer):
+            raise ValueError(f"Cannot rewind stream to {begin}, buffer starts at {self._buffer_offset}")
+        self._buffer = self._buffer[begin - self._buffer_offset:]
+        self._buffer_offset = begin
+        missing = length - len(self._buffer)
+        if missing > 0:
+            self._buffer += self._read(missing)
+        logger.d(f"Sending {min(length, len(self._buffer))} bytes of stream from offset {begin}")
+        return self._buffer[:length]
+
+    def _read(self, length) -> bytes:
+        """Reads up to length bytes, only returning less at the end of the stream"""
+        parts = []
+        while length > 0:
+            part = self._stream.read(length)
+            if not part:
+                break
+            parts.append(part)
+            length -= len(part)
+        return b''.join(parts)
+
+    def to_json(self):
+        """Stream uploads cannot be serialized, so they cannot be resumed by another process.
+
+        What a MediaUpload serializes is how to reopen its media, but a stream cannot be reopened: what was read from
+        stdin or a pipe is gone, except for the last chunk held in memory. A serialized upload could only be resumed
+        by this same process, which can simply keep the upload object instead.
+        """
+        raise StreamNotSerializableError("Uploads of streams cannot be serialized, since streams cannot be reopened")
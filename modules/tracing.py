@@ -0,0 +1,133 @@
+import asyncio
+import json
+import os
+import threading
+import time
+
+# Trace events in the Chrome trace event format, which chrome://tracing and ui.perfetto.dev open. Recording is off
+# unless start() is called, and then every event is kept in memory until write().
+_events = None
+_lock = threading.Lock()
+_start_time = 0.0
+_thread_names = {}  # Kept as events are recorded, since worker threads may be gone by the time they are written
+_local = threading.local()
+
+
+def start():
+    global _events, _start_time
+    _events = []
+    _start_time = time.perf_counter()
+
+
+def is_enabled() -> bool:
+    return _events is not None
+
+
+def _timestamp() -> float:
+    """Microseconds since tracing started"""
+    return (time.perf_counter() - _start_time) * 1e6
+
+
+def _task_id():
+    try:
+        current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task  # No current_task in 3.6
+        task = current_task()
+    except RuntimeError:
+        # Not in the event loop thread
+        return None
+    return id(task) if task is not None else None
+
+
+def _record(event: dict):
+    event.update(pid=os.getpid(), tid=threading.get_ident())
+    args = event.setdefault('args', {})
+    task_id = _task_id()
+    if task_id is not None:
+        args['task'] = task_id
+    with _lock:
+        if _events is not None:
+            _events.append(event)
+            _thread_names[event['tid']] = threading.current_thread().name
+
+
+class span:
+    """Records the time spent in a with-block, on the current thread"""
+
+    def __init__(self, name: str, category: str, **args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self._start = None
+
+    def __enter__(self):
+        if _events is not None:
+            self._start = _timestamp()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._start is None:
+            return
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        _record({'name': self.name, 'cat': self.category, 'ph': 'X', 'ts': self._start,
+                 'dur': _timestamp() - self._start, 'args': self.args})
+
+
+def instant(name: str, category: str, **args):
+    if _events is not None:
+        _record({'name': name, 'cat': category, 'ph': 'i', 's': 't', 'ts': _timestamp(), 'args': args})
+
+
+def begin(name: str, category: str, span_id, **args):
+    """Begins a span that may end on another thread, like the lifecycle of a chunk"""
+    if _events is not None:
+        _record({'name': name, 'cat': category, 'ph': 'b', 'id': span_id, 'ts': _timestamp(), 'args': args})
+
+
+def step(name: str, category: str, span_id, **args):
+    """Marks a step of a span begun with begin()"""
+    if _events is not None:
+        _record({'name': name, 'cat': category, 'ph': 'n', 'id': span_id, 'ts': _timestamp(), 'args': args})
+
+
+class current:
+    """Makes a span begun with begin() the current one of this thread in a with-block, so code that does not know it,
+    like a downloader, can mark steps of it with current_step()"""
+
+    def __init__(self, span_id):
+        self.span_id = span_id
+        self._previous = None
+
+    def __enter__(self):
+        self._previous = getattr(_local, 'span_id', None)
+        _local.span_id = self.span_id
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _local.span_id = self._previous
+
+
+def current_step(name: str, category: str, **args):
+    """Marks a step of the current span of this thread or, when there is none, an instant on the thread"""
+    span_id = getattr(_local, 'span_id', None)
+    if span_id is None:
+        instant(name, category, **args)
+    else:
+        step(name, category, span_id, **args)
+
+
+def end(name: str, category: str, span_id, **args):
+    if _events is not None:
+        _record({'name': name, 'cat': category, 'ph': 'e', 'id': span_id, 'ts': _timestamp(), 'args': args})
+
+
+def write(path: str):
+    """Writes the events recorded so far, with the names of their threads"""
+    with _lock:
+        events = list(_events or [])
+        names = dict(_thread_names)
+    metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': thread_id, 'args': {'name': name}}
+                for thread_id, name in names.items()]
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}, f)
+    print(f"Trace with {len(events)} events written to {path}")
@@ -1,7 +1,10 @@
+import math
 import mimetypes
 import os
+import queue
 import sys
-from typing import Callable, Any
+import threading
+from typing import Callable, Any, Iterable, Iterator, BinaryIO
 
 from modules import logger
 
@@ -19,6 +22,39 @@ def to_human_readable(*values, suffix='B'):
     return tuple(convert(value) for value in values)
 
 
+def from_human_readable(value: str, suffix='B') -> int:
+    """Converts a human-readable size, like '256M' or '1.5GB', back to bytes"""
+    units = ['', 'K', 'M', 'G', 'T']
+    text = value.strip().upper()
+    if text.endswith(suffix):
+        text = text[:-len(suffix)]
+    unit = text[-1:] if text[-1:] in units[1:] else ''
+    number = text[:-1] if unit else text
+    try:
+        size = float(number) * 1024 ** units.index(unit)
+    except ValueError:
+        raise ValueError(f"Invalid size '{value}'")
+    if not math.isfinite(size) or size < 0:
+        raise ValueError(f"Invalid size '{value}'")
+    return int(size)
+
+
+def positive_size(value: str) -> int:
+    """A human-readable size that must be at least one byte, like a memory budget"""
+    size = from_human_readable(value)
+    if size < 1:
+        raise ValueError(f"Size '{value}' must be at least 1 byte")
+    return size
+
+
+def positive_int(value: str) -> int:
+    """A count that must be at least one, like a number of workers"""
+    number = int(value)
+    if number < 1:
+        raise ValueError(f"'{value}' must be at least 1")
+    return number
+
+
 def get_modification_time(file):
     return os.stat(file).st_mtime
 
@@ -145,12 +181,63 @@ def remove_file(*paths):
             logger.d(f"File not found {path}", e)
 
 
-def copy_file_contents(dest: str, *srcs: str):
+def copy_file_contents(dest: str, *srcs: str, buffer: bytearray = None):
+    """Concatenates srcs into dest. If a buffer is given, files are copied through it instead of read whole"""
     with open(dest, 'wb') as final_file:
-        for src in srcs:
-            with open(src, 'rb') as partial_file:
-                logger.d(f"Writing '{partial_file.name}' into '{dest}'")
+        append_file_contents(final_file, *srcs, buffer=buffer)
+
+
+def append_file_contents(final_file: BinaryIO, *srcs: str, buffer: bytearray = None):
+    """Appends srcs to an open file. If a buffer is given, files are copied through it instead of read whole"""
+    for src in srcs:
+        with open(src, 'rb') as partial_file:
+            logger.d(f"Writing '{partial_file.name}' into '{final_file.name}'")
+            if buffer is None:
                 final_file.write(partial_file.read())
+                continue
+            view = memoryview(buffer)
+            while True:
+                read = partial_file.readinto(view)
+                if not read:
+                    break
+                final_file.write(view[:read])
+
+
+def prefetched(iterable: Iterable, depth: int = 1) -> Iterator:
+    """Iterates over iterable in a background thread, keeping up to depth items ready ahead of the consumer"""
+    items = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((end, None))
+        except BaseException as e:
+            put((end, e))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is end:
+                return
+            yield item
+    finally:
+        stopped.set()
 
 
 def delete_lines(lines: int = 1):
@@ -0,0 +1,186 @@
+import asyncio
+import ctypes
+import ctypes.util
+import fnmatch
+import os
+import struct
+from typing import AsyncIterator, Dict, List, Optional
+
+from modules import config, logger
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+class Inotify:
+    """Thin wrapper of Linux inotify, through libc, so watching needs no extra dependencies"""
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self._check(self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+
+    @staticmethod
+    def is_supported() -> bool:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'))
+            return hasattr(libc, 'inotify_init1')
+        except OSError:
+            return False
+
+    def _check(self, result: int) -> int:
+        if result < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return result
+
+    def add_watch(self, path: str, mask: int = WATCH_MASK) -> int:
+        return self._check(self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask))
+
+    def read_events(self):
+        """Yields (watch descriptor, mask, name) of the events ready to be read, without blocking"""
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            yield wd, mask, name
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DirectoryWatcher:
+    """Watches a directory tree, yielding rounds of files that have settled: written and then left alone for a while.
+
+    Changed files are yielded together once the whole tree has had no changes for debounce seconds, so the files of a
+    burst, like the outputs of a build, make a single round, and files still being written are not yielded. If the
+    tree never quiets down, files left alone for max_delay seconds are yielded anyway. Uses inotify, so nothing is
+    rescanned; where inotify is not available, the tree is polled instead.
+    """
+
+    def __init__(self, path: str, pattern: Optional[str] = None, debounce=config.WATCH_DEBOUNCE,
+                 max_delay=config.WATCH_MAX_DELAY):
+        self.path = path
+        self.pattern = pattern
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self._pending: Dict[str, float] = {}  # Path of a changed file -> time of its last change
+        self._directories: Dict[int, str] = {}  # Watch descriptor -> watched directory
+        self._changed: Optional[asyncio.Event] = None
+        self._inotify: Optional[Inotify] = None
+        self._loop = None
+
+    def _matches(self, path: str) -> bool:
+        return self.pattern is None or fnmatch.fnmatch(os.path.basename(path), self.pattern)
+
+    def _touch(self, path: str):
+        if self._matches(path):
+            self._pending[path] = self._loop.time()
+            self._changed.set()
+
+    def _watch_tree(self, path: str, existing_files_changed: bool):
+        for directory, _, files in os.walk(path):
+            self._directories[self._inotify.add_watch(directory)] = directory
+            if existing_files_changed:
+                # Files created before the new directory was watched
+                for name in files:
+                    self._touch(os.path.join(directory, name))
+
+    def _on_events(self):
+        for wd, mask, name in self._inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                logger.d("inotify queue overflowed, some changes may be missed")
+                continue
+            directory = self._directories.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_tree(path, existing_files_changed=True)
+            elif mask & IN_DELETE:
+                self._pending.pop(path, None)
+            else:
+                self._touch(path)
+
+    async def rounds(self) -> AsyncIterator[List[str]]:
+        self._loop = asyncio.get_event_loop()
+        self._changed = asyncio.Event()
+        if not Inotify.is_supported():
+            logger.d("inotify is not supported, polling for changes instead")
+            async for files in self._polled_rounds():
+                yield files
+            return
+        self._inotify = Inotify()
+        try:
+            self._watch_tree(self.path, existing_files_changed=False)
+            self._loop.add_reader(self._inotify.fd, self._on_events)
+            async for files in self._settled_rounds():
+                yield files
+        finally:
+            self._loop.remove_reader(self._inotify.fd)
+            self._inotify.close()
+
+    def _take_settled(self) -> List[str]:
+        now = self._loop.time()
+        if now - max(self._pending.values()) >= self.debounce:
+            settled = list(self._pending)
+        else:
+            settled = [path for path, changed in self._pending.items() if now - changed >= self.max_delay]
+        for path in settled:
+            del self._pending[path]
+        return sorted(path for path in settled if os.path.isfile(path))
+
+    def _time_to_settle(self) -> float:
+        deadline = min(max(self._pending.values()) + self.debounce, min(self._pending.values()) + self.max_delay)
+        return max(0.0, deadline - self._loop.time())
+
+    async def _settled_rounds(self) -> AsyncIterator[List[str]]:
+        while True:
+            if not self._pending:
+                await self._changed.wait()
+                self._changed.clear()
+                continue
+            await asyncio.sleep(self._time_to_settle())
+            files = self._take_settled() if self._pending else None
+            if files:
+                yield files
+
+    async def _polled_rounds(self) -> AsyncIterator[List[str]]:
+        known = self._scan()
+        while True:
+            await asyncio.sleep(config.WATCH_POLL_INTERVAL)
+            current = self._scan()
+            for path, mtime in current.items():
+                if known.get(path) != mtime:
+                    self._touch(path)
+            known = current
+            files = self._take_settled() if self._pending else None
+            if files:
+                yield files
+
+    def _scan(self) -> Dict[str, float]:
+        mtimes = {}
+        for directory, _, files in os.walk(self.path):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    mtimes[path] = os.stat(path).st_mtime
+                except FileNotFoundError:
+                    pass
+        return mtimes
@@ -18,6 +18,10 @@ setuptools.setup(
     packages=setuptools.find_packages(),
     python_requires=">=3.6",
     install_requires=install_requires,
+    extras_require={
+        'zstd': ['zstandard'],
+        'http2': ['httpx[http2]'],
+    },
     classifiers=[
         "Programming Language :: Python",
         "Programming Language :: Python :: 3",
@@ -0,0 +1,11 @@
+import asyncio
+
+
+def run(coroutine):
+    """Runs a coroutine on a new event loop, set as the current one, and closes the loop afterwards"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
@@ -0,0 +1,112 @@
+import asyncio
+import os
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+from modules import agent
+from modules.agent import MetadataCache
+from modules.googleservice import DriveQueries
+from tests import run
+
+
+class MetadataCacheTest(unittest.TestCase):
+
+    def test_expired_entries_are_dropped_on_lookup(self):
+        cache = MetadataCache(ttl=60)
+        with mock.patch('time.time', return_value=1000):
+            cache.put('a', {'id': 'a'})
+        with mock.patch('time.time', return_value=1030):
+            self.assertEqual({'id': 'a'}, cache.get('a'))
+        with mock.patch('time.time', return_value=1060):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual(0, len(cache))
+
+    def test_expired_entries_are_dropped_when_storing(self):
+        cache = MetadataCache(ttl=60)
+        with mock.patch('time.time', return_value=1000):
+            for number in range(100):
+                cache.put(number, {})
+        with mock.patch('time.time', return_value=1100):
+            cache.put('new', {})
+        self.assertEqual(1, len(cache))
+
+    def test_size_is_capped(self):
+        cache = MetadataCache(ttl=60, max_size=10)
+        for number in range(100):
+            cache.put(number, {'id': number})
+        self.assertEqual(10, len(cache))
+        self.assertIsNone(cache.get(0))
+        self.assertEqual({'id': 99}, cache.get(99))
+
+
+class AgentSocketTest(unittest.TestCase):
+
+    @unittest.skipUnless(agent.is_supported(), "Needs Unix sockets")
+    def test_socket_is_created_private(self):
+        with tempfile.TemporaryDirectory() as directory:
+            socket_path = os.path.join(directory, 'agent.sock')
+            modes = []
+            real_start_unix_server = asyncio.start_unix_server
+
+            async def start_unix_server(*args, **kwargs):
+                server = await real_start_unix_server(*args, **kwargs)
+                # As soon as it listens, before anything else is done with it
+                modes.append(stat.S_IMODE(os.stat(socket_path).st_mode))
+                return server
+
+            async def serve_briefly():
+                serving = asyncio.ensure_future(agent.Agent(socket_path, google=object()).serve())
+                await asyncio.sleep(0.1)
+                serving.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await serving
+
+            with mock.patch('asyncio.start_unix_server', start_unix_server):
+                run(serve_briefly())
+            self.assertEqual([0o600], modes)
+
+    @unittest.skipUnless(agent.is_supported(), "Needs Unix sockets")
+    def test_running_agent_is_left_alone(self):
+        with tempfile.TemporaryDirectory() as directory:
+            socket_path = os.path.join(directory, 'agent.sock')
+
+            async def serve_twice():
+                serving = asyncio.ensure_future(agent.Agent(socket_path, google=object()).serve())
+                await asyncio.sleep(0.1)
+                try:
+                    with self.assertRaises(agent.AgentError):
+                        await asyncio.wait_for(agent.Agent(socket_path, google=object()).serve(), 1)
+                    self.assertIsNotNone(await asyncio.get_event_loop().run_in_executor(
+                        None, agent.AgentClient.connect_if_running, socket_path))
+                finally:
+                    serving.cancel()
+                    with self.assertRaises(asyncio.CancelledError):
+                        await serving
+
+            run(serve_twice())
+
+    @unittest.skipUnless(agent.is_supported(), "Needs Unix sockets")
+    def test_stale_socket_is_replaced(self):
+        with tempfile.TemporaryDirectory() as directory:
+            socket_path = os.path.join(directory, 'agent.sock')
+            # Left behind by an agent that was killed, with nothing listening on it
+            open(socket_path, 'w').close()
+
+            async def serve_briefly():
+                serving = asyncio.ensure_future(agent.Agent(socket_path, google=object()).serve())
+                await asyncio.sleep(0.1)
+                self.assertTrue(stat.S_ISSOCK(os.stat(socket_path).st_mode))
+                serving.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await serving
+
+            run(serve_briefly())
+
+
+class DriveQueriesTest(unittest.TestCase):
+
+    def test_search_page_is_abstract(self):
+        with self.assertRaises(TypeError):
+            DriveQueries()
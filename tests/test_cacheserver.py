@@ -0,0 +1,143 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from modules.cacheserver import CacheServer, UpstreamError, parse_range
+from tests import run
+
+BLOCK_SIZE = 1000
+CONTENT = bytes(range(256)) * 40
+CHECKSUM = hashlib.md5(CONTENT).hexdigest()
+TOKEN = 'Bearer token'
+
+
+class FakeDrive:
+    """Stands in for the requests the cache server makes to Drive, counting them"""
+
+    def __init__(self, content=CONTENT):
+        self.content = content
+        self.ranges = []
+        self.metadata_checks = 0
+        self._lock = threading.Lock()
+
+    def check_metadata(self, file_id, checksum, size, authorization):
+        with self._lock:
+            self.metadata_checks += 1
+        if checksum != hashlib.md5(self.content).hexdigest() or size != len(self.content):
+            raise UpstreamError(404, 'Not Found', {}, b'Drive has no such version of the file')
+
+    def download(self, entry, file_id, first, last, authorization):
+        time.sleep(0.05)  # Long enough for other clients to ask for the same blocks meanwhile
+        with self._lock:
+            self.ranges.append((first, last))
+        with open(entry.path, 'r+b') as f:
+            f.seek(first)
+            f.write(self.content[first:last + 1])
+
+
+class CacheServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.server = CacheServer(self.directory.name, max_size=1 << 30, block_size=BLOCK_SIZE)
+        self.drive = FakeDrive()
+        self.server._check_metadata = self.drive.check_metadata
+        self.server._download = self.drive.download
+
+    def tearDown(self):
+        self.server.executor.shutdown()
+        self.directory.cleanup()
+
+    def serve(self, *requests):
+        """Answers requests, as (range, authorization, checksum, size), sent at the same time by different clients"""
+        async def get(port, byte_range, authorization, checksum, size):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            headers = [f'GET /files/file?md5={checksum}&size={size} HTTP/1.1', 'Connection: close']
+            if byte_range is not None:
+                headers.append(f'Range: bytes={byte_range[0]}-{byte_range[1]}')
+            if authorization is not None:
+                headers.append(f'Authorization: {authorization}')
+            writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1'))
+            response = await reader.read()
+            writer.close()
+            head, _, body = response.partition(b'\r\n\r\n')
+            return int(head.split()[1]), body
+
+        async def serve():
+            server = await asyncio.start_server(self.server._handle, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                return await asyncio.gather(*(get(port, *request) for request in requests))
+            finally:
+                server.close()
+
+        return run(serve())
+
+    def test_concurrent_clients_asking_for_the_same_range_fetch_it_once(self):
+        responses = self.serve(*[((2500, 6499), TOKEN, CHECKSUM, len(CONTENT))] * 10)
+        self.assertEqual([(206, CONTENT[2500:6500])] * 10, responses)
+        self.assertEqual([(2000, 6999)], self.drive.ranges)
+        self.assertEqual(1, self.drive.metadata_checks)
+        self.assertEqual({}, self.server._fetches)
+
+    def test_overlapping_ranges_fetch_each_block_once(self):
+        ranges = [(0, 4999), (3000, 7999), (6000, len(CONTENT) - 1), None]
+        responses = self.serve(*[(byte_range, TOKEN, CHECKSUM, len(CONTENT)) for byte_range in ranges])
+        self.assertEqual([206, 206, 206, 200], [status for status, _ in responses])
+        self.assertEqual(CONTENT, responses[-1][1])
+        fetched = sorted(byte for first, last in self.drive.ranges for byte in range(first, last + 1))
+        self.assertEqual(list(range(len(CONTENT))), fetched)
+
+    def test_hits_need_no_token_and_misses_ask_for_one(self):
+        self.assertEqual([401], [status for status, _ in self.serve((None, None, CHECKSUM, len(CONTENT)))])
+        self.serve(((0, 999), TOKEN, CHECKSUM, len(CONTENT)))
+        self.assertEqual([(206, CONTENT[:1000])], self.serve(((0, 999), None, CHECKSUM, len(CONTENT))))
+        self.assertEqual([401], [status for status, _ in self.serve(((1000, 1999), None, CHECKSUM, len(CONTENT)))])
+
+    def test_nothing_is_allocated_for_a_size_drive_does_not_confirm(self):
+        self.assertEqual([404], [status for status, _ in self.serve(((0, 999), TOKEN, CHECKSUM, 1 << 50))])
+        self.assertEqual([], os.listdir(self.directory.name))
+        self.assertEqual([], self.drive.ranges)
+
+    def test_content_not_matching_the_checksum_is_dropped(self):
+        # Drive confirms the version asked for, and then the file changes
+        self.server._check_metadata = lambda *args: None
+        self.drive.content = CONTENT[::-1]
+        self.assertEqual([502], [status for status, _ in self.serve((None, TOKEN, CHECKSUM, len(CONTENT)))])
+        self.assertEqual([], os.listdir(self.directory.name))
+        self.assertEqual({}, self.server._entries)
+
+    def test_cache_is_only_scanned_when_it_may_not_fit(self):
+        scans = []
+        entries = self.server.entries
+        self.server.entries = lambda: scans.append(1) or entries()
+        for first in range(0, len(CONTENT) - BLOCK_SIZE, BLOCK_SIZE):
+            self.serve(((first, first + 9), TOKEN, CHECKSUM, len(CONTENT)))
+        self.assertEqual(1, len(scans))
+        self.server.max_size = 0
+        self.serve(((len(CONTENT) - 10, len(CONTENT) - 1), TOKEN, CHECKSUM, len(CONTENT)))
+        self.assertEqual(2, len(scans))
+
+    def test_empty_file(self):
+        self.assertEqual([(200, b'')], self.serve((None, None, hashlib.md5().hexdigest(), 0)))
+        self.assertEqual([], os.listdir(self.directory.name))
+
+
+class ParseRangeTest(unittest.TestCase):
+
+    def test_ranges(self):
+        self.assertEqual((0, 99), parse_range('bytes=0-99', 1000))
+        self.assertEqual((900, 999), parse_range('bytes=900-', 1000))
+        self.assertEqual((900, 999), parse_range('bytes=-100', 1000))
+        self.assertEqual((0, 999), parse_range('bytes=0-5000', 1000))
+        self.assertIsNone(parse_range(None, 1000))
+        with self.assertRaises(ValueError):
+            parse_range('bytes=1000-', 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import io
+import os
+import tempfile
+import unittest
+
+from modules.chunks import Chunks, SmallFile, StreamedChunks, complete, transfer
+from modules.memorybudget import MemoryBudget
+from tests import run
+
+CONTENT = bytes(range(256)) * 1000
+
+
+def downloader(start, end, interrupted=None):
+    return CONTENT[start:end + 1]
+
+
+def failing_downloader(start, end, interrupted=None):
+    if start > 0:
+        raise OSError("Connection reset")
+    return CONTENT[start:end + 1]
+
+
+class ChunksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'file')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_chunks_are_joined_in_order(self):
+        async def download():
+            progresses = [progress async for progress in transfer(Chunks(self.path, len(CONTENT), 1000, downloader))]
+            self.assertEqual(len(CONTENT), progresses[-1].bytes_received)
+
+        run(download())
+        with open(self.path, 'rb') as f:
+            self.assertEqual(CONTENT, f.read())
+        self.assertEqual(['file'], os.listdir(self.directory.name))
+
+    def test_failed_transfer_is_cancelled_and_leaves_nothing_behind(self):
+        async def download():
+            await complete(Chunks(self.path, len(CONTENT), 1000, failing_downloader))
+
+        with self.assertRaises(OSError):
+            run(download())
+        self.assertEqual([], os.listdir(self.directory.name))
+
+    def test_small_file(self):
+        async def download():
+            await complete(SmallFile(self.path, 1000, downloader))
+
+        run(download())
+        with open(self.path, 'rb') as f:
+            self.assertEqual(CONTENT[:1000], f.read())
+        self.assertEqual(['file'], os.listdir(self.directory.name))
+
+    def test_empty_small_file(self):
+        async def download():
+            return [progress async for progress in transfer(SmallFile(self.path, 0, failing_downloader))]
+
+        progresses = run(download())
+        self.assertEqual([100], [progress.percentage for progress in progresses])
+        with open(self.path, 'rb') as f:
+            self.assertEqual(b'', f.read())
+
+    def test_streamed_chunks_are_written_in_order(self):
+        output = io.BytesIO()
+
+        async def download():
+            await complete(StreamedChunks(len(CONTENT), 1000, downloader, output, MemoryBudget(4000)))
+
+        run(download())
+        self.assertEqual(CONTENT, output.getvalue())
@@ -0,0 +1,95 @@
+import io
+import os
+import unittest
+import zipfile
+
+from modules.drivefile import DriveFile
+
+CONTENT = bytes(range(256)) * 100
+
+
+class Downloader:
+    """Serves ranges of content, keeping the ranges asked for"""
+
+    def __init__(self, content=CONTENT):
+        self.content = content
+        self.ranges = []
+
+    def __call__(self, start, end):
+        self.ranges.append((start, end))
+        return self.content[start:end + 1]
+
+
+class DriveFileTest(unittest.TestCase):
+
+    def drive_file(self, content=CONTENT, **kwargs):
+        self.downloader = Downloader(content)
+        kwargs = dict(dict(block_size=1000, cache_size=4000, max_readahead=4000), **kwargs)
+        return DriveFile(self.downloader, len(content), **kwargs)
+
+    def test_reads_and_seeks(self):
+        f = self.drive_file()
+        self.assertEqual(CONTENT[:10], f.read(10))
+        f.seek(-5, os.SEEK_END)
+        self.assertEqual(CONTENT[-5:], f.read())
+        self.assertEqual(b'', f.read(10))
+        f.seek(2500)
+        f.seek(100, os.SEEK_CUR)
+        self.assertEqual(2600, f.tell())
+        self.assertEqual(CONTENT[2600:4100], f.read(1500))
+        with self.assertRaises(ValueError):
+            f.seek(-1)
+
+    def test_small_reads_of_a_block_take_one_request(self):
+        f = self.drive_file()
+        for offset in (900, 100, 500, 0):
+            f.seek(offset)
+            self.assertEqual(CONTENT[offset:offset + 50], f.read(50))
+        self.assertEqual([(0, 999)], self.downloader.ranges)
+
+    def test_adjacent_missing_blocks_take_one_request(self):
+        f = self.drive_file(max_readahead=0)
+        f.seek(1500)
+        f.read(10)
+        f.seek(0)
+        self.assertEqual(CONTENT[:3500], f.read(3500))
+        self.assertEqual([(1000, 1999), (0, 999), (2000, 3999)], self.downloader.ranges)
+
+    def test_least_recently_used_blocks_are_evicted(self):
+        f = self.drive_file(cache_size=2000)
+        for offset in (0, 5000, 0, 9000, 0, 5000):
+            f.seek(offset)
+            f.read(10)
+        self.assertEqual([(0, 999), (5000, 5999), (9000, 9999), (5000, 5999)], self.downloader.ranges)
+
+    def test_sequential_reads_read_ahead(self):
+        f = self.drive_file(max_readahead=2000)
+        while f.read(500):
+            pass
+        # The first block, and then a block with a readahead window of two after it, at a time
+        self.assertEqual([(0, 999)] + [(start, min(len(CONTENT), start + 3000) - 1)
+                                       for start in range(1000, len(CONTENT), 3000)], self.downloader.ranges)
+
+    def test_a_jump_drops_readahead(self):
+        f = self.drive_file()
+        f.read(2000)
+        f.read(1000)
+        self.downloader.ranges.clear()
+        f.seek(20000)
+        f.read(10)
+        self.assertEqual([(20000, 20999)], self.downloader.ranges)
+
+    def test_reads_a_member_of_a_zip_without_the_others(self):
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as z:
+            for number in range(10):
+                z.writestr(f'member{number}', os.urandom(20000))
+            z.writestr('wanted', b'the content')
+        f = self.drive_file(archive.getvalue())
+        with zipfile.ZipFile(io.BufferedReader(f)) as z:
+            self.assertEqual(b'the content', z.read('wanted'))
+        self.assertLess(sum(end - start + 1 for start, end in self.downloader.ranges), 20000)
+
+
+if __name__ == '__main__':
+    unittest.main()
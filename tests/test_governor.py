@@ -0,0 +1,315 @@
+import asyncio
+import http.client
+import re
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from modules.agent import Agent
+from modules.batch import Batch
+from modules.command import Watch
+from modules.governor import ConcurrencyGovernor, GovernedHttp, retry_after
+from modules.mediastream import MediaStream, download_range
+from modules.memorybudget import MemoryBudget
+from tests import run
+
+try:
+    import requests
+    from google.oauth2.credentials import Credentials
+    from googleapiclient.http import HttpRequest
+    from googleapiclient.model import MediaModel
+    from modules.googleservice import GoogleCredentials, GoogleService
+except ImportError:
+    GoogleService = None
+
+CONTENT = bytes(range(256)) * 2048
+RANGE_SIZE = 2048
+
+
+class Response(dict):
+    def __init__(self, status, headers=None):
+        super().__init__(headers or {})
+        self.status = status
+
+
+class ConcurrencyGovernorTest(unittest.TestCase):
+
+    def test_limit_grows_by_about_one_per_round(self):
+        governor = ConcurrencyGovernor(initial=4, maximum=64)
+        for _ in range(4):
+            governor.acquire()
+            governor.release()
+        self.assertTrue(4.9 < governor.limit <= 5, governor.limit)
+
+    def test_throttling_halves_the_limit_and_pauses(self):
+        governor = ConcurrencyGovernor(initial=32)
+        governor.acquire()
+        governor.release(throttled=True, retry_after=0.2)
+        self.assertEqual(16, governor.limit)
+        started = time.monotonic()
+        governor.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.15)
+        governor.release()
+
+    def test_limit_stays_within_bounds(self):
+        governor = ConcurrencyGovernor(initial=2, minimum=1, maximum=3)
+        for _ in range(5):
+            governor.acquire()
+            governor.release(throttled=True, retry_after=0)
+        self.assertEqual(1, governor.limit)
+        for _ in range(50):
+            governor.acquire()
+            governor.release()
+        self.assertEqual(3, governor.limit)
+
+    def test_initial_limit_above_the_maximum_is_kept(self):
+        governor = ConcurrencyGovernor(initial=100, maximum=64)
+        governor.acquire()
+        governor.release()
+        self.assertGreaterEqual(governor.limit, 100)
+
+    def test_retry_after(self):
+        self.assertEqual(3.0, retry_after(Response(429, {'retry-after': '3'})))
+        self.assertIsNone(retry_after(Response(429)))
+        self.assertIsNone(retry_after(Response(429, {'retry-after': 'soon'})))
+
+
+class GovernedHttpTest(unittest.TestCase):
+
+    def test_throttled_requests_are_retried(self):
+        class Http:
+            calls = 0
+
+            def request(self, uri, method='GET', body=None, headers=None):
+                Http.calls += 1
+                if Http.calls == 1:
+                    return Response(429, {'retry-after': '0'}), b''
+                return Response(200), b'ok'
+
+        http = GovernedHttp(Http(), ConcurrencyGovernor(initial=4))
+        response, content = http.request('https://drive')
+        self.assertEqual((200, b'ok'), (response.status, content))
+        self.assertEqual(2, Http.calls)
+        self.assertEqual(0, http.governor.in_flight)
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serves ranges of CONTENT, throttling the first requests once each, and counts the requests in flight"""
+    protocol_version = 'HTTP/1.0'
+    lock = threading.Lock()
+    in_flight = 0
+    most_in_flight = 0
+    to_throttle = 0
+    throttled = set()
+    authorization = None  # Required, if set
+
+    def do_GET(self):
+        cls = type(self)
+        if cls.authorization is not None and self.headers['Authorization'] != cls.authorization:
+            self.send_response(401)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        with cls.lock:
+            cls.in_flight += 1
+            cls.most_in_flight = max(cls.most_in_flight, cls.in_flight)
+            throttle = cls.to_throttle > 0 and self.headers['Range'] not in cls.throttled
+            if throttle:
+                cls.to_throttle -= 1
+                cls.throttled.add(self.headers['Range'])
+        try:
+            time.sleep(0.05)
+            if throttle:
+                self.send_response(429)
+                self.send_header('Retry-After', '0')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            start, end = map(int, re.match(r'bytes=(\d+)-(\d+)', self.headers['Range']).groups())
+            body = CONTENT[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with cls.lock:
+                cls.in_flight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class RangeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class LocalServerTest(unittest.TestCase):
+    """Tests against a RangeHandler serving on a local port"""
+
+    def setUp(self):
+        RangeHandler.in_flight = RangeHandler.most_in_flight = RangeHandler.to_throttle = 0
+        RangeHandler.throttled = set()
+        RangeHandler.authorization = None
+        self.server = RangeServer(('127.0.0.1', 0), RangeHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class StressTest(LocalServerTest):
+    """Hundreds of ranges downloaded at once from a local server, through a governor"""
+
+    def open_stream(self, uri, headers):
+        connection = http.client.HTTPConnection(*self.server.server_address)
+        connection.request('GET', uri, headers=headers)
+        response = connection.getresponse()
+        return MediaStream(response.status, response.reason, dict(response.getheaders()),
+                           iter(lambda: response.read(1024), b''), connection.close)
+
+    def download(self, governor, workers):
+        interrupted = threading.Event()
+        starts = range(0, len(CONTENT), RANGE_SIZE)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            ranges = executor.map(lambda start: download_range(
+                self.open_stream, governor, '/file', start, start + RANGE_SIZE - 1, interrupted), starts)
+            return b''.join(ranges)
+
+    def test_requests_in_flight_start_at_the_initial_limit(self):
+        governor = ConcurrencyGovernor(initial=32)
+        self.assertEqual(CONTENT, self.download(governor, workers=64))
+        self.assertLessEqual(RangeHandler.most_in_flight, int(governor.limit))
+        self.assertGreater(RangeHandler.most_in_flight, 16)
+        self.assertEqual(0, governor.in_flight)
+
+    def test_throttled_ranges_back_off_and_are_retried(self):
+        RangeHandler.to_throttle = 20
+        governor = ConcurrencyGovernor(initial=32)
+        self.assertEqual(CONTENT, self.download(governor, workers=64))
+        self.assertEqual(0, RangeHandler.to_throttle)
+        self.assertLess(governor.limit, 32)
+        self.assertEqual(0, governor.in_flight)
+
+
+class FakeDriveResource:
+    """The files resource of Drive, with media on a local server"""
+
+    def __init__(self, uri):
+        self.uri = uri
+
+    def files(self):
+        return self
+
+    def get_media(self, fileId):
+        return HttpRequest(None, MediaModel().response, f'{self.uri}/{fileId}?alt=media', headers={})
+
+
+@unittest.skipIf(GoogleService is None, "Needs google-api-python-client and requests")
+class DownloaderStressTest(LocalServerTest):
+    """Hundreds of ranges downloaded at once from a local server, through the downloaders of a GoogleService"""
+
+    def setUp(self):
+        super().setUp()
+        RangeHandler.authorization = 'Bearer token'
+        uri = 'http://{}:{}'.format(*self.server.server_address)
+        with mock.patch.object(GoogleCredentials, 'build', return_value=Credentials('token')), \
+                mock.patch.object(GoogleService, 'build_drive', return_value=FakeDriveResource(uri)):
+            self.google = GoogleService(concurrency=32)
+
+    def download_through_service(self, interruptible: bool):
+        file_downloader = self.google.get_file_downloader({'id': 'file', 'size': str(len(CONTENT))})
+        interrupted = threading.Event() if interruptible else None
+        starts = range(0, len(CONTENT), RANGE_SIZE)
+        with ThreadPoolExecutor(max_workers=64) as executor:
+            ranges = list(executor.map(lambda start: bytes(file_downloader(start, start + RANGE_SIZE - 1, interrupted)),
+                                       starts))
+        for start, content in zip(starts, ranges):
+            self.assertEqual(CONTENT[start:start + RANGE_SIZE], content, f'range at {start}')
+        self.assertEqual(0, self.google.governor.in_flight)
+
+    def test_streamed_ranges(self):
+        self.download_through_service(interruptible=True)
+        self.assertLessEqual(RangeHandler.most_in_flight, int(self.google.governor.limit))
+        self.assertGreater(RangeHandler.most_in_flight, 16)
+
+    def test_ranges_through_the_api_client(self):
+        self.download_through_service(interruptible=False)
+        self.assertLessEqual(RangeHandler.most_in_flight, int(self.google.governor.limit))
+        self.assertGreater(RangeHandler.most_in_flight, 16)
+
+    def test_throttled_ranges(self):
+        RangeHandler.to_throttle = 20
+        self.download_through_service(interruptible=True)
+        self.assertEqual(0, RangeHandler.to_throttle)
+
+
+class FakeUploadRequest:
+    """A resumable upload of a few chunks, keeping the http each chunk was sent with and the thread sending it"""
+
+    def __init__(self, chunks=3):
+        self.http = None
+        self.chunks = chunks
+        self.sent = []
+
+    def next_chunk(self, http=None):
+        self.sent.append((http or self.http, threading.get_ident()))
+        time.sleep(0.01)  # Long enough for the other uploads to be sending their chunks meanwhile
+        self.chunks -= 1
+        return None, {'id': 'file'} if not self.chunks else None
+
+
+@unittest.skipIf(GoogleService is None, "Needs google-api-python-client and requests")
+class ConcurrentUploadTest(unittest.TestCase):
+
+    def setUp(self):
+        with mock.patch.object(GoogleCredentials, 'build', return_value=Credentials('token')), \
+                mock.patch.object(GoogleService, 'build_drive', return_value=None):
+            self.google = GoogleService()
+
+    def assert_no_http_is_shared(self, upload):
+        """Runs upload for a few paths at the same time"""
+        requests_sent = [FakeUploadRequest() for _ in range(8)]
+        with mock.patch.object(self.google, 'upload', side_effect=requests_sent), mock.patch('builtins.print'):
+            async def upload_all():
+                await asyncio.gather(*(upload(f'file{number}') for number in range(8)))
+
+            run(upload_all())
+        threads = {}
+        for request in requests_sent:
+            self.assertEqual(0, request.chunks)
+            for http, thread in request.sent:
+                self.assertIsNotNone(http)
+                threads.setdefault(id(http), set()).add(thread)
+        self.assertTrue(all(len(used_by) == 1 for used_by in threads.values()))
+
+    def test_uploads_of_a_watch_round_never_share_an_http(self):
+        watch = Watch.__new__(Watch)
+        watch.google = self.google
+        self.assert_no_http_is_shared(watch.upload_file)
+
+    def test_upload_jobs_of_a_batch_never_share_an_http(self):
+        runner = Batch(self.google, None, concurrency=8, memory=MemoryBudget(1 << 20))
+        try:
+            self.assert_no_http_is_shared(lambda path: runner._upload({'path': path}))
+        finally:
+            runner._executor.shutdown()
+
+    def test_uploads_of_agent_clients_never_share_an_http(self):
+        drive_agent = Agent(google=self.google)
+
+        async def upload(path):
+            async for _ in drive_agent._job_upload(path, None):
+                pass
+
+        try:
+            self.assert_no_http_is_shared(upload)
+        finally:
+            drive_agent.executor.shutdown()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import asyncio
+import io
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from modules.chunks import Chunks, StreamedChunks, complete, create_chunks
+from modules.memorybudget import MemoryBudget
+from modules.util import from_human_readable, positive_int, positive_size
+from tests import run
+
+MB = 1024 * 1024
+
+
+class MemoryBudgetTest(unittest.TestCase):
+
+    def test_reserve_waits_for_release(self):
+        memory = MemoryBudget(10)
+        self.assertTrue(memory.reserve(6))
+        self.assertFalse(memory.reserve(6, timeout=0.05))
+        threading.Timer(0.05, memory.release, (6,)).start()
+        self.assertTrue(memory.reserve(6, timeout=5))
+        self.assertEqual(6, memory.reserved)
+
+    def test_reservation_larger_than_budget_passes_alone(self):
+        memory = MemoryBudget(10)
+        self.assertTrue(memory.reserve(20, timeout=0))
+        self.assertFalse(memory.reserve(1, timeout=0))
+
+
+class ChunksMemoryTest(unittest.TestCase):
+
+    def test_peak_memory_stays_within_max_memory(self):
+        max_memory = 8 * MB
+        chunk_size = 2 * MB
+
+        def downloader(start, end, interrupted=None):
+            return bytearray(end - start + 1)
+
+        async def download(path):
+            chunks = Chunks(path, 32 * MB, chunk_size, downloader, MemoryBudget(max_memory), executor=ThreadPoolExecutor(16),
+                            window=16)
+            async for _ in chunks.progresses():
+                pass
+            await chunks.await_it()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'file')
+            tracemalloc.start()
+            try:
+                run(download(path))
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            self.assertEqual(32 * MB, os.path.getsize(path))
+        # The budget, plus the join buffer and some slack for everything else
+        self.assertLess(peak, max_memory + 2 * MB)
+
+    def test_concurrent_transfers_share_one_budget(self):
+        max_memory = 8 * MB
+        memory = MemoryBudget(max_memory)
+        in_flight = []
+        lock = threading.Lock()
+
+        def downloader(start, end, interrupted=None):
+            with lock:
+                in_flight.append((in_flight[-1] if in_flight else 0) + end - start + 1)
+            time.sleep(0.01)  # Long enough for the downloads of the other transfers to overlap it
+            with lock:
+                in_flight.append(in_flight[-1] - (end - start + 1))
+            return bytearray(end - start + 1)
+
+        async def download(directory):
+            transfers = [create_chunks(os.path.join(directory, f'file{number}'), 16 * MB, 2 * MB, downloader, memory,
+                                       executor=ThreadPoolExecutor(16), window=16) for number in range(3)]
+            transfers += [create_chunks(os.path.join(directory, f'small{number}'), MB, 2 * MB, downloader, memory,
+                                        executor=ThreadPoolExecutor(1)) for number in range(4)]
+            transfers.append(StreamedChunks(16 * MB, 2 * MB, downloader, io.BytesIO(), memory,
+                                            executor=ThreadPoolExecutor(16)))
+            await asyncio.gather(*map(complete, transfers))
+
+        with tempfile.TemporaryDirectory() as directory:
+            run(download(directory))
+        self.assertLessEqual(max(in_flight), max_memory)
+        self.assertEqual(0, memory.reserved)
+
+    def test_failed_stream_gives_its_memory_back(self):
+        memory = MemoryBudget(8 * MB)
+        executor = ThreadPoolExecutor(4)
+
+        def downloader(start, end, interrupted=None):
+            if start == 2 * MB:
+                time.sleep(0.05)  # Long enough for the chunks after it to be downloaded, and wait to be written
+                raise OSError("Connection reset")
+            return bytearray(end - start + 1)
+
+        async def download():
+            await complete(StreamedChunks(16 * MB, MB, downloader, io.BytesIO(), memory, executor=executor))
+
+        with self.assertRaises(OSError):
+            run(download())
+        executor.shutdown()
+        self.assertEqual(0, memory.reserved)
+
+
+class SizeTest(unittest.TestCase):
+
+    def test_from_human_readable(self):
+        self.assertEqual(256 * MB, from_human_readable('256M'))
+        self.assertEqual(0, from_human_readable('0'))
+
+    def test_invalid_sizes(self):
+        for value in ('-1M', 'inf', 'nan', 'lots'):
+            with self.assertRaises(ValueError, msg=value):
+                from_human_readable(value)
+
+    def test_positive_size_rejects_zero(self):
+        with self.assertRaises(ValueError):
+            positive_size('0')
+        self.assertEqual(1, positive_size('1'))
+
+    def test_positive_int_rejects_zero(self):
+        for value in ('0', '-1', 'many'):
+            with self.assertRaises(ValueError, msg=value):
+                positive_int(value)
+        self.assertEqual(32, positive_int('32'))
@@ -0,0 +1,150 @@
+import json
+import os
+import tempfile
+import unittest
+
+from modules.memorybudget import MemoryBudget
+from modules.mirror import STATE_FILE, Mirror, MirrorError
+from tests import run
+
+FOLDER = 'folder'
+
+
+class FakeDrive:
+    """The calls a mirror makes to Google Drive, answered from a dict of file ID -> (name, content)"""
+
+    def __init__(self, files):
+        self.files = files
+        self.changes = []
+        self.downloads = []
+        self.failing = set()
+
+    def metadata(self, file_id):
+        name, content = self.files[file_id]
+        return {'id': file_id, 'name': name, 'size': str(len(content)), 'md5Checksum': str(hash(content)),
+                'parents': [FOLDER]}
+
+    def get_start_page_token(self):
+        return '1'
+
+    def search(self, query, page_size, fields=None):
+        yield [self.metadata(file_id) for file_id in self.files]
+
+    def list_changes(self, page_token, fields=None):
+        changes, self.changes = self.changes, []
+        return changes, None, str(int(page_token) + 1)
+
+    def change(self, file_id):
+        self.changes.append({'fileId': file_id, 'file': self.metadata(file_id)})
+
+    def get_file_downloader(self, metadata):
+        file_id = metadata['id']
+        self.downloads.append(file_id)
+
+        def download(start, end, interrupted=None):
+            if file_id in self.failing:
+                raise OSError("Connection reset")
+            return self.files[file_id][1][start:end + 1]
+
+        return download
+
+
+class MirrorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def sync(self, drive):
+        async def sync():
+            mirror = Mirror(drive, FOLDER, self.path, MemoryBudget(1 << 20))
+            try:
+                await mirror.sync()
+            finally:
+                mirror.close()
+            return mirror
+
+        return run(sync())
+
+    def read(self, name):
+        with open(os.path.join(self.path, name), 'rb') as f:
+            return f.read()
+
+    def state(self):
+        with open(os.path.join(self.path, STATE_FILE), 'r') as f:
+            return json.load(f)
+
+    def test_first_sync_mirrors_the_folder_and_checkpoints(self):
+        drive = FakeDrive({'a': ('a.txt', b'a' * 5000), 'b': ('b.txt', b'')})
+        self.sync(drive)
+        self.assertEqual(b'a' * 5000, self.read('a.txt'))
+        self.assertEqual(b'', self.read('b.txt'))
+        self.assertEqual({'a', 'b'}, set(self.state()['files']))
+        self.assertEqual([STATE_FILE, 'a.txt', 'b.txt'], sorted(os.listdir(self.path)))
+
+    def test_later_syncs_resume_from_the_checkpoint(self):
+        drive = FakeDrive({'a': ('a.txt', b'old')})
+        self.sync(drive)
+        drive.files['a'] = ('a.txt', b'new')
+        drive.change('a')
+        drive.downloads.clear()
+        self.sync(drive)
+        self.assertEqual(['a'], drive.downloads)
+        self.assertEqual(b'new', self.read('a.txt'))
+
+    def test_checkpoint_is_not_moved_past_a_failed_download(self):
+        drive = FakeDrive({'a': ('a.txt', b'old')})
+        self.sync(drive)
+        page_token = self.state()['page_token']
+        drive.files['a'] = ('a.txt', b'new')
+        drive.change('a')
+        drive.failing.add('a')
+        with self.assertRaises(MirrorError):
+            self.sync(drive)
+        self.assertEqual(page_token, self.state()['page_token'])
+        self.assertEqual(b'old', self.read('a.txt'))
+        self.assertEqual([STATE_FILE, 'a.txt'], sorted(os.listdir(self.path)))
+
+    def test_files_with_the_same_name_download_apart(self):
+        drive = FakeDrive({'a': ('same.txt', b'a' * 5000), 'b': ('same.txt', b'b' * 5000)})
+        self.sync(drive)
+        self.assertIn(self.read('same.txt'), (b'a' * 5000, b'b' * 5000))
+        self.assertEqual([STATE_FILE, 'same.txt'], sorted(os.listdir(self.path)))
+
+    def test_rename_of_a_deleted_local_file_downloads_it(self):
+        drive = FakeDrive({'a': ('a.txt', b'content')})
+        self.sync(drive)
+        page_token = self.state()['page_token']
+        os.remove(os.path.join(self.path, 'a.txt'))
+        drive.files['a'] = ('renamed.txt', b'content')
+        drive.change('a')
+        mirror = self.sync(drive)
+        self.assertEqual(b'content', self.read('renamed.txt'))
+        self.assertEqual('renamed.txt', mirror.files['a']['name'])
+        self.assertNotEqual(page_token, self.state()['page_token'])
+
+    def test_names_the_mirror_cannot_use_are_skipped(self):
+        names = ['..', '.', STATE_FILE, f'{STATE_FILE}.tmp', '.b.part', '..c.part']
+        drive = FakeDrive(dict({f'bad{number}': (name, b'bad') for number, name in enumerate(names)},
+                               a=('a.txt', b'content')))
+        mirror = self.sync(drive)
+        self.assertEqual(['a'], list(mirror.files))
+        self.assertEqual([STATE_FILE, 'a.txt'], sorted(os.listdir(self.path)))
+        self.assertEqual(FOLDER, self.state()['folder'])
+
+    def test_file_renamed_to_a_name_the_mirror_cannot_use_is_removed(self):
+        drive = FakeDrive({'a': ('a.txt', b'content')})
+        self.sync(drive)
+        drive.files['a'] = (STATE_FILE, b'content')
+        drive.change('a')
+        mirror = self.sync(drive)
+        self.assertEqual({}, mirror.files)
+        self.assertEqual([STATE_FILE], os.listdir(self.path))
+        self.assertEqual(FOLDER, self.state()['folder'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import io
+import threading
+import unittest
+from argparse import Namespace
+from unittest import mock
+
+from modules.chunks import complete
+from modules.command import Download
+from tests import run
+
+CONTENT = bytes(range(256)) * 1000
+
+
+class FakeService:
+    """Serves ranges of content, keeping the ranges asked for"""
+
+    def __init__(self):
+        self.ranges = []
+        self._lock = threading.Lock()
+
+    def get_file_downloader(self, metadata):
+        def downloader(start, end, interrupted=None):
+            with self._lock:
+                self.ranges.append((start, end))
+            return CONTENT[start:end + 1]
+
+        return downloader
+
+
+class PrefetchTest(unittest.TestCase):
+
+    def download(self, max_memory):
+        google = FakeService()
+        args = Namespace(file=['file'], no_agent=True, max_memory=max_memory, processes=0, output='-', cache=False,
+                         member=None, cache_server=None, workers=4)
+        with mock.patch.object(Download, '_create_service', return_value=google):
+            command = Download(args)
+        command.output = io.BytesIO()
+        command.prefetch_first_range()
+
+        async def download():
+            await complete(command.create_chunks({'id': 'file', 'size': str(len(CONTENT))}))
+
+        run(download())
+        self.assertEqual(CONTENT, command.output.getvalue())
+        return google.ranges
+
+    def test_first_chunk_is_taken_from_the_prefetch(self):
+        ranges = self.download(max_memory=100000)
+        self.assertEqual(1, ranges.count((0, 99999)))
+        self.assertEqual(len(set(ranges)), len(ranges))
+
+    def test_prefetch_fits_the_memory_budget(self):
+        # A prefetch of a whole default chunk would not match the first chunk, clipped to the budget, and be wasted
+        ranges = self.download(max_memory=50000)
+        self.assertEqual([(0, 49999)], [byte_range for byte_range in ranges if byte_range[0] == 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
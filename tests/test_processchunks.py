@@ -0,0 +1,60 @@
+import multiprocessing
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from modules import processchunks
+from modules.processchunks import ProcessChunks
+from tests import run
+
+CHUNK_SIZE = 1024
+
+
+def fake_init_worker(metadata, file_path, interrupted, cache_server):
+    processchunks._worker['fd'] = os.open(file_path, os.O_WRONLY)
+
+
+def fake_download_range(start: int, end: int) -> int:
+    content = bytes([start // CHUNK_SIZE % 256]) * (end - start + 1)
+    os.pwrite(processchunks._worker['fd'], content, start)
+    return len(content)
+
+
+class WindowedProcessChunks(ProcessChunks):
+    """Records the most chunks ever submitted and not done at the same time"""
+    most_in_flight = 0
+
+    def _submit(self, number: int):
+        task = super()._submit(number)
+        WindowedProcessChunks.most_in_flight = max(WindowedProcessChunks.most_in_flight, len(self._in_flight) + 1)
+        return task
+
+
+# The fakes reach the worker processes by being patched in before they are forked
+@unittest.skipUnless(multiprocessing.get_start_method() == 'fork', "Needs worker processes started by fork")
+class ProcessChunksTest(unittest.TestCase):
+
+    def test_only_a_window_of_chunks_is_submitted(self):
+        number_of_chunks = 100
+        file_size = number_of_chunks * CHUNK_SIZE - 10
+
+        async def download(path):
+            chunks = WindowedProcessChunks(path, file_size, CHUNK_SIZE, {}, 2, window=4)
+            progresses = [progress async for progress in chunks.progresses()]
+            await chunks.await_it()
+            return progresses
+
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.object(processchunks, '_init_worker', fake_init_worker), \
+                mock.patch.object(processchunks, '_download_range', fake_download_range):
+            path = os.path.join(directory, 'file')
+            progresses = run(download(path))
+            with open(path, 'rb') as f:
+                content = f.read()
+        self.assertLessEqual(WindowedProcessChunks.most_in_flight, 4)
+        self.assertEqual(number_of_chunks, len(progresses))
+        self.assertEqual(file_size, progresses[-1].bytes_received)
+        self.assertEqual(file_size, len(content))
+        for number in range(number_of_chunks):
+            self.assertEqual({number % 256}, set(content[number * CHUNK_SIZE:(number + 1) * CHUNK_SIZE]))
@@ -0,0 +1,55 @@
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+from modules.chunks import SmallFile, transfer
+from modules.progresslogger import Progress, ProgressLogger
+from tests import run
+
+
+def log(*progresses):
+    """What a progress logger prints for progresses"""
+    async def send():
+        with ProgressLogger('Downloading') as progress_logger:
+            for progress in progresses:
+                await progress_logger.send(progress)
+        await progress_logger
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        run(send())
+    return output.getvalue()
+
+
+class ProgressLoggerTest(unittest.TestCase):
+
+    def test_progress(self):
+        self.assertIn('Downloading 50% - ', log(Progress(50, 100)))
+
+    def test_nothing_received_yet(self):
+        self.assertIn('ETA: --:--:--', log(Progress(0, 100)))
+
+    def test_empty_file(self):
+        self.assertIn('Downloading 100% - 0.0B/0.0B', log(Progress(0, 0)))
+
+    def test_unknown_total(self):
+        self.assertIn('Downloading 0.0B', log(Progress(0, None)))
+
+    def test_empty_file_download(self):
+        with tempfile.TemporaryDirectory() as directory:
+            async def download():
+                with ProgressLogger('Downloading') as progress_logger:
+                    async for progress in transfer(SmallFile(os.path.join(directory, 'file'), 0, None)):
+                        await progress_logger.send(progress)
+                await progress_logger
+
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                run(download())
+        self.assertIn('Downloading 100%', output.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
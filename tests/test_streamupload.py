@@ -0,0 +1,31 @@
+import io
+import unittest
+
+try:
+    from modules.streamupload import StreamMediaUpload, StreamNotSerializableError
+except ImportError:
+    StreamMediaUpload = None
+
+
+@unittest.skipIf(StreamMediaUpload is None, "Needs google-api-python-client")
+class StreamMediaUploadTest(unittest.TestCase):
+
+    def test_reads_ahead_and_resends_unacknowledged_bytes(self):
+        upload = StreamMediaUpload(io.BytesIO(b'0123456789'), 'text/plain', 4)
+        self.assertEqual(b'0123', upload.getbytes(0, 4))
+        # Only the first two bytes were acknowledged
+        self.assertEqual(b'2345', upload.getbytes(2, 4))
+        self.assertEqual(b'6789', upload.getbytes(6, 4))
+        self.assertEqual(b'', upload.getbytes(10, 4))
+
+    def test_cannot_rewind_past_acknowledged_bytes(self):
+        upload = StreamMediaUpload(io.BytesIO(b'0123456789'), 'text/plain', 4)
+        upload.getbytes(0, 4)
+        upload.getbytes(4, 4)
+        with self.assertRaises(ValueError):
+            upload.getbytes(0, 4)
+
+    def test_cannot_be_serialized(self):
+        upload = StreamMediaUpload(io.BytesIO(b''), 'text/plain', 4)
+        with self.assertRaises(StreamNotSerializableError):
+            upload.to_json()
@@ -0,0 +1,70 @@
+import io
+import os
+import tempfile
+import threading
+import unittest
+
+from modules import tracing
+from modules.chunks import Chunks, StreamedChunks, complete
+from modules.mediastream import MediaStream
+from modules.memorybudget import MemoryBudget
+from tests import run
+
+CONTENT = bytes(range(256)) * 100
+
+
+def streaming_downloader(start, end, interrupted):
+    """Like a media download, which marks its first byte when it reads its stream"""
+    content = CONTENT[start:end + 1]
+    blocks = (content[i:i + 100] for i in range(0, len(content), 100))
+    return bytes(MediaStream(206, 'Partial Content', {}, blocks, lambda: None).read(interrupted, len(content)))
+
+
+class TracingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        tracing.start()
+
+    def tearDown(self):
+        tracing._events = None
+        self.directory.cleanup()
+
+    def events(self, name):
+        return [event for event in tracing._events if event['name'] == name]
+
+    def assert_first_bytes_are_steps_of(self, span_ids):
+        first_bytes = self.events('first byte')
+        self.assertEqual(['n'] * len(span_ids), [event['ph'] for event in first_bytes])
+        self.assertEqual(sorted(span_ids), sorted(event['id'] for event in first_bytes))
+
+    def test_first_byte_is_a_step_of_its_chunk(self):
+        path = os.path.join(self.directory.name, 'file')
+
+        async def download():
+            await complete(Chunks(path, len(CONTENT), 10000, streaming_downloader))
+
+        run(download())
+        begun = [event['id'] for event in tracing._events if event['ph'] == 'b']
+        self.assertEqual(3, len(begun))
+        self.assert_first_bytes_are_steps_of(begun)
+
+    def test_first_byte_is_a_step_of_its_streamed_chunk(self):
+        output = io.BytesIO()
+
+        async def download():
+            await complete(StreamedChunks(len(CONTENT), 10000, streaming_downloader, output, MemoryBudget(20000)))
+
+        run(download())
+        self.assertEqual(CONTENT, output.getvalue())
+        begun = [event['id'] for event in tracing._events if event['ph'] == 'b']
+        self.assertEqual(3, len(begun))
+        self.assert_first_bytes_are_steps_of(begun)
+
+    def test_first_byte_outside_a_span_is_an_instant(self):
+        streaming_downloader(0, 99, threading.Event())
+        self.assertEqual(['i'], [event['ph'] for event in self.events('first byte')])
+
+
+if __name__ == '__main__':
+    unittest.main()